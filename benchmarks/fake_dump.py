@@ -0,0 +1,62 @@
+"""Stand-in for the database client tools (mysqldump, pg_dumpall, pg_dump,
+mysql, psql), which are used by the benchmarks instead of real databases.
+
+Dump tools write synthetic SQL to stdout. Its size and entropy are read from
+the environment:
+
+- BENCH_DUMP_SIZE: size of the dump in bytes
+- BENCH_DUMP_ENTROPY: share of random data in each row (0.0 - 1.0)
+- BENCH_DUMP_SEED: seed of the random data
+"""
+
+import os
+import random
+import sys
+
+ROW_PAYLOAD_SIZE = 200
+ROWS_PER_BATCH = 1000
+FILLER = "lorem ipsum dolor sit amet " * (ROW_PAYLOAD_SIZE // 27 + 1)
+DATABASE_NAME = "bench"
+
+
+def write_dump(output, size, entropy, seed):
+    rng = random.Random(seed)
+    random_size = round(ROW_PAYLOAD_SIZE * min(max(entropy, 0.0), 1.0))
+    filler = FILLER[:ROW_PAYLOAD_SIZE - random_size]
+
+    header = (
+        f"CREATE DATABASE `{DATABASE_NAME}`;\n"
+        f"CREATE TABLE `rows` (`id` int, `payload` text);\n"
+    ).encode()
+    output.write(header)
+    written = len(header)
+
+    row_id = 0
+    while written < size:
+        # Hex encoding doubles the size, so half of the random bytes suffice
+        random_data = rng.randbytes(
+            (random_size * ROWS_PER_BATCH + 1) // 2).hex()
+        rows = []
+        for i in range(ROWS_PER_BATCH):
+            payload = random_data[i * random_size:(i + 1) * random_size]
+            rows.append(
+                f"INSERT INTO `rows` VALUES ({row_id},'{payload}{filler}');\n")
+            row_id += 1
+        batch = "".join(rows).encode()[:size - written]
+        output.write(batch)
+        written += len(batch)
+
+
+if __name__ == "__main__":
+    tool = sys.argv[1]
+
+    if tool in ["mysql", "psql"]:
+        # Answers every query with the name of the only database
+        print(DATABASE_NAME)
+    else:
+        write_dump(
+            sys.stdout.buffer,
+            int(os.getenv("BENCH_DUMP_SIZE", str(32 * 1024 * 1024))),
+            float(os.getenv("BENCH_DUMP_ENTROPY", "0.5")),
+            os.getenv("BENCH_DUMP_SEED", "0"),
+        )
@@ -0,0 +1,375 @@
+"""Benchmarks of the backup pipeline.
+
+Runs the backup cycle against a fake docker client and stand-in dump tools,
+and measures the throughput of the single stages. Each stage runs in its own
+process, so that the peak RSS can be attributed to it. Results are written
+as JSON.
+
+Usage: python benchmarks/run.py [--output results.json] [--stages cycle,...]
+"""
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyAesCrypt  # noqa: E402
+
+from src import settings, compression  # noqa: E402
+from src.backup import Backup, TargetLogger  # noqa: E402
+from src.compression import CompressionAlgorithm  # noqa: E402
+from src.database import Database  # noqa: E402
+from src.healthcheck import Healthcheck  # noqa: E402
+from src.metrics import Metrics  # noqa: E402
+from src.pipeline import BUFFER_SIZE  # noqa: E402
+from src.registry import TargetRegistry  # noqa: E402
+from fake_dump import write_dump  # noqa: E402
+
+RESULT_VERSION = 1
+STAND_IN_TOOLS = ["mysqldump", "mysql", "pg_dumpall", "pg_dump", "psql"]
+ENCRYPTION_KEY = "benchmark"
+
+# Label sets of the benchmarked backup cycles
+CYCLE_SCENARIOS = {
+    "plain": {},
+    "gzip": {"compress": "true"},
+    "gzip_encrypt": {"compress": "true", "encrypt": "true", "encryption_key": ENCRYPTION_KEY},
+    "stream_gzip_encrypt": {
+        "stream": "true", "compress": "true", "encrypt": "true", "encryption_key": ENCRYPTION_KEY},
+    "stream_zstd": {"stream": "true", "compress": "true", "compression_algorithm": "zstd"},
+    "per_database": {"dump_layout": "per_database", "compress": "true"},
+}
+STAGES = [f"cycle:{x}" for x in CYCLE_SCENARIOS] + \
+    ["compression", "encryption", "retention"]
+
+
+class FakeImage:
+    tags = ["mysql:8"]
+
+
+class FakeContainer:
+    def __init__(self, index, labels):
+        self.id = f"{index:064x}"
+        self.short_id = self.id[:12]
+        self.name = f"bench{index}"
+        self.labels = {f"{settings.LABEL_PREFIX}{key}": value for key, value in labels.items()}
+        self.labels[f"{settings.LABEL_PREFIX}enable"] = "true"
+        self.image = FakeImage()
+        self.attrs = {"State": {"StartedAt": "2000-01-01T00:00:00.000000000Z"}}
+
+
+class FakeContainerCollection:
+    def __init__(self, containers):
+        self._containers = containers
+
+    def list(self, filters=None):
+        return self._containers
+
+
+class FakeClient:
+    """Docker client of the target registry (DOCKER_EVENTS_ENABLE). The
+    targets never change, so the event stream stays empty."""
+
+    def __init__(self, containers):
+        self.containers = FakeContainerCollection(containers)
+
+    def events(self, **kwargs):
+        threading.Event().wait()
+        yield from ()
+
+
+class FakeDocker:
+    """Replaces src.docker.Docker. Targets are reachable without any network."""
+
+    def __init__(self, containers):
+        self._containers = containers
+
+    def get_targets(self, label):
+        return self._containers
+
+    def watch_targets(self, label, global_labels):
+        return TargetRegistry(FakeClient(self._containers), label, global_labels)
+
+    def create_backup_network(self):
+        pass
+
+    def remove_backup_network(self):
+        pass
+
+    def reconcile_targets(self, containers):
+        pass
+
+    def get_target_name(self, container):
+        return container.name
+
+    def connect_target(self, container):
+        pass
+
+    def disconnect_target(self, container):
+        pass
+
+
+def install_stand_in_tools(bin_dir):
+    fake_dump = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_dump.py")
+    for tool in STAND_IN_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{fake_dump}" {tool} "$@"\n')
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+def create_backup(dump_dir, containers, env=None):
+    os.environ.update({"DUMP_UID": "-1", "DUMP_GID": "-1", **(env or {})})
+    config, global_labels = settings.read()
+    Backup.DUMP_DIR = dump_dir
+    backup = Backup(config, global_labels, FakeDocker(containers),
+                    Healthcheck(config), Metrics(config))
+    return backup, global_labels
+
+
+def generate_dump(path, args):
+    with open(path, "wb") as f:
+        write_dump(f, args.size, args.entropy, "0")
+
+
+def summarize(durations, size=None):
+    result = {
+        "seconds": [round(x, 4) for x in durations],
+        "median_seconds": round(statistics.median(durations), 4),
+    }
+    if size is not None:
+        result["bytes"] = size
+        result["throughput"] = round(size / statistics.median(durations))
+    return result
+
+
+def bench_cycle(scenario, args, work_dir):
+    labels = CYCLE_SCENARIOS[scenario]
+    durations = []
+    dump_sizes = []
+    for i in range(args.repeat):
+        dump_dir = tempfile.mkdtemp(dir=work_dir)
+        containers = [FakeContainer(x, labels) for x in range(args.targets)]
+        backup, global_labels = create_backup(
+            dump_dir, containers, {"MAX_PARALLEL_BACKUPS": str(args.parallel)})
+
+        start = time.perf_counter()
+        backup.run()
+        durations.append(time.perf_counter() - start)
+
+        dump_sizes.append(sum(
+            os.path.getsize(os.path.join(root, x))
+            for root, _, files in os.walk(dump_dir) for x in files))
+        shutil.rmtree(dump_dir)
+
+    result = summarize(durations, args.size * args.targets)
+    result["dump_size"] = dump_sizes[-1]
+    result["labels"] = labels
+    return result
+
+
+def bench_compression(args, work_dir):
+    input_file = os.path.join(work_dir, "dump.sql")
+    output_file = os.path.join(work_dir, "dump.out")
+    generate_dump(input_file, args)
+
+    levels = {
+        CompressionAlgorithm.gzip: [1, 6, 9],
+        CompressionAlgorithm.zstd: [1, 3, 9],
+        CompressionAlgorithm.lz4: [1, 9],
+    }
+    results = {}
+    for algorithm, algorithm_levels in levels.items():
+        if shutil.which(algorithm.name) is None:
+            logging.warning(f"Skip {algorithm.name}, command not found")
+            continue
+        for level in algorithm_levels:
+            command = compression.get_compress_command(algorithm, level, 0)
+            durations = []
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                subprocess.run(
+                    f'{command} < "{input_file}" > "{output_file}"', shell=True, check=True)
+                durations.append(time.perf_counter() - start)
+            result = summarize(durations, args.size)
+            result["ratio"] = round(os.path.getsize(output_file) / args.size, 4)
+            results[f"{algorithm.name}-{level}"] = result
+
+    return results
+
+
+def bench_encryption(args, work_dir):
+    input_file = os.path.join(work_dir, "dump.sql")
+    output_file = os.path.join(work_dir, "dump.sql.aes")
+    generate_dump(input_file, args)
+
+    results = {}
+    durations = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        with open(input_file, "rb") as fin, open(output_file, "wb") as fout:
+            pyAesCrypt.encryptStream(fin, fout, ENCRYPTION_KEY, BUFFER_SIZE)
+        durations.append(time.perf_counter() - start)
+    results["encrypt"] = summarize(durations, args.size)
+
+    durations = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        with open(output_file, "rb") as fin:
+            pyAesCrypt.decryptStream(fin, io.BytesIO(), ENCRYPTION_KEY, BUFFER_SIZE)
+        durations.append(time.perf_counter() - start)
+    results["decrypt"] = summarize(durations, args.size)
+
+    return results
+
+
+def bench_retention(args, work_dir):
+    name = "bench0"
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    logger = TargetLogger(logging.getLogger(), {"position": "1/1"})
+    labels = {"retention_policy": "simple",
+              "retention_max_count": str(args.retention_files // 2)}
+
+    results = {}
+    for mode in ["glob", "catalog"]:
+        durations = []
+        rebuild_durations = []
+        for i in range(args.repeat):
+            dump_dir = tempfile.mkdtemp(dir=work_dir)
+            for j in range(args.retention_files):
+                timestamp = now - datetime.timedelta(hours=j)
+                open(os.path.join(
+                    dump_dir, f"{name}_{timestamp.strftime('%Y-%m-%d_%H-%M-%S')}.sql.gz"), "w").close()
+
+            start = time.perf_counter()
+            backup, global_labels = create_backup(
+                dump_dir, [], {"CATALOG_ENABLE": str(mode == "catalog").lower()})
+            rebuild_durations.append(time.perf_counter() - start)
+            database = Database(FakeContainer(0, labels), global_labels)
+
+            start = time.perf_counter()
+            kept, checked = backup._apply_retention(database, name, now, logger)
+            durations.append(time.perf_counter() - start)
+            assert checked == args.retention_files
+
+            shutil.rmtree(dump_dir)
+
+        results[mode] = summarize(durations)
+        results[mode]["files"] = args.retention_files
+        results[mode]["kept_files"] = kept
+        if mode == "catalog":
+            results["catalog_rebuild"] = summarize(rebuild_durations)
+
+    return results
+
+
+def run_stage(stage, args):
+    """Runs a single stage in this process and returns its result."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        install_stand_in_tools(work_dir)
+        os.environ.update({
+            "BENCH_DUMP_SIZE": str(args.size),
+            "BENCH_DUMP_ENTROPY": str(args.entropy),
+        })
+
+        if stage.startswith("cycle:"):
+            result = bench_cycle(stage.partition(":")[2], args, work_dir)
+        elif stage == "compression":
+            result = bench_compression(args, work_dir)
+        elif stage == "encryption":
+            result = bench_encryption(args, work_dir)
+        elif stage == "retention":
+            result = bench_retention(args, work_dir)
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+
+    # ru_maxrss is given in kilobytes on Linux. The dump tools are not
+    # included, forked children inherit the peak RSS of this process.
+    return {
+        "result": result,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="Write results to this file instead of stdout")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"Comma-separated list of stages. Default: {','.join(STAGES)}")
+    parser.add_argument("--size", type=int, default=32,
+                        help="Size of each synthetic dump in MiB. Default: 32")
+    parser.add_argument("--entropy", type=float, default=0.5,
+                        help="Share of random data in the synthetic dump (0.0 - 1.0). Default: 0.5")
+    parser.add_argument("--targets", type=int, default=2,
+                        help="Count of database containers per cycle. Default: 2")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Maximum count of parallel backups (MAX_PARALLEL_BACKUPS). Default: 1")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Repetitions of each measurement. Default: 3")
+    parser.add_argument("--retention-files", type=int, default=5000,
+                        help="Count of existing dumps for the retention benchmark. Default: 5000")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.size *= 1024 * 1024
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+
+    if args.stage is not None:
+        # Child process of a single stage
+        json.dump(run_stage(args.stage, args), sys.stdout)
+        return
+
+    results = {}
+    for stage in args.stages.split(","):
+        print(f"Running {stage}..", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--stage", stage],
+            check=True, stdout=subprocess.PIPE,
+        ).stdout
+        results[stage] = json.loads(output)
+
+    report = {
+        "version": RESULT_VERSION,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            "size": args.size,
+            "entropy": args.entropy,
+            "targets": args.targets,
+            "parallel": args.parallel,
+            "repeat": args.repeat,
+            "retention_files": args.retention_files,
+        },
+        "stages": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
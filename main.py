@@ -2,10 +2,11 @@ import logging
 import sys
 
 from src.healthcheck import Healthcheck
-from src.schedule import Schedule
+from src.scheduler import Scheduler
 from src.docker import Docker
 from src.backup import Backup
 from src.metrics import Metrics
+from src.verify import Verifier
 from src import settings
 
 # Read config and setup logging
@@ -20,22 +21,16 @@ docker = Docker(config)
 metrics = Metrics(config)
 healthcheck = Healthcheck(config)
 backup = Backup(config, global_labels, docker, healthcheck, metrics)
+verifier = Verifier(Backup.DUMP_DIR, metrics,
+                    config.verify_jobs) if config.verify_schedule else None
 
 # Initializing Scheduler
-schedule = Schedule(config)
-logging.info(f"Schedule: {schedule.get_humanized_schedule()}")
+scheduler = Scheduler(config, global_labels, backup, metrics, verifier)
+logging.info(f"Schedule: {scheduler.get_humanized_schedule()}")
 
-while True:
-    # Scheduling next run
-    next_run = schedule.get_next()
-    if next_run is not None:
-        logging.info(
-            f"Scheduled next run at {next_run.strftime('%Y-%m-%d %H:%M:%S')}.."
-        )
-
-        schedule.wait_until(next_run)
-    else:
-        logging.info("Exiting backup service")
-        sys.exit()
-
-    backup.run()
+scheduler.run()
+backup.close()
+# Deliver the pings of the last backup cycle
+healthcheck.close()
+logging.info("Exiting backup service")
+sys.exit()
@@ -0,0 +1,25 @@
+import os
+import sys
+
+from src.dedup import DedupRepository
+
+
+def reassemble_file(manifest_file, output_file, password=None):
+    try:
+        repository = DedupRepository(os.path.dirname(os.path.abspath(manifest_file)))
+        with open(output_file, "wb") as output:
+            repository.restore(manifest_file, output, password)
+        print(f"Reassembly successful: {output_file}")
+    except Exception as e:
+        print(f"Reassembly failed: {e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python reassemble.py <manifest_file> <output_file> [password]")
+        sys.exit(1)
+    manifest_file = sys.argv[1]
+    output_file = sys.argv[2]
+    password = sys.argv[3] if len(sys.argv) == 4 else None
+
+    reassemble_file(manifest_file, output_file, password)
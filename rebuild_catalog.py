@@ -0,0 +1,21 @@
+import sys
+
+from src.backup import Backup
+from src.catalog import Catalog
+
+
+def rebuild_catalog(dump_dir):
+    try:
+        count = Catalog(dump_dir, auto_rebuild=False).rebuild()
+        print(f"Rebuild successful: {count} dump(s) found in {dump_dir}")
+    except Exception as e:
+        print(f"Rebuild failed: {e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: python rebuild_catalog.py [dump_dir]")
+        sys.exit(1)
+    dump_dir = sys.argv[1] if len(sys.argv) == 2 else Backup.DUMP_DIR
+
+    rebuild_catalog(dump_dir)
@@ -0,0 +1,83 @@
+import argparse
+import datetime
+import logging
+import sys
+
+import docker
+
+from src import settings
+from src.database import Database
+from src.pipeline import PipelineError
+from src.restore import BaseBackupRestore, Restore, RestoreError, is_base_backup
+
+
+def restore(artifact, container_name, database_name=None, table=None, jobs=4, encryption_key=None,
+            until=None, log_dir=None, target_dir=None):
+    try:
+        _, global_labels = settings.read()
+        if target_dir is not None or is_base_backup(artifact):
+            if target_dir is None:
+                raise RestoreError(
+                    "Base backups are restored into a directory (--target-dir)")
+            # Postgres is started on the restored directory, so no container
+            # is needed
+            BaseBackupRestore(encryption_key or global_labels["encryption_key"]).run(
+                artifact, target_dir, until, log_dir)
+            print(f"Restore successful: {artifact}. Start Postgres on {target_dir} to replay the WAL.")
+            return True
+
+        if container_name is None:
+            raise RestoreError("No container given")
+        client = docker.from_env()
+        container = client.containers.get(container_name)
+        database = Database(container, global_labels)
+        Restore(client, container, database, jobs, encryption_key).run(
+            artifact, database_name, table, until, log_dir)
+        print(f"Restore successful: {artifact}")
+        return True
+    except PipelineError as e:
+        print(f"Restore failed: {e}. Return Code: {e.returncode}; Error Output:\n{e.stderr}")
+        return False
+    except Exception as e:
+        print(f"Restore failed: {e}")
+        return False
+
+
+def parse_time(value):
+    """Parses an ISO 8601 time. Times without time zone are UTC."""
+    time = datetime.datetime.fromisoformat(value)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Streams a dump into a database container.")
+    parser.add_argument(
+        "artifact", help="Dump file, deduplication manifest, dump directory or base backup")
+    parser.add_argument(
+        "container", nargs="?", help="Name or ID of the database container (not needed with --target-dir)")
+    parser.add_argument(
+        "--database", help="Only restore this database")
+    parser.add_argument(
+        "--table", help="Only restore this table of the database (schema.table for postgres)")
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="Databases restored in parallel. Default: 4")
+    parser.add_argument(
+        "--encryption-key", help="Key of encrypted dumps. Default: encryption_key label of the container")
+    parser.add_argument(
+        "--until", type=parse_time,
+        help="Replay the logs of a continuous backup up to this time (ISO 8601, default time zone: UTC)")
+    parser.add_argument(
+        "--log-dir", help="Directory of the streamed logs. Default: <name>.binlog or <name>.wal next to the dump")
+    parser.add_argument(
+        "--target-dir", help="Extract a Postgres base backup into this empty data directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    successful = restore(args.artifact, args.container, args.database,
+                         args.table, args.jobs, args.encryption_key,
+                         args.until, args.log_dir, args.target_dir)
+    sys.exit(0 if successful else 1)
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+
+from src.compression import LEVELS
+
+# Weight of the newest measurement in the moving averages
+EWMA_WEIGHT = 0.3
+# Levels, that were not measured yet, are estimated from the nearest measured
+# level. Each level is assumed to be this much slower and smaller.
+LEVEL_RATE_FACTOR = 0.75
+LEVEL_RATIO_FACTOR = 0.97
+# Levels must reduce the size by at least this share to be worth their time
+MIN_SAVED_RATIO = 0.001
+# Share of the budget, that is planned. The rest absorbs variations.
+BUDGET_HEADROOM = 0.9
+# Limits of the correction of the planned cycle duration
+MIN_CORRECTION = 0.5
+MAX_CORRECTION = 4
+
+
+class CompressionPlanner:
+    """Chooses the compression levels of targets with an adaptive
+    compression level, so that the backup cycle fits into a time budget
+    while the dumps are as small as possible.
+
+    The planner keeps a history of each target: the raw dump size, the time
+    spent outside of compression and the compression rate and ratio of each
+    used level, as moving averages. Starting from the fastest levels, the
+    level of the target with the most saved bytes per additional second is
+    raised, as long as the estimated cycle duration fits into the budget.
+    Levels next to the measured ones are estimated, so that a target moves
+    by one level per cycle into unknown territory. The ratio of the actual
+    and the estimated cycle duration corrects the estimates (e.g. for
+    parallel backups slowing each other down)."""
+
+    def __init__(self, history_file):
+        self._history_file = history_file
+        self._lock = threading.Lock()
+        self._history = self._load()
+        self._estimate = None
+
+    def plan(self, targets, budget, parallelism):
+        """Returns the compression levels of the adaptive targets. targets is
+        a list of (dump name, Database). Without budget (timedelta or None),
+        or history of a target, the configured level is used."""
+        with self._lock:
+            targets_history = self._history.setdefault("targets", {})
+            levels = {}
+            candidates = []
+            seconds = 0
+            complete = True
+
+            for name, database in targets:
+                adaptive = database.compress and database.compression_adaptive
+                if adaptive:
+                    levels[name] = database.compression_level
+                entry = targets_history.get(name)
+                if entry is None:
+                    complete = False
+                    continue
+                options = self._get_options(
+                    entry, database.compression_algorithm) if adaptive else []
+                if len(options) == 0:
+                    seconds += entry["duration"]
+                else:
+                    candidates.append((name, options))
+                    seconds += options[0][1]
+
+            self._estimate = None
+            if budget is None or len(candidates) == 0:
+                return levels
+
+            correction = self._history.get("correction", 1)
+            capacity = budget.total_seconds() * parallelism * BUDGET_HEADROOM / correction
+            choices = {name: 0 for name, _ in candidates}
+            while True:
+                best = None
+                for name, options in candidates:
+                    index = choices[name]
+                    if index + 1 >= len(options):
+                        continue
+                    _, current_seconds, current_size = options[index]
+                    _, next_seconds, next_size = options[index + 1]
+                    extra_seconds = next_seconds - current_seconds
+                    saved_size = current_size - next_size
+                    if saved_size <= current_size * MIN_SAVED_RATIO or seconds + extra_seconds > capacity:
+                        continue
+                    value = saved_size / max(extra_seconds, 0.001)
+                    if best is None or value > best[0]:
+                        best = (value, name, extra_seconds)
+                if best is None:
+                    break
+                choices[best[1]] += 1
+                seconds += best[2]
+
+            for name, options in candidates:
+                level, target_seconds, _ = options[choices[name]]
+                levels[name] = level
+                logging.debug(
+                    f"Adaptive compression: {name} level {level} (estimated {target_seconds:.1f}s)")
+            if complete:
+                # Only estimates of all targets can be compared to the cycle
+                self._estimate = seconds * correction / parallelism
+            return levels
+
+    def record(self, name, algorithm, level, raw_size, compressed_size, duration, compress_seconds):
+        """Adds the measurements of a successful backup of a target. level
+        is None for uncompressed dumps. compress_seconds is the time of the
+        phase, that compressed the dump."""
+        with self._lock:
+            entry = self._history.setdefault("targets", {}).setdefault(name, {"levels": {}})
+            entry["duration"] = _ewma(entry.get("duration"), duration)
+            if level is None or raw_size == 0 or compress_seconds <= 0:
+                return
+
+            entry["raw_size"] = _ewma(entry.get("raw_size"), raw_size)
+            entry["other_seconds"] = _ewma(
+                entry.get("other_seconds"), max(duration - compress_seconds, 0))
+            sample = entry["levels"].setdefault(f"{algorithm.name}:{level}", {})
+            sample["rate"] = _ewma(sample.get("rate"), raw_size / compress_seconds)
+            sample["ratio"] = _ewma(sample.get("ratio"), compressed_size / raw_size)
+
+    def record_cycle(self, duration):
+        """Adds the actual duration of the planned cycle."""
+        with self._lock:
+            if self._estimate is None or self._estimate <= 0:
+                return
+            correction = self._history.get("correction", 1)
+            factor = min(max(
+                duration * correction / self._estimate, MIN_CORRECTION), MAX_CORRECTION)
+            self._history["correction"] = _ewma(correction, factor)
+            self._estimate = None
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._history)
+        try:
+            part_file = f"{self._history_file}.part"
+            with open(part_file, "w") as f:
+                f.write(data)
+            os.replace(part_file, self._history_file)
+        except OSError as e:
+            logging.warning(f"Cannot write compression history: {e}")
+
+    def _load(self):
+        if not os.path.exists(self._history_file):
+            return {}
+        try:
+            with open(self._history_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot read compression history. Starting without history: {e}")
+            return {}
+
+    def _get_options(self, entry, algorithm):
+        """Returns the estimated (level, seconds, size) of the levels around
+        the measured levels of the algorithm, fastest level first."""
+        measured = {}
+        for key, sample in entry["levels"].items():
+            name, _, level = key.partition(":")
+            if name == algorithm.name:
+                measured[int(level)] = sample
+        if len(measured) == 0 or "raw_size" not in entry:
+            return []
+
+        min_level, max_level = LEVELS[algorithm]
+        options = []
+        for level in range(max(min(measured) - 1, min_level), min(max(measured) + 1, max_level) + 1):
+            nearest = min(measured, key=lambda x: (abs(x - level), x))
+            rate = measured[nearest]["rate"] * LEVEL_RATE_FACTOR ** (level - nearest)
+            ratio = measured[nearest]["ratio"] * LEVEL_RATIO_FACTOR ** (level - nearest)
+            options.append((
+                level,
+                entry["other_seconds"] + entry["raw_size"] / rate,
+                entry["raw_size"] * ratio,
+            ))
+        return options
+
+
+def _ewma(average, value):
+    if average is None:
+        return value
+    return average + EWMA_WEIGHT * (value - average)
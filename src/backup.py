@@ -1,8 +1,14 @@
 import logging
 
-from src.database import Database, DatabaseType
-from src import settings
+from src.database import Database, DatabaseType, DumpLayout, DumpMode, IoniceClass
+from src.pipeline import BUFFER_SIZE, Cancelled, CountingWriter, DumpPipeline, PipelineError, RateLimiter, filter_file, run_command
+from src.adaptive import CompressionPlanner
+from src.catalog import Catalog
+from src.engine import BackupEngine
+from src.remote import RemoteError, RemoteStorage
+from src import settings, checksum, chunked, compression, continuous, dedup
 import subprocess
+import functools
 import os
 import glob
 import datetime
@@ -10,11 +16,55 @@ import pyAesCrypt
 import humanize
 import re
 import math
+import resource
+import concurrent.futures
+import copy
+import shlex
+import shutil
+import threading
+import time
+import urllib.parse
+
+
+class TargetLogger(logging.LoggerAdapter):
+    """Prefixes log messages with the position of the processed target, so
+    interleaved output of parallel backups can be told apart."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['position']}] {msg}", kwargs
+
+
+class PhaseTimer:
+    """Measures the time spent in consecutive phases of a backup."""
+
+    def __init__(self):
+        self.durations = {}
+        self._phase = None
+        self._start = None
+
+    def start(self, phase):
+        self.stop()
+        self._phase = phase
+        self._start = time.monotonic()
+
+    def stop(self):
+        if self._phase is not None:
+            self.durations[self._phase] = self.durations.get(
+                self._phase, 0) + time.monotonic() - self._start
+            self._phase = None
 
 
 class Backup:
     DUMP_DIR = "/dump"
+    TARGET_LABEL = f"{settings.LABEL_PREFIX}enable=true"
     DUMP_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9_.-]*$")
+    FINGERPRINT_DIR = ".fingerprints"
+    COMPRESSION_HISTORY_FILE = ".compression_history.json"
+    GLOBALS_NAME = "_globals"
+    # Host of the database, when the dump client runs inside of the target
+    EXEC_TARGET_HOST = "localhost"
+    IGNORED_MYSQL_DATABASES = ["mysql", "information_schema", "performance_schema", "sys"]
+    AGE_REGEX = re.compile(r"^.+_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\..+(?<!\.part)$")
 
     def __init__(self, config, global_labels, docker, healthcheck, metrics):
         self._config = config
@@ -22,301 +72,140 @@ class Backup:
         self._healthcheck = healthcheck
         self._docker = docker
         self._metrics = metrics
+        self._catalog = Catalog(
+            self.DUMP_DIR) if config.catalog_enable else None
+        self._registry = docker.watch_targets(
+            self.TARGET_LABEL, global_labels) if config.docker_events_enable else None
+        self._engine = BackupEngine(
+            config.max_parallel_backups, config.cycle_timeout, config.postprocess_jobs)
+        self._remote = RemoteStorage(
+            config, self.DUMP_DIR) if config.s3_bucket else None
+        self._compression_planner = CompressionPlanner(
+            f"{self.DUMP_DIR}/{self.COMPRESSION_HISTORY_FILE}")
+        # Compression levels of adaptive targets in the current cycle. The
+        # history is only kept, while adaptive targets exist.
+        self._compression_levels = None
+        self._archiver = continuous.LogArchiver(
+            config, docker, metrics, self.DUMP_DIR, self._get_client_command)
 
-    def run(self):
-        # Start healthcheck integrations
-        self._healthcheck.start("Starting backup cycle.")
-        cycle_start = datetime.datetime.now(datetime.timezone.utc)
-
-        # Find available database containers
-        containers = self._docker.get_targets(
-            f"{settings.LABEL_PREFIX}enable=true")
+    def get_targets(self):
+        """Returns all database containers, that should be backed up."""
+        if self._registry is not None:
+            containers = self._registry.get_targets()
+        else:
+            containers = self._docker.get_targets(self.TARGET_LABEL)
 
         # Process only container with the name in the whitelist
         if self._config.whitelist is not None:
             container_whitelist = [x.strip() for x in self._config.whitelist.split(',') if x]
             if len(container_whitelist) > 0:
-                logging.info(f"Container whitelist is active! Only these names are processed: {container_whitelist}")
+                logging.debug(f"Container whitelist is active! Only these names are processed: {container_whitelist}")
                 # Removes all containers from the list, which are not included in the filter
                 containers = [x for x in containers if x.name in container_whitelist]
 
         # Process all container, but not with the name in the blacklist
-        if self._config.blacklist is not None:   
+        if self._config.blacklist is not None:
             container_blacklist = [x.strip() for x in self._config.blacklist.split(',') if x]
             if len(container_blacklist) > 0:
-                logging.info(f"Container blacklist is active! The following names will be not processed: {container_blacklist}")
+                logging.debug(f"Container blacklist is active! The following names will be not processed: {container_blacklist}")
                 # Removes all containers from the list, which are not included in the filter
                 containers = [x for x in containers if x.name not in container_blacklist]
 
-        container_count = len(containers)
-        successful_count = 0
-        self._metrics.init_metrics()
-
-        if container_count:
-            logging.info(
-                f"Starting backup cycle with {len(containers)} container(s)..")
-
-            self._docker.create_backup_network()
-
-            for i, container in enumerate(containers):
-                start = datetime.datetime.now(datetime.timezone.utc)
-                database = Database(container, self._global_labels)
-                dump_name_part = (
-                    database.dump_name if len(
-                        database.dump_name) > 0 else container.name
-                )
-                dump_timestamp_part = (
-                    start.strftime("_%Y-%m-%d_%H-%M-%S")
-                    if database.dump_timestamp
-                    else ""
-                )
-                dump_file = f"{self.DUMP_DIR}/{dump_name_part}{dump_timestamp_part}.sql"
-                failed = False
-                metric_labels = {
-                    "name": dump_name_part,
-                    "type": database.type.name
-                }
-
-                container_started_at = datetime.datetime.fromisoformat(
-                    container.attrs['State']['StartedAt'].partition('.')[0] + '.000000+00:00')
-                container_uptime = start - container_started_at
-
-                logging.info(
-                    "[{}/{}] Processing container {} {} ({})".format(
-                        i + 1,
-                        container_count,
-                        container.short_id,
-                        container.name,
-                        database.type.name,
-                    )
-                )
-
-                if not self.DUMP_NAME_PATTERN.match(dump_name_part):
-                    logging.error(
-                        f"> FAILED: Invalid dump name. Name must match '{self.DUMP_NAME_PATTERN.pattern}'."
-                    )
-                    failed = True
-
-                if not failed and database.type == DatabaseType.unknown:
-                    logging.error(
-                        "> FAILED: Cannot resolve database type. Please specify via label."
-                    )
-                    failed = True
+        return containers
 
-                if not failed:
-                    logging.debug(
-                        "> Login {}@host:{} using Password: {}".format(
-                            database.username,
-                            database.port,
-                            "YES" if len(database.password) > 0 else "NO",
-                        )
-                    )
+    def get_targets_version(self):
+        """Returns a number, that changes with the targets, or None if changes
+        are not tracked (without docker events)."""
+        if self._registry is not None:
+            return self._registry.get_version()
+        return None
 
-                    # Create dump
-                    self._docker.connect_target(container)
-                    target_host = self._docker.get_target_name()
-
-                    try:
-                        env = os.environ.copy()
-
-                        if (
-                            database.type == DatabaseType.mysql
-                            or database.type == DatabaseType.mariadb
-                        ):
-                            subprocess.run(
-                                (
-                                    f"mysqldump"
-                                    f' --host="{target_host}"'
-                                    f' --user="{database.username}"'
-                                    f' --password="{database.password}"'
-                                    f" --all-databases"
-                                    f" --ignore-database=mysql"
-                                    f" --ignore-database=information_schema"
-                                    f" --ignore-database=performance_schema"
-                                    f' {"--skip-ssl" if database.skip_ssl else ""}'
-                                    f' > "{dump_file}"'
-                                ),
-                                shell=True,
-                                text=True,
-                                capture_output=True,
-                                env=env,
-                            ).check_returncode()
-                        elif database.type == DatabaseType.postgres:
-                            env["PGPASSWORD"] = database.password
-                            subprocess.run(
-                                (
-                                    f"pg_dumpall"
-                                    f' --host="{target_host}"'
-                                    f' --username="{database.username}"'
-                                    f' > "{dump_file}"'
-                                ),
-                                shell=True,
-                                text=True,
-                                capture_output=True,
-                                env=env,
-                            ).check_returncode()
-                    except subprocess.CalledProcessError as e:
-                        error_text = f"\n{e.stderr.strip()}".replace(
-                            "\n", "\n> "
-                        ).strip()
-                        logging.error(
-                            f"> FAILED. Error while crating dump. Return Code: {e.returncode}; Error Output:"
-                        )
-                        logging.error(f"{error_text}")
-                        failed = True
+    def get_database(self, container):
+        if self._registry is not None:
+            return self._registry.get_database(container)
+        return Database(container, self._global_labels)
 
-                    self._docker.disconnect_target(container)
+    def update_streams(self, containers):
+        """Starts and stops the log streaming of continuous targets, so that
+        it matches the given targets."""
+        targets = []
+        for container in containers:
+            database = self.get_database(container)
+            dump_name_part = self._get_dump_name(database, container)
+            if database.continuous and self.DUMP_NAME_PATTERN.match(dump_name_part):
+                targets.append((container, database, dump_name_part))
+        self._archiver.update(targets)
 
-                if not failed and (not os.path.exists(dump_file)):
-                    logging.error(
-                        "> FAILED: Dump cannot be created due to an unknown error!"
-                    )
-                    failed = True
-
-                if not failed:
-                    dump_size = os.path.getsize(dump_file)
-                    processed_dump_size = dump_size
-                    if dump_size == 0:
-                        logging.error("> FAILED: Dump file is empty!")
-                        failed = True
+    def close(self):
+        """Stops the log streaming of continuous targets."""
+        self._archiver.close()
 
-                # Compress pump
-                if not failed and database.compress:
-                    logging.debug(
-                        f"> Compressing dump (level: {database.compression_level})"
-                    )
-                    compressed_dump_file = f"{dump_file}.gz"
-
-                    try:
-                        if os.path.exists(compressed_dump_file):
-                            os.remove(compressed_dump_file)
+    def run(self, containers=None):
+        """Runs a backup cycle for the given containers, or for all targets if
+        none are given."""
+        # Start healthcheck integrations
+        self._healthcheck.start("Starting backup cycle.")
+        cycle_start = datetime.datetime.now(datetime.timezone.utc)
 
-                        subprocess.check_output(
-                            f'gzip -{database.compression_level} "{dump_file}"',
-                            shell=True,
-                        )
-                    except Exception as e:
-                        logging.error(
-                            f"> FAILED: Error while compressing: {e}")
-                        failed = True
+        # Find available database containers
+        partial = containers is not None
+        if not partial:
+            containers = self.get_targets()
 
-                    processed_dump_size = os.path.getsize(compressed_dump_file)
-                    dump_file = compressed_dump_file
+        container_count = len(containers)
+        successful_count = 0
+        skipped_count = 0
+        # Keep the metrics of targets, that are not part of this cycle
+        self._metrics.init_metrics(partial)
 
-                # Encrypt dump
-                if not failed and database.encrypt and dump_size > 0:
-                    logging.debug("> Encrypting dump")
-                    encrypted_dump_file = f"{dump_file}.aes"
+        if container_count:
+            logging.info(
+                f"Starting backup cycle with {len(containers)} container(s) "
+                f"(max. {self._config.max_parallel_backups} in parallel"
+                + (f", {self._config.postprocess_jobs} post-processing" if self._config.postprocess_jobs else "")
+                + ")..")
 
-                    if not database.encryption_key:
-                        logging.error(
-                            "> FAILED: No encryption key specified!")
-                        failed = True
-                    else:
-                        try:
-                            if os.path.exists(encrypted_dump_file):
-                                os.remove(encrypted_dump_file)
+            databases = [self.get_database(x) for x in containers]
+            # Targets in the exec dump mode need no backup network
+            use_network = any(x.dump_mode == DumpMode.network for x in databases)
+            if use_network:
+                self._docker.create_backup_network()
+                self._docker.reconcile_targets(
+                    self.get_targets() if partial else containers)
 
-                            pyAesCrypt.encryptFile(
-                                dump_file, encrypted_dump_file, database.encryption_key
-                            )
-                            os.remove(dump_file)
-                        except Exception as e:
-                            logging.error(
-                                f"> FAILED: Error while encrypting: {e}")
-                            failed = True
-
-                        processed_dump_size = os.path.getsize(
-                            encrypted_dump_file)
-                        dump_file = encrypted_dump_file
-
-                if not failed:
-                    # Change Owner of dump
-                    os.chown(
-                        dump_file, self._config.dump_uid, self._config.dump_gid
-                    )  # pylint: disable=maybe-no-member
-                    # todo catch errors when chowning file
+            self._compression_levels = None
+            if any(x.compress and x.compression_adaptive for x in databases):
+                self._compression_levels = self._compression_planner.plan(
+                    [(self._get_dump_name(database, container), database)
+                     for container, database in zip(containers, databases)],
+                    self._config.cycle_time_budget,
+                    self._config.max_parallel_backups,
+                )
 
-                if not failed:
-                    successful_count += 1
-                    logging.info(
-                        "> SUCCESS. Size: {}{}".format(
-                            humanize.naturalsize(dump_size),
-                            " ("
-                            + humanize.naturalsize(processed_dump_size)
-                            + " compressed/encrypted)"
-                            if database.compress or database.encrypt
-                            else "",
-                        )
-                    )
-                elif container_uptime < database.grace_time:
+            results = self._engine.run([
+                (
+                    functools.partial(self._backup_container,
+                                      i, container_count, container),
+                    database.timeout,
+                )
+                for i, (container, database) in enumerate(zip(containers, databases))
+            ])
+            for result in results:
+                if result is None:
+                    # Job failed with an unexpected error
+                    continue
+                successful, _, skipped = result
+                if successful:
                     successful_count += 1
-                    logging.info("> Ignore failure because of grace time")
-
-                # Cleanup
-                if database.dump_timestamp:
-                    glob_expression = f"{self.DUMP_DIR}/{dump_name_part}_*.*"
-                    files = sorted(glob.glob(glob_expression), reverse=True)
-                    kept_files = 0
-                    if len(files) > 0:
-
-                        for i in range(len(files)):
-                            # Calculate Age
-                            basename = os.path.basename(files[i])
-                            age_regex = re.compile(
-                                r"^.+_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\..+$")
-                            timestamp_str = age_regex.match(basename).group(1)
-                            timestamp = datetime.datetime.strptime(
-                                timestamp_str, '%Y-%m-%d_%H-%M-%S').replace(tzinfo=datetime.timezone.utc)
-                            delta = start - timestamp
-
-                            # Check if dump file should be deleted
-                            delete = False
-                            if i <= database.retention_min_count - 1:
-                                logging.debug(f"{files[i]} KEEP (min_count)")
-                            elif delta <= database.retention_min_age:
-                                logging.debug(f"{files[i]} KEEP (min_age)")
-                            elif database.retention_max_count > 0 and i > database.retention_max_count - 1:
-                                logging.debug(f"{files[i]} DELETE (max_count)")
-                                delete = True
-                            elif database.retention_max_age.total_seconds() > 0 and delta > database.retention_max_age:
-                                logging.debug(f"{files[i]} DELETE (max_aget)")
-                                delete = True
-                            else:
-                                logging.debug(f"{files[i]} KEEP (default)")
-
-                            if delete:
-                                os.remove(files[i])
-                            else:
-                                kept_files += 1
-                else:
-                    # Dummy files to get useful metrics
-                    files = [None]
-                    kept_files = 1
-
-                    logging.info(
-                        f"> Retention ({database.retention_policy}). Kept {kept_files}/{len(files)} files")
-
-                end = datetime.datetime.now(datetime.timezone.utc)
-                duration = end - start
-
-                # Add database specific metrics
-                if "dump_size" in locals():
-                    self._metrics.add_multi_value(
-                        'backup_dump_raw_size', metric_labels, dump_size)
-                if "processed_dump_size" in locals():
-                    self._metrics.add_multi_value(
-                        'backup_dump_size', metric_labels, processed_dump_size)
-                self._metrics.add_multi_value(
-                    'backup_status', metric_labels, int(not failed))
-                self._metrics.add_multi_value(
-                    'backup_duration', metric_labels, math.ceil(duration.total_seconds() * 1000))
-                self._metrics.add_multi_value(
-                    'backup_retention_kept_files', metric_labels, kept_files)
-                self._metrics.add_multi_value(
-                    'backup_retention_checked_files', metric_labels, len(files))
+                if skipped:
+                    skipped_count += 1
 
-            self._docker.remove_backup_network()
+            if use_network:
+                self._docker.remove_backup_network()
+
+            # Remove chunks, which are no longer referenced after retention
+            if any(result is not None and result[1] for result in results):
+                self._collect_dedup_garbage(cycle_start)
 
         # Summarize backup cycle
         full_success = successful_count == container_count
@@ -327,6 +216,8 @@ class Backup:
             self._healthcheck.success(message)
         else:
             message = f"Finished backup cycle. {successful_count}/{container_count} successful."
+            if skipped_count:
+                message += f" {skipped_count} skipped, because unchanged."
             logging.info(message)
             if full_success:
                 self._healthcheck.success(message)
@@ -335,11 +226,1244 @@ class Backup:
 
         cycle_end = datetime.datetime.now(datetime.timezone.utc)
         cycle_duration = cycle_end - cycle_start
+        if self._compression_levels is not None:
+            self._compression_planner.record_cycle(
+                cycle_duration.total_seconds())
+            self._compression_planner.save()
 
         # Set general metrics
         self._metrics.set_single_value('targets', container_count)
         self._metrics.set_single_value(
             'successful_targets', successful_count)
+        self._metrics.set_single_value('skipped_targets', skipped_count)
         self._metrics.set_single_value(
             'cycle_duration', math.ceil(cycle_duration.total_seconds() * 1000))
+        # Kilobytes on Linux
+        self._metrics.set_single_value(
+            'service_max_rss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        self._metrics.increment('cycles_total')
         self._metrics.flush_metrics()
+
+    def _backup_container(self, index, container_count, container, scope):
+        """Creates the dump of a single target and applies its retention policy.
+        Child processes are tracked by scope, which kills them once the
+        deadline has passed. Runs as a generator, which yields after the dump,
+        so that compression, encryption and retention can run in the
+        post-processing pool (see BackupEngine). Returns, if the backup counts
+        as successful, if the deduplication repository was used and if it
+        was skipped."""
+        log = TargetLogger(logging.getLogger(), {
+                           "position": f"{index + 1}/{container_count}"})
+
+        start = datetime.datetime.now(datetime.timezone.utc)
+        database = self.get_database(container)
+        dump_name_part = self._get_dump_name(database, container)
+        if database.compress and database.compression_adaptive and dump_name_part in (self._compression_levels or {}):
+            # The database may be shared with other cycles
+            database = copy.copy(database)
+            database.compression_level = self._compression_levels[dump_name_part]
+        dump_timestamp_part = (
+            start.strftime("_%Y-%m-%d_%H-%M-%S")
+            if database.dump_timestamp
+            else ""
+        )
+        # Continuous backups of Postgres are physical base backups
+        dump_extension = "tar" if database.continuous and database.type == DatabaseType.postgres else "sql"
+        dump_file = f"{self.DUMP_DIR}/{dump_name_part}{dump_timestamp_part}.{dump_extension}"
+        failed = False
+        skipped = False
+        successful = False
+        fingerprint = None
+        dump_checksum = None
+        dump_size = None
+        processed_dump_size = None
+        dedup_stats = {}
+        database_sizes = {}
+        # Compression and encryption happen while dumping
+        streamed = database.dedup or database.stream or database.dump_layout != DumpLayout.single
+        # Uploads of the dump to the object storage, which are fed by the
+        # phase, that writes the final dump file
+        uploads = []
+        upload_phase = None
+        if self._remote is not None and not database.dedup:
+            if streamed or not (database.compress or database.encrypt):
+                upload_phase = "dump"
+            elif database.encrypt:
+                upload_phase = "encrypt"
+            else:
+                upload_phase = "compress"
+        timer = PhaseTimer()
+        phase_sizes = {}
+        # The limiters also stop in-process work of cancelled backups
+        read_limiter = RateLimiter(database.read_rate_limit, scope)
+        write_limiter = RateLimiter(database.write_rate_limit, scope)
+        metric_labels = {
+            "name": dump_name_part,
+            "type": database.type.name
+        }
+
+        container_started_at = datetime.datetime.fromisoformat(
+            container.attrs['State']['StartedAt'].partition('.')[0] + '.000000+00:00')
+        container_uptime = start - container_started_at
+
+        log.info(
+            "Processing container {} {} ({})".format(
+                container.short_id,
+                container.name,
+                database.type.name,
+            )
+        )
+        if database.healthchecks_io_url:
+            self._healthcheck.start(
+                f"Starting backup of {container.name}.", database.healthchecks_io_url)
+
+        if not self.DUMP_NAME_PATTERN.match(dump_name_part):
+            log.error(
+                f"> FAILED: Invalid dump name. Name must match '{self.DUMP_NAME_PATTERN.pattern}'."
+            )
+            failed = True
+
+        if not failed and database.type == DatabaseType.unknown:
+            log.error(
+                "> FAILED: Cannot resolve database type. Please specify via label."
+            )
+            failed = True
+
+        if not failed and database.continuous:
+            try:
+                continuous.validate(database)
+            except ValueError as e:
+                log.error(f"> FAILED: {e}")
+                failed = True
+
+        if not failed and scope.cancelled:
+            log.error(f"> FAILED: {scope.reason}")
+            failed = True
+
+        if not failed and self._remote is not None and database.dedup:
+            log.warning(
+                "> Deduplicated dumps are not uploaded to the object storage")
+
+        if not failed:
+            log.debug(
+                "> Login {}@host:{} using Password: {}".format(
+                    database.username,
+                    database.port,
+                    "YES" if len(database.password) > 0 else "NO",
+                )
+            )
+
+            # Create dump
+            timer.start("connect")
+            if database.dump_mode == DumpMode.exec:
+                target_host = self.EXEC_TARGET_HOST
+            else:
+                self._docker.connect_target(container)
+                target_host = self._docker.get_target_name(container)
+            dump_command, env = self._get_dump_command(database, target_host)
+
+            # Skip dump, if nothing was written since the last backup
+            if database.skip_unchanged:
+                timer.start("detect_changes")
+                try:
+                    fingerprint = self._get_fingerprint(
+                        database, container, target_host, log, scope)
+                    if fingerprint is not None and self._is_unchanged(
+                            database, dump_name_part, fingerprint):
+                        skipped = True
+                except Cancelled as e:
+                    log.error(f"> FAILED: {e}")
+                    failed = True
+
+            timer.start("dump")
+            if skipped:
+                log.info(
+                    "> SKIPPED: Database has not changed since the last backup")
+            elif failed:
+                # Change detection was cancelled
+                pass
+            elif streamed:
+                try:
+                    if database.encrypt and not database.encryption_key:
+                        log.error(
+                            "> FAILED: No encryption key specified!")
+                        failed = True
+                    elif database.dump_layout != DumpLayout.single:
+                        if database.dedup:
+                            raise ValueError(
+                                f"Deduplication is not supported with the {database.dump_layout.name} dump layout")
+
+                        dump_dir = f"{self.DUMP_DIR}/{dump_name_part}{dump_timestamp_part}.d"
+                        if database.dump_layout == DumpLayout.chunked:
+                            log.debug(
+                                f"> Dumping tables in chunks (jobs: {database.dump_jobs}, rows: {database.dump_chunk_rows})")
+                            dump_directory = self._dump_chunked
+                        else:
+                            log.debug(
+                                f"> Dumping databases in parallel (jobs: {database.dump_jobs})")
+                            dump_directory = self._dump_per_database
+                        database_sizes = dump_directory(
+                            database, container, target_host, dump_dir, log,
+                            read_limiter, write_limiter, scope,
+                            uploads if upload_phase == "dump" else None)
+                        dump_file = dump_dir
+                        dump_checksum = checksum.hash_file(
+                            f"{dump_dir}/{checksum.SUMS_FILE}")
+                        dump_size = sum(x[0] for x in database_sizes.values())
+                        processed_dump_size = sum(
+                            x[1] for x in database_sizes.values())
+                    elif database.dedup:
+                        log.debug("> Storing dump in deduplication repository")
+                        manifest_file = f"{dump_file}.{dedup.MANIFEST_EXTENSION}"
+                        pipeline = self._create_pipeline(
+                            database, container, dump_command, env,
+                            read_limiter=read_limiter, scope=scope)
+                        repository = dedup.DedupRepository(self.DUMP_DIR)
+
+                        def store(stream):
+                            manifest, stats = repository.store(
+                                stream,
+                                min(database.compression_level, 9) if database.compress else None,
+                                database.encryption_key if database.encrypt else None,
+                                write_limiter,
+                            )
+                            dedup_stats.update(stats, manifest=manifest)
+                            return stats["stored_size"]
+
+                        pipeline.run_into(store)
+                        repository.write_manifest(
+                            manifest_file, dedup_stats["manifest"])
+                        dump_file = manifest_file
+                        dump_checksum = checksum.hash_file(manifest_file)
+                        dump_size = pipeline.raw_size
+                        processed_dump_size = pipeline.processed_size
+                        log.debug(
+                            f"> Stored {dedup_stats['new_chunks']}/{dedup_stats['chunks']} new chunks "
+                            f"({humanize.naturalsize(dedup_stats['written_size'])})")
+                    else:
+                        if database.compress:
+                            log.debug(
+                                f"> Streaming dump with compression ({database.compression_algorithm.name}, level: {database.compression_level})")
+                        if database.encrypt:
+                            log.debug("> Streaming dump with encryption")
+                        compress_command, suffix = self._get_stream_options(
+                            database)
+                        stream_dump_file = f"{dump_file}{suffix}"
+
+                        pipeline = self._create_pipeline(
+                            database,
+                            container,
+                            dump_command,
+                            env,
+                            compress_command,
+                            database.encryption_key if database.encrypt else None,
+                            read_limiter,
+                            write_limiter,
+                            scope,
+                        )
+                        pipeline.run(
+                            stream_dump_file,
+                            self._open_upload(stream_dump_file, uploads, scope)
+                            if upload_phase == "dump" else None,
+                        )
+                        dump_file = stream_dump_file
+                        dump_checksum = pipeline.checksum
+                        dump_size = pipeline.raw_size
+                        processed_dump_size = pipeline.processed_size
+                except Cancelled as e:
+                    log.error(f"> FAILED: {e}")
+                    failed = True
+                except PipelineError as e:
+                    error_text = f"\n{e.stderr}".replace(
+                        "\n", "\n> "
+                    ).strip()
+                    log.error(
+                        f"> FAILED. {e}. Return Code: {e.returncode}; Error Output:"
+                    )
+                    log.error(f"{error_text}")
+                    failed = True
+                except Exception as e:
+                    log.error(
+                        f"> FAILED: Error while streaming dump: {e}")
+                    failed = True
+            else:
+                try:
+                    pipeline = self._create_pipeline(
+                        database,
+                        container,
+                        dump_command,
+                        env,
+                        read_limiter=read_limiter,
+                        write_limiter=write_limiter,
+                        scope=scope,
+                    )
+                    pipeline.run(
+                        dump_file,
+                        self._open_upload(dump_file, uploads, scope)
+                        if upload_phase == "dump" else None,
+                    )
+                    dump_checksum = pipeline.checksum
+                except Cancelled as e:
+                    log.error(f"> FAILED: {e}")
+                    failed = True
+                except PipelineError as e:
+                    error_text = f"\n{e.stderr.strip()}".replace(
+                        "\n", "\n> "
+                    ).strip()
+                    log.error(
+                        f"> FAILED. Error while crating dump. Return Code: {e.returncode}; Error Output:"
+                    )
+                    log.error(f"{error_text}")
+                    failed = True
+                except Exception as e:
+                    log.error(
+                        f"> FAILED: Error while creating dump: {e}")
+                    failed = True
+
+            if database.dump_mode == DumpMode.network:
+                timer.start("disconnect")
+                self._docker.disconnect_target(container)
+            timer.stop()
+
+        if not failed and not skipped and (not os.path.exists(dump_file)):
+            log.error(
+                "> FAILED: Dump cannot be created due to an unknown error!"
+            )
+            failed = True
+
+        if not failed and not skipped:
+            if not streamed:
+                dump_size = os.path.getsize(dump_file)
+                processed_dump_size = dump_size
+            if dump_size == 0:
+                log.error("> FAILED: Dump file is empty!")
+                failed = True
+            phase_sizes["dump"] = dump_size
+
+        # The database is no longer needed. In pipelined mode, the engine
+        # continues with the next target, while this dump is post-processed.
+        yield
+
+        # Compress pump
+        if not failed and not skipped and database.compress and not streamed:
+            log.debug(
+                f"> Compressing dump ({database.compression_algorithm.name}, level: {database.compression_level})"
+            )
+            timer.start("compress")
+            phase_sizes["compress"] = processed_dump_size
+            compressed_dump_file = f"{dump_file}.{compression.get_extension(database.compression_algorithm)}"
+            compress_command = compression.get_compress_command(
+                database.compression_algorithm,
+                database.compression_level,
+                database.compression_threads,
+            )
+
+            try:
+                if os.path.exists(compressed_dump_file):
+                    os.remove(compressed_dump_file)
+
+                digest = checksum.new()
+                processed_dump_size = filter_file(
+                    f"{self._get_priority_prefix(database)}{compress_command}",
+                    dump_file,
+                    compressed_dump_file,
+                    write_limiter,
+                    scope,
+                    digest,
+                    self._open_upload(compressed_dump_file, uploads, scope)
+                    if upload_phase == "compress" else None,
+                )
+                os.remove(dump_file)
+                dump_file = compressed_dump_file
+                dump_checksum = digest.hexdigest()
+            except Exception as e:
+                log.error(
+                    f"> FAILED: Error while compressing: {e}")
+                failed = True
+            timer.stop()
+
+        # Encrypt dump
+        if not failed and not skipped and database.encrypt and not streamed and dump_size > 0:
+            log.debug("> Encrypting dump")
+            encrypted_dump_file = f"{dump_file}.aes"
+            timer.start("encrypt")
+            phase_sizes["encrypt"] = processed_dump_size
+
+            if not database.encryption_key:
+                log.error(
+                    "> FAILED: No encryption key specified!")
+                failed = True
+            else:
+                try:
+                    if os.path.exists(encrypted_dump_file):
+                        os.remove(encrypted_dump_file)
+
+                    digest = checksum.new()
+                    mirror = self._open_upload(
+                        encrypted_dump_file, uploads, scope) if upload_phase == "encrypt" else None
+                    with open(dump_file, "rb") as fin, open(encrypted_dump_file, "wb") as fout:
+                        pyAesCrypt.encryptStream(
+                            fin,
+                            CountingWriter(fout, write_limiter, digest, mirror),
+                            database.encryption_key,
+                            BUFFER_SIZE,
+                        )
+                    os.remove(dump_file)
+                    processed_dump_size = os.path.getsize(
+                        encrypted_dump_file)
+                    dump_file = encrypted_dump_file
+                    dump_checksum = digest.hexdigest()
+                except Exception as e:
+                    log.error(
+                        f"> FAILED: Error while encrypting: {e}")
+                    failed = True
+                    if os.path.exists(encrypted_dump_file):
+                        os.remove(encrypted_dump_file)
+            timer.stop()
+
+        if not failed and not skipped:
+            # Store checksum next to the dump. Dump directories contain the
+            # checksums of their files.
+            if not os.path.isdir(dump_file):
+                checksum.write_sidecar(dump_file, dump_checksum)
+
+            # Change Owner of dump
+            timer.start("chown")
+            os.chown(
+                dump_file, self._config.dump_uid, self._config.dump_gid
+            )  # pylint: disable=maybe-no-member
+            if os.path.isdir(dump_file):
+                for entry in os.scandir(dump_file):
+                    os.chown(
+                        entry.path, self._config.dump_uid, self._config.dump_gid
+                    )  # pylint: disable=maybe-no-member
+            else:
+                os.chown(
+                    checksum.get_sidecar_file(dump_file), self._config.dump_uid, self._config.dump_gid
+                )  # pylint: disable=maybe-no-member
+            # todo catch errors when chowning file
+            timer.stop()
+
+            if self._catalog is not None:
+                self._catalog.add(
+                    dump_file,
+                    dump_name_part,
+                    start.replace(microsecond=0) if database.dump_timestamp else None,
+                    dump_size,
+                    processed_dump_size,
+                    dump_checksum,
+                )
+
+            # The local dump is kept, even if the upload fails
+            if uploads:
+                timer.start("upload")
+                try:
+                    self._complete_uploads(dump_file, uploads)
+                except RemoteError as e:
+                    log.error(f"> FAILED: {e}")
+                    failed = True
+                timer.stop()
+
+        if failed:
+            for upload in uploads:
+                upload.abort()
+
+        if not failed and not skipped and self._compression_levels is not None:
+            compressed = database.compress and not database.dedup
+            self._compression_planner.record(
+                dump_name_part,
+                database.compression_algorithm,
+                database.compression_level if compressed else None,
+                dump_size,
+                processed_dump_size,
+                (datetime.datetime.now(datetime.timezone.utc) - start).total_seconds(),
+                timer.durations.get("dump" if streamed else "compress", 0),
+            )
+
+        if skipped:
+            successful = True
+        elif not failed:
+            successful = True
+            if fingerprint is not None:
+                self._write_fingerprint(dump_name_part, fingerprint)
+            log.info(
+                "> SUCCESS. Size: {}{}".format(
+                    humanize.naturalsize(dump_size),
+                    " ("
+                    + humanize.naturalsize(processed_dump_size)
+                    + " compressed/encrypted)"
+                    if database.compress or database.encrypt
+                    else "",
+                )
+            )
+        elif container_uptime < database.grace_time:
+            successful = True
+            log.info("> Ignore failure because of grace time")
+
+        # Cleanup
+        timer.start("retention")
+        kept_files, checked_files = self._apply_retention(
+            database, dump_name_part, start, log, not failed and not skipped)
+        timer.stop()
+
+        end = datetime.datetime.now(datetime.timezone.utc)
+        duration = end - start
+        usage = scope.usage
+        if usage.processes > 0:
+            log.debug(
+                f"> Resources of {usage.processes} processes: CPU {usage.user_seconds:.1f}s user, "
+                f"{usage.system_seconds:.1f}s system, max. RSS {humanize.naturalsize(usage.max_rss)}")
+
+        # Add database specific metrics
+        if dump_size is not None:
+            self._metrics.add_multi_value(
+                'backup_dump_raw_size', metric_labels, dump_size)
+        if processed_dump_size is not None:
+            self._metrics.add_multi_value(
+                'backup_dump_size', metric_labels, processed_dump_size)
+        if database.compress and not database.dedup:
+            self._metrics.add_multi_value(
+                'backup_compression_level', metric_labels, database.compression_level)
+        for database_name, (raw_size, processed_size) in database_sizes.items():
+            database_labels = {**metric_labels, "database": database_name}
+            self._metrics.add_multi_value(
+                'backup_database_dump_raw_size', database_labels, raw_size)
+            self._metrics.add_multi_value(
+                'backup_database_dump_size', database_labels, processed_size)
+        if "written_size" in dedup_stats:
+            self._metrics.add_multi_value(
+                'backup_dedup_written_size', metric_labels, dedup_stats["written_size"])
+        self._metrics.add_multi_value(
+            'backup_status', metric_labels, int(not failed))
+        self._metrics.add_multi_value(
+            'backup_skipped', metric_labels, int(skipped))
+        self._metrics.add_multi_value(
+            'backup_duration', metric_labels, math.ceil(duration.total_seconds() * 1000))
+        self._metrics.add_multi_value(
+            'backup_retention_kept_files', metric_labels, kept_files)
+        if usage.processes > 0:
+            self._metrics.add_multi_value(
+                'backup_cpu_user_time', metric_labels, math.ceil(usage.user_seconds * 1000))
+            self._metrics.add_multi_value(
+                'backup_cpu_system_time', metric_labels, math.ceil(usage.system_seconds * 1000))
+            self._metrics.add_multi_value(
+                'backup_max_rss', metric_labels, usage.max_rss)
+            self._metrics.add_multi_value(
+                'backup_io_read_bytes', metric_labels, usage.read_bytes)
+            self._metrics.add_multi_value(
+                'backup_io_write_bytes', metric_labels, usage.write_bytes)
+            self._metrics.increment(
+                'backup_cpu_seconds_total', {**metric_labels, "mode": "user"}, usage.user_seconds)
+            self._metrics.increment(
+                'backup_cpu_seconds_total', {**metric_labels, "mode": "system"}, usage.system_seconds)
+        self._metrics.add_multi_value(
+            'backup_retention_checked_files', metric_labels, checked_files)
+        dump_seconds = timer.durations.get("dump", 0)
+        write_seconds = dump_seconds + timer.durations.get("compress", 0) + \
+            timer.durations.get("encrypt", 0)
+        if read_limiter.bytes > 0 and dump_seconds > 0:
+            self._metrics.add_multi_value(
+                'backup_read_rate', metric_labels, round(read_limiter.bytes / dump_seconds))
+        if write_limiter.bytes > 0 and write_seconds > 0:
+            self._metrics.add_multi_value(
+                'backup_write_rate', metric_labels, round(write_limiter.bytes / write_seconds))
+        for phase, seconds in timer.durations.items():
+            phase_labels = {**metric_labels, "phase": phase}
+            self._metrics.add_multi_value(
+                'backup_phase_duration', phase_labels, math.ceil(seconds * 1000))
+            if phase_sizes.get(phase) and seconds > 0:
+                self._metrics.add_multi_value(
+                    'backup_phase_throughput', phase_labels, round(phase_sizes[phase] / seconds))
+        self._metrics.observe(
+            'backup_duration_seconds', metric_labels, duration.total_seconds())
+        if processed_dump_size is not None:
+            self._metrics.observe(
+                'backup_dump_size_bytes', metric_labels, processed_dump_size)
+        self._metrics.increment('backups_total', metric_labels)
+        if failed:
+            self._metrics.increment('backup_failures_total', metric_labels)
+            if scope.cancelled:
+                self._metrics.increment('backup_timeouts_total', metric_labels)
+        elif skipped:
+            self._metrics.increment('backup_skipped_total', metric_labels)
+        else:
+            self._metrics.increment(
+                'backup_raw_bytes_total', metric_labels, dump_size)
+            self._metrics.increment(
+                'backup_bytes_total', metric_labels, processed_dump_size)
+
+        if database.healthchecks_io_url:
+            if skipped:
+                message = f"Backup of {container.name} skipped, because unchanged."
+            elif not failed:
+                message = f"Backup of {container.name} successful. Size: {humanize.naturalsize(processed_dump_size)}"
+            elif successful:
+                message = f"Backup of {container.name} failed, but ignored because of grace time."
+            else:
+                message = f"Backup of {container.name} failed."
+            if successful:
+                self._healthcheck.success(message, database.healthchecks_io_url)
+            else:
+                self._healthcheck.fail(message, database.healthchecks_io_url)
+
+        return successful, database.dedup, skipped
+
+    def _apply_retention(self, database, dump_name_part, start, log, dumped=False):
+        """Deletes old dumps according to the retention policy. dumped tells,
+        if a new dump was created at start. Returns the count of kept and
+        checked dumps."""
+        self._remove_stale_parts(dump_name_part, start, log)
+
+        if not database.dump_timestamp:
+            # The new dump replaced the previous one
+            if dumped:
+                self._prune_logs(database, dump_name_part, start, log)
+            # Dummy files to get useful metrics
+            kept_files = 1
+            log.info(
+                f"> Retention ({database.retention_policy}). Kept {kept_files}/1 files")
+            return kept_files, 1
+
+        if self._catalog is not None:
+            # Dumps, that were written without timestamp, are not part of the
+            # retention (like without the catalog)
+            files = [(x.path, x.timestamp)
+                     for x in self._catalog.get_artifacts(dump_name_part)
+                     if x.timestamp is not None]
+        else:
+            glob_expression = f"{self.DUMP_DIR}/{dump_name_part}_*.*"
+            files = []
+            for file in sorted(self._glob_dumps(glob_expression), reverse=True):
+                # Calculate Age
+                basename = os.path.basename(file)
+                timestamp_str = self.AGE_REGEX.match(basename).group(1)
+                timestamp = datetime.datetime.strptime(
+                    timestamp_str, '%Y-%m-%d_%H-%M-%S').replace(tzinfo=datetime.timezone.utc)
+                files.append((file, timestamp))
+
+        kept_files, deleted_files = self._select_expired(
+            database, files, start, log)
+
+        for file in deleted_files:
+            try:
+                self._remove_dump(file)
+            except FileNotFoundError:
+                log.warning(f"{file} was already deleted")
+        if self._catalog is not None:
+            self._catalog.remove(deleted_files)
+
+        kept_timestamps = [x[1] for x in files if x[0] not in deleted_files]
+        if len(kept_timestamps) > 0:
+            self._prune_logs(database, dump_name_part, min(kept_timestamps), log)
+
+        # Copies in the object storage are selected independently, as they
+        # can differ from the local dumps (e.g. after failed uploads)
+        if self._remote is not None:
+            try:
+                _, deleted_files = self._select_expired(
+                    database, self._remote.get_dumps(dump_name_part), start, log, "remote ")
+                for file in deleted_files:
+                    self._remote.remove_dump(file)
+            except RemoteError as e:
+                log.error(
+                    f"> Error while applying retention to the object storage: {e}")
+
+        return kept_files, len(files)
+
+    def _remove_stale_parts(self, dump_name_part, before, log):
+        """Deletes the partial dumps (*.part) of a target, that were left
+        behind by runs, which crashed or were killed before the start of
+        the current dump (before)."""
+        part_regex = re.compile(
+            rf"^{re.escape(dump_name_part)}(_\d{{4}}-\d{{2}}-\d{{2}}_\d{{2}}-\d{{2}}-\d{{2}})?\.[^_]+\.part$")
+        for file in glob.glob(f"{self.DUMP_DIR}/{glob.escape(dump_name_part)}*.part"):
+            if not part_regex.match(os.path.basename(file)):
+                # Belongs to another target with the same prefix
+                continue
+            try:
+                if os.path.getmtime(file) >= before.timestamp():
+                    # Still written
+                    continue
+                self._remove_dump(file)
+                log.info(f"> Deleted partial dump of a previous run: {file}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.error(f"> Error while deleting partial dump {file}: {e}")
+
+    def _prune_logs(self, database, dump_name_part, before, log):
+        """Deletes the streamed logs of a continuous target, that were
+        written before the start of its oldest dump (before). Logs are kept
+        from there on, so that each dump can be restored to any point in
+        time after it."""
+        log_dir = continuous.get_log_dir(
+            self.DUMP_DIR, dump_name_part, database.type)
+        if not database.continuous or not os.path.isdir(log_dir):
+            return
+        try:
+            deleted_logs = continuous.prune_logs(log_dir, before)
+            log.debug(
+                f"> Deleted {len(deleted_logs)} log files older than the oldest dump")
+        except OSError as e:
+            log.error(f"> Error while deleting old log files: {e}")
+
+    def _select_expired(self, database, files, start, log, log_prefix=""):
+        """Selects the dumps, that are deleted by the retention policy, from
+        (path, timestamp) pairs sorted newest first. Returns the count of kept
+        dumps and the paths of the expired ones."""
+        kept_files = 0
+        deleted_files = []
+        for i, (file, timestamp) in enumerate(files):
+            delta = start - timestamp
+
+            # Check if dump file should be deleted
+            delete = False
+            if i <= database.retention_min_count - 1:
+                log.debug(f"{log_prefix}{file} KEEP (min_count)")
+            elif delta <= database.retention_min_age:
+                log.debug(f"{log_prefix}{file} KEEP (min_age)")
+            elif database.retention_max_count > 0 and i > database.retention_max_count - 1:
+                log.debug(f"{log_prefix}{file} DELETE (max_count)")
+                delete = True
+            elif database.retention_max_age.total_seconds() > 0 and delta > database.retention_max_age:
+                log.debug(f"{log_prefix}{file} DELETE (max_aget)")
+                delete = True
+            else:
+                log.debug(f"{log_prefix}{file} KEEP (default)")
+
+            if delete:
+                deleted_files.append(file)
+            else:
+                kept_files += 1
+
+        return kept_files, deleted_files
+
+    def _collect_dedup_garbage(self, cycle_start):
+        repository = dedup.DedupRepository(self.DUMP_DIR)
+        # Chunks touched during this cycle are always kept
+        min_age = (datetime.datetime.now(datetime.timezone.utc) -
+                   cycle_start).total_seconds()
+        try:
+            removed_count, removed_size = repository.collect_garbage(min_age)
+            logging.info(
+                f"Deduplication: Removed {removed_count} unreferenced chunks ({humanize.naturalsize(removed_size)})")
+        except OSError as e:
+            logging.error(
+                f"Deduplication: Error while collecting garbage: {e}")
+
+    def _get_fingerprint(self, database, container, target_host, log, scope=None):
+        """Returns a value, that changes whenever data is written to the
+        database, or None if it cannot be determined."""
+        client, env = self._get_client_command(database, target_host)
+
+        if (
+            database.type == DatabaseType.mysql
+            or database.type == DatabaseType.mariadb
+        ):
+            # SHOW MASTER STATUS was replaced in MySQL 8.4
+            commands = [
+                f'{client} --execute="SHOW BINARY LOG STATUS"',
+                f'{client} --execute="SHOW MASTER STATUS"',
+            ]
+        elif database.type == DatabaseType.postgres:
+            commands = [
+                f'{client} --command="'
+                "SELECT CASE WHEN pg_is_in_recovery()"
+                " THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END,"
+                " (SELECT string_agg(datname || ':' || (tup_inserted + tup_updated + tup_deleted), ',' ORDER BY datname)"
+                ' FROM pg_stat_database WHERE datname IS NOT NULL)"'
+            ]
+
+        for command in commands:
+            result = self._run_client(
+                database, container, command, env, scope)
+            if result.returncode == 0:
+                state = result.stdout.strip()
+                if len(state) == 0:
+                    log.debug(
+                        "> Change detection not available (binary log disabled)")
+                    return None
+                # Changed settings must also result in a new dump
+                return "|".join([
+                    database.type.name,
+                    str(database.compress),
+                    database.compression_algorithm.name,
+                    str(database.encrypt),
+                    str(database.stream),
+                    str(database.dedup),
+                    database.dump_layout.name,
+                    str(database.continuous),
+                    state,
+                ])
+
+        log.debug(
+            f"> Change detection not available: {result.stderr.strip()}")
+        return None
+
+    def _get_dump_name(self, database, container):
+        return database.dump_name if len(database.dump_name) > 0 else container.name
+
+    def _get_fingerprint_file(self, dump_name_part):
+        return f"{self.DUMP_DIR}/{self.FINGERPRINT_DIR}/{dump_name_part}"
+
+    def _is_unchanged(self, database, dump_name_part, fingerprint):
+        fingerprint_file = self._get_fingerprint_file(dump_name_part)
+        if not os.path.exists(fingerprint_file):
+            return False
+        with open(fingerprint_file) as f:
+            if f.read() != fingerprint:
+                return False
+
+        # The last dump must still exist
+        if database.dump_timestamp:
+            return len(self._glob_dumps(f"{self.DUMP_DIR}/{dump_name_part}_*.*")) > 0
+        return (
+            len(self._glob_dumps(f"{self.DUMP_DIR}/{dump_name_part}.sql*")) > 0
+            or len(self._glob_dumps(f"{self.DUMP_DIR}/{dump_name_part}.tar*")) > 0
+            or os.path.isdir(f"{self.DUMP_DIR}/{dump_name_part}.d")
+        )
+
+    def _write_fingerprint(self, dump_name_part, fingerprint):
+        os.makedirs(f"{self.DUMP_DIR}/{self.FINGERPRINT_DIR}", exist_ok=True)
+        with open(self._get_fingerprint_file(dump_name_part), "w") as f:
+            f.write(fingerprint)
+
+    def _get_stream_options(self, database):
+        """Returns the compression command and the file suffix of a streamed
+        dump."""
+        compress_command = None
+        suffix = ""
+        if database.compress:
+            compress_command = compression.get_compress_command(
+                database.compression_algorithm,
+                database.compression_level,
+                database.compression_threads,
+            )
+            suffix += f".{compression.get_extension(database.compression_algorithm)}"
+        if database.encrypt:
+            suffix += ".aes"
+
+        return compress_command, suffix
+
+    def _dump_per_database(self, database, container, target_host, dump_dir, log,
+                           read_limiter=None, write_limiter=None, scope=None, uploads=None):
+        """Dumps each database of the target into its own file inside of
+        dump_dir. Returns the raw and processed size per database. If uploads
+        is given, each file is uploaded while it is written and its upload is
+        appended."""
+        database_names = self._list_databases(
+            database, container, target_host, scope)
+        compress_command, _ = self._get_stream_options(database)
+
+        commands = {}
+        globals_command = self._get_globals_command(database, target_host)
+        if globals_command is not None:
+            commands[self.GLOBALS_NAME] = globals_command
+        for database_name in database_names:
+            commands[database_name] = self._get_dump_command(
+                database, target_host, database_name)
+
+        def create_pipeline(command, env):
+            return lambda: self._create_pipeline(
+                database,
+                container,
+                command,
+                env,
+                compress_command,
+                database.encryption_key if database.encrypt else None,
+                read_limiter,
+                write_limiter,
+                scope,
+            )
+
+        jobs = {
+            urllib.parse.quote(name, safe=""): (name, create_pipeline(command, env))
+            for name, (command, env) in commands.items()
+        }
+        sizes = self._dump_files(database, dump_dir, jobs, log, scope, uploads)
+        return {name: sizes[file_name] for file_name, (name, _) in jobs.items()}
+
+    def _dump_chunked(self, database, container, target_host, dump_dir, log,
+                      read_limiter=None, write_limiter=None, scope=None, uploads=None):
+        """Dumps the tables of the target in chunks of about dump_chunk_rows
+        rows over dump_jobs connections, which share a consistent snapshot.
+        The schema and the triggers of each database are dumped by mysqldump.
+        The files are listed in a manifest, so that they can be restored in
+        parallel. Returns the raw and processed size per database."""
+        if database.type not in (DatabaseType.mysql, DatabaseType.mariadb):
+            raise ValueError(
+                "The chunked dump layout is only supported by MySQL and MariaDB")
+        if database.dump_mode != DumpMode.network:
+            raise ValueError(
+                "The chunked dump layout is only supported in the network dump mode")
+
+        compress_command, _ = self._get_stream_options(database)
+        encryption_key = database.encryption_key if database.encrypt else None
+        snapshot = chunked.Snapshot(
+            functools.partial(
+                chunked.connect, target_host, database.port, database.username, database.password),
+            database.dump_jobs,
+        )
+        try:
+            if scope is not None:
+                scope.add(snapshot)
+            database_names = snapshot.get_databases(
+                self.IGNORED_MYSQL_DATABASES)
+            tables = snapshot.get_tables(database_names)
+
+            def create_pipeline(command, env):
+                return lambda: self._create_pipeline(
+                    database, container, command, env, compress_command, encryption_key,
+                    read_limiter, write_limiter, scope)
+
+            def create_chunk_pipeline(chunk):
+                return lambda: self._create_pipeline(
+                    database, container, chunk.get_query(), None, compress_command, encryption_key,
+                    read_limiter, write_limiter, scope,
+                    lambda command, env: chunked.ChunkProcess(snapshot, chunk))
+
+            # Schemas and triggers are dumped like in the per_database layout
+            jobs = {}
+            file_databases = {}
+            for database_name in database_names:
+                command, env = self._get_dump_command(
+                    database, target_host, database_name)
+                file_name = chunked.quote_name(database_name)
+                jobs[f"{file_name}.schema"] = (f"{database_name} schema", create_pipeline(
+                    f"{command} --no-data --skip-triggers --routines --events", env))
+                jobs[f"{file_name}.triggers"] = (f"{database_name} triggers", create_pipeline(
+                    f"{command} --no-data --no-create-info --no-create-db --skip-routines --triggers", env))
+                file_databases[f"{file_name}.schema"] = database_name
+                file_databases[f"{file_name}.triggers"] = database_name
+            chunk_files = {}
+            for table in tables:
+                chunks = snapshot.get_chunks(table, database.dump_chunk_rows)
+                log.debug(
+                    f"> Dumping {table.database}.{table.name} in {len(chunks)} chunks")
+                for chunk in chunks:
+                    jobs[chunk.name] = (
+                        f"{table.database}.{table.name} ({chunk.number}/{len(chunks)})",
+                        create_chunk_pipeline(chunk))
+                    file_databases[chunk.name] = table.database
+                    chunk_files.setdefault(
+                        (table.database, table.name), []).append(chunk.name)
+
+            _, suffix = self._get_stream_options(database)
+
+            def write_manifest(part_dir):
+                chunked.write_manifest(
+                    f"{part_dir}/{chunked.MANIFEST_FILE}",
+                    {
+                        x: tuple(f"{chunked.quote_name(x)}.{y}.sql{suffix}" for y in ["schema", "triggers"])
+                        for x in database_names
+                    },
+                    {
+                        key: [f"{x}.sql{suffix}" for x in files]
+                        for key, files in chunk_files.items()
+                    },
+                    snapshot.binlog_position,
+                )
+
+            sizes = self._dump_files(
+                database, dump_dir, jobs, log, scope, uploads, write_manifest)
+        finally:
+            if scope is not None:
+                scope.discard(snapshot)
+            snapshot.close()
+
+        database_sizes = {}
+        for file_name, database_name in file_databases.items():
+            raw_size, processed_size = database_sizes.get(database_name, (0, 0))
+            database_sizes[database_name] = (
+                raw_size + sizes[file_name][0], processed_size + sizes[file_name][1])
+        return database_sizes
+
+    def _dump_files(self, database, dump_dir, jobs, log, scope=None, uploads=None, finish=None):
+        """Writes the files of a dump directory in parallel. jobs maps the
+        file names (without extension) to a description and a function,
+        which returns the DumpPipeline of the file. finish is called with
+        the directory before the checksums are written (e.g. to add further
+        files). Returns the raw and processed size per file name."""
+        _, suffix = self._get_stream_options(database)
+        part_dir = f"{dump_dir}.part"
+        checksums = {}
+
+        def dump(file_name, name, create_pipeline):
+            pipeline = create_pipeline()
+            mirror = None
+            if uploads is not None:
+                mirror = self._open_upload(
+                    f"{dump_dir}/{file_name}.sql{suffix}", uploads, scope)
+            pipeline.run(f"{part_dir}/{file_name}.sql{suffix}", mirror)
+            log.debug(
+                f"> Dumped {name} ({humanize.naturalsize(pipeline.raw_size)})")
+            checksums[f"{file_name}.sql{suffix}"] = pipeline.checksum
+            return pipeline.raw_size, pipeline.processed_size
+
+        if os.path.exists(part_dir):
+            shutil.rmtree(part_dir)
+        os.makedirs(part_dir)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=database.dump_jobs,
+                thread_name_prefix=f"{threading.current_thread().name}_dump",
+            ) as executor:
+                futures = {
+                    file_name: executor.submit(dump, file_name, name, create_pipeline)
+                    for file_name, (name, create_pipeline) in jobs.items()
+                }
+                try:
+                    sizes = {file_name: future.result()
+                             for file_name, future in futures.items()}
+                except BaseException:
+                    # The remaining files would be removed anyway
+                    executor.shutdown(cancel_futures=True)
+                    raise
+            if finish is not None:
+                finish(part_dir)
+                for entry in os.scandir(part_dir):
+                    if entry.name not in checksums:
+                        checksums[entry.name] = checksum.hash_file(entry.path)
+            checksum.write_sums(part_dir, checksums)
+        except BaseException:
+            shutil.rmtree(part_dir)
+            raise
+
+        # Replace the previous dump, if no timestamp is used
+        if os.path.exists(dump_dir):
+            shutil.rmtree(dump_dir)
+        os.rename(part_dir, dump_dir)
+
+        return sizes
+
+    def _open_upload(self, path, uploads, scope):
+        """Starts the upload of the dump file path and appends it to
+        uploads."""
+        upload = self._remote.open_upload(path, scope)
+        uploads.append(upload)
+        return upload
+
+    def _complete_uploads(self, dump_file, uploads):
+        """Completes the uploads of a dump and copies its checksums. The
+        checksums are uploaded last, so that they mark complete copies."""
+        for upload in uploads:
+            upload.complete()
+
+        if os.path.isdir(dump_file):
+            keys = [x.key for x in uploads]
+            sums_file = f"{dump_file}/{checksum.SUMS_FILE}"
+            # Files, that were not streamed (e.g. a manifest)
+            for entry in sorted(os.scandir(dump_file), key=lambda x: x.name):
+                key = self._remote.get_key(entry.path)
+                if entry.path != sums_file and key not in keys:
+                    self._remote.upload_file(entry.path)
+                    keys.append(key)
+            self._remote.upload_file(sums_file)
+            # Files of databases, that were removed since the previous dump
+            self._remote.remove_dump(
+                dump_file, keep=keys + [self._remote.get_key(sums_file)])
+        else:
+            self._remote.upload_file(checksum.get_sidecar_file(dump_file))
+
+    def _list_databases(self, database, container, target_host, scope=None):
+        client, env = self._get_client_command(database, target_host)
+
+        if (
+            database.type == DatabaseType.mysql
+            or database.type == DatabaseType.mariadb
+        ):
+            command = f'{client} --execute="SHOW DATABASES"'
+        elif database.type == DatabaseType.postgres:
+            command = (
+                f'{client} --command="SELECT datname FROM pg_database'
+                f' WHERE datallowconn AND NOT datistemplate ORDER BY datname"'
+            )
+
+        try:
+            result = self._run_client(
+                database, container, command, env, scope)
+            result.check_returncode()
+        except subprocess.CalledProcessError as e:
+            raise PipelineError(
+                "Error while listing databases", e.returncode, e.stderr.strip())
+
+        database_names = [x for x in result.stdout.splitlines() if len(x) > 0]
+        if database.type != DatabaseType.postgres:
+            database_names = [
+                x for x in database_names if x not in self.IGNORED_MYSQL_DATABASES]
+
+        return database_names
+
+    def _create_pipeline(self, database, container, command, env, compress_command=None, encryption_key=None,
+                         read_limiter=None, write_limiter=None, scope=None, launcher=None):
+        """Returns a DumpPipeline, that runs the dump command locally or inside
+        of the target container, depending on the dump mode. A custom
+        launcher (e.g. for chunks) is called with the unchanged command."""
+        priority_prefix = self._get_priority_prefix(database)
+        if launcher is None:
+            command = f"{priority_prefix}{command}"
+            launcher = self._get_launcher(database, container)
+        if compress_command is not None:
+            compress_command = f"{priority_prefix}{compress_command}"
+
+        return DumpPipeline(command, env, compress_command, encryption_key,
+                            launcher, read_limiter, write_limiter, scope)
+
+    def _get_priority_prefix(self, database):
+        """Returns the command prefix, that sets the CPU and I/O priority of
+        dump and compression commands."""
+        prefix = ""
+        if database.nice != 0:
+            prefix += f"nice -n {database.nice} "
+        if database.ionice_class != IoniceClass.none:
+            prefix += f"ionice -c {database.ionice_class.value} "
+            if database.ionice_class != IoniceClass.idle:
+                prefix += f"-n {database.ionice_level} "
+        return prefix
+
+    def _run_client(self, database, container, command, env, scope=None):
+        """Runs a client command locally or inside of the target container and
+        returns its result."""
+        return run_command(
+            command, env, self._get_launcher(database, container), scope)
+
+    def _get_launcher(self, database, container):
+        """Returns the function, that starts commands inside of the target
+        container, or None to start them locally."""
+        if database.dump_mode != DumpMode.exec:
+            return None
+
+        def launcher(command, env):
+            return self._docker.exec_process(
+                container, command, self._get_exec_environment(env))
+        return launcher
+
+    def _get_exec_environment(self, env):
+        # Only pass variables, that were added for the command. The environment
+        # of the backup service is not passed into the target container.
+        return {
+            key: value for key, value in env.items()
+            if os.environ.get(key) != value
+        }
+
+    def _get_client_command(self, database, target_host):
+        """Returns the shell command of the interactive database client and the
+        environment to run it with."""
+        env = os.environ.copy()
+
+        if (
+            database.type == DatabaseType.mysql
+            or database.type == DatabaseType.mariadb
+        ):
+            command = (
+                f"mysql"
+                f' --host="{target_host}"'
+                f' --user="{database.username}"'
+                f' --password="{database.password}"'
+                f" --batch --skip-column-names"
+                f' {"--skip-ssl" if database.skip_ssl else ""}'
+            )
+        elif database.type == DatabaseType.postgres:
+            env["PGPASSWORD"] = database.password
+            command = (
+                f"psql"
+                f' --host="{target_host}"'
+                f' --username="{database.username}"'
+                f" --dbname=postgres --no-align --tuples-only"
+            )
+
+        return command, env
+
+    def _get_globals_command(self, database, target_host):
+        """Returns the command to dump roles and other global objects, or
+        None if the database type has none outside of the system database."""
+        if database.type == DatabaseType.postgres:
+            env = os.environ.copy()
+            env["PGPASSWORD"] = database.password
+            command = (
+                f"pg_dumpall"
+                f' --host="{target_host}"'
+                f' --username="{database.username}"'
+                f" --globals-only"
+            )
+            return command, env
+
+        return None
+
+    def _get_dump_command(self, database, target_host, database_name=None):
+        """Returns the shell command, that writes a dump of all databases (or
+        only the given one) of the target to stdout, and the environment to
+        run it with."""
+        env = os.environ.copy()
+
+        if (
+            database.type == DatabaseType.mysql
+            or database.type == DatabaseType.mariadb
+        ):
+            if database_name is None:
+                selection = (
+                    f" --all-databases"
+                    f" --ignore-database=mysql"
+                    f" --ignore-database=information_schema"
+                    f" --ignore-database=performance_schema"
+                )
+            else:
+                selection = f" --databases {shlex.quote(database_name)}"
+
+            if database.continuous and database_name is None:
+                # Position in the binary log, from which it is replayed
+                selection += " --single-transaction --master-data=2"
+
+            command = (
+                f"mysqldump"
+                f' --host="{target_host}"'
+                f' --user="{database.username}"'
+                f' --password="{database.password}"'
+                f"{selection}"
+                f' {"--skip-ssl" if database.skip_ssl else ""}'
+            )
+        elif database.type == DatabaseType.postgres:
+            env["PGPASSWORD"] = database.password
+            if database.continuous and database_name is None:
+                # Physical copy, which the streamed WAL is replayed on
+                command = (
+                    f"pg_basebackup"
+                    f' --host="{target_host}"'
+                    f' --username="{database.username}"'
+                    f" --pgdata=- --format=tar --wal-method=fetch --checkpoint=fast"
+                )
+            elif database_name is None:
+                command = (
+                    f"pg_dumpall"
+                    f' --host="{target_host}"'
+                    f' --username="{database.username}"'
+                )
+            else:
+                command = (
+                    f"pg_dump"
+                    f' --host="{target_host}"'
+                    f' --username="{database.username}"'
+                    f" --create"
+                    f" --dbname={shlex.quote(database_name)}"
+                )
+
+        return command, env
+
+    def _glob_dumps(self, glob_expression):
+        """Returns the dumps matching the expression without checksum
+        sidecars and partial dumps, that are still written (or were left
+        behind by a crash)."""
+        return [
+            x for x in glob.glob(glob_expression)
+            if not checksum.is_sidecar(x) and not x.endswith(".part")
+        ]
+
+    def _remove_dump(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+            sidecar_file = checksum.get_sidecar_file(path)
+            if os.path.exists(sidecar_file):
+                os.remove(sidecar_file)
@@ -0,0 +1,195 @@
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from src import checksum, compression
+
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+TIMESTAMPED_NAME_REGEX = re.compile(
+    r"^(.+)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\..+$")
+PLAIN_NAME_REGEX = re.compile(r"^(.+?)\.(?:sql|tar|d)(?:\..+)?$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    timestamp TEXT,
+    raw_size INTEGER,
+    size INTEGER,
+    codec TEXT,
+    encrypted INTEGER NOT NULL DEFAULT 0,
+    checksum TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_name_timestamp ON artifacts (name, timestamp);
+"""
+
+_INSERT = (
+    "INSERT OR REPLACE INTO artifacts"
+    " (path, name, timestamp, raw_size, size, codec, encrypted, checksum, created_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+class Artifact:
+    def __init__(self, path, name, timestamp, raw_size, size, codec, encrypted, checksum):
+        self.path = path
+        self.name = name
+        self.timestamp = timestamp
+        self.raw_size = raw_size
+        self.size = size
+        self.codec = codec
+        self.encrypted = encrypted
+        self.checksum = checksum
+
+
+class Catalog:
+    """Persistent index of all dump artifacts inside the dump directory, so
+    retention does not need to scan the directory."""
+
+    FILE_NAME = ".catalog.sqlite"
+
+    def __init__(self, dump_dir, auto_rebuild=True):
+        self._dump_dir = dump_dir
+        self._path = os.path.join(dump_dir, self.FILE_NAME)
+        self._lock = threading.Lock()
+
+        created = not os.path.exists(self._path)
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+        if created and auto_rebuild:
+            count = self.rebuild()
+            logging.info(
+                f"Created catalog with {count} existing dump(s)")
+
+    def add(self, path, name, timestamp, raw_size, size, checksum=None):
+        """Records an artifact. An existing record with the same path is
+        replaced."""
+        with self._connect() as connection:
+            connection.execute(
+                _INSERT, _create_row(path, name, timestamp, raw_size, size, checksum))
+
+    def get_artifacts(self, name):
+        """Returns all artifacts of a dump name, newest first."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT path, name, timestamp, raw_size, size, codec, encrypted, checksum"
+                " FROM artifacts WHERE name = ? ORDER BY timestamp DESC, path DESC",
+                (name,),
+            ).fetchall()
+
+        return [
+            Artifact(
+                row[0], row[1], _parse_timestamp(row[2]), row[3], row[4],
+                row[5], bool(row[6]), row[7])
+            for row in rows
+        ]
+
+    def remove(self, paths):
+        """Removes the records of multiple artifacts in one transaction."""
+        if len(paths) == 0:
+            return
+        with self._connect() as connection:
+            connection.executemany(
+                "DELETE FROM artifacts WHERE path = ?", [(x,) for x in paths])
+
+    def rebuild(self):
+        """Replaces all records by the dumps found in the dump directory.
+        Returns the count of found dumps."""
+        artifacts = []
+        for entry in os.scandir(self._dump_dir):
+            if entry.name.startswith(".") or entry.name.endswith(".part") or checksum.is_sidecar(entry.name):
+                continue
+
+            match = TIMESTAMPED_NAME_REGEX.match(entry.name)
+            if match is not None:
+                name = match.group(1)
+                timestamp = datetime.datetime.strptime(
+                    match.group(2), TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc)
+            else:
+                match = PLAIN_NAME_REGEX.match(entry.name)
+                if match is None:
+                    continue
+                name = match.group(1)
+                timestamp = None
+
+            if entry.is_dir():
+                size = sum(x.stat().st_size for x in os.scandir(entry.path))
+                sums_file = os.path.join(entry.path, checksum.SUMS_FILE)
+                file_checksum = checksum.hash_file(
+                    sums_file) if os.path.exists(sums_file) else None
+            else:
+                size = entry.stat().st_size
+                file_checksum = checksum.read_sidecar(entry.path)
+            artifacts.append((entry.path, name, timestamp, size, file_checksum))
+
+        with self._connect() as connection:
+            connection.execute("DELETE FROM artifacts")
+            connection.executemany(_INSERT, [
+                _create_row(path, name, timestamp, None, size, file_checksum)
+                for path, name, timestamp, size, file_checksum in artifacts
+            ])
+
+        return len(artifacts)
+
+    def _connect(self):
+        return _LockedConnection(self._path, self._lock)
+
+
+class _LockedConnection:
+    """Context manager, that opens a connection and commits the transaction
+    on success. Access is serialized between threads."""
+
+    def __init__(self, path, lock):
+        self._path = path
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self._connection = sqlite3.connect(self._path, timeout=30)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._connection.commit()
+            else:
+                self._connection.rollback()
+            self._connection.close()
+        finally:
+            self._lock.release()
+
+
+def _create_row(path, name, timestamp, raw_size, size, checksum=None):
+    basename = os.path.basename(path)
+    codec = compression.detect_algorithm(basename)
+
+    return (
+        path,
+        name,
+        _format_timestamp(timestamp),
+        raw_size,
+        size,
+        codec.name if codec is not None else None,
+        int(basename.endswith(".aes")),
+        checksum,
+        _format_timestamp(datetime.datetime.now(datetime.timezone.utc)),
+    )
+
+
+def _format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if timestamp is not None else None
+
+
+def _parse_timestamp(value):
+    if value is None:
+        return None
+    return datetime.datetime.strptime(
+        value, TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc)
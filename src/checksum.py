@@ -0,0 +1,81 @@
+import hashlib
+import os
+
+READ_SIZE = 1024 * 1024
+EXTENSION = "sha256"
+# Checksums of the files inside of a dump directory (per_database layout)
+SUMS_FILE = "SHA256SUMS"
+
+
+def new():
+    return hashlib.sha256()
+
+
+def get_sidecar_file(path):
+    return f"{path}.{EXTENSION}"
+
+
+def is_sidecar(path):
+    return path.endswith(f".{EXTENSION}")
+
+
+def write_sidecar(path, checksum):
+    """Stores the checksum of a dump file next to it. Like the sums of dump
+    directories, it uses the format of sha256sum, so `sha256sum -c` can also
+    check it."""
+    _write_sums(get_sidecar_file(path), {os.path.basename(path): checksum})
+
+
+def read_sidecar(path):
+    """Returns the stored checksum of a dump file, or None if there is
+    none."""
+    sidecar_file = get_sidecar_file(path)
+    if not os.path.exists(sidecar_file):
+        return None
+    return _read_sums(sidecar_file).get(os.path.basename(path))
+
+
+def write_sums(directory, checksums):
+    """Stores the checksums of the files (name -> checksum) inside of a dump
+    directory. Returns the checksum of the written file, which stands for
+    the whole directory."""
+    sums_file = os.path.join(directory, SUMS_FILE)
+    _write_sums(sums_file, checksums)
+    return hash_file(sums_file)
+
+
+def read_sums(directory):
+    """Returns the stored checksums of the files inside of a dump directory,
+    or None if there are none."""
+    sums_file = os.path.join(directory, SUMS_FILE)
+    if not os.path.exists(sums_file):
+        return None
+    return _read_sums(sums_file)
+
+
+def hash_file(path):
+    """Returns the checksum of a file. hashlib releases the GIL, so multiple
+    files can be hashed in parallel by threads."""
+    digest = new()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _write_sums(path, checksums):
+    part_file = f"{path}.part"
+    with open(part_file, "w") as f:
+        for name, checksum in sorted(checksums.items()):
+            f.write(f"{checksum}  {name}\n")
+    os.replace(part_file, path)
+
+
+def _read_sums(path):
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            checksum, _, name = line.rstrip("\n").partition("  ")
+            if len(name) > 0:
+                checksums[name] = checksum
+    return checksums
@@ -0,0 +1,385 @@
+import contextlib
+import io
+import json
+import math
+import queue
+import socket
+import threading
+import urllib.parse
+
+import pymysql
+import pymysql.converters
+import pymysql.cursors
+from pymysql.constants import FIELD_TYPE
+
+from src.pipeline import PipelineError, ProducerThread
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+# Approximate maximum size of a single INSERT statement
+INSERT_SIZE = 1024 * 1024
+# Types of keys, that can be split into ranges
+KEY_TYPES = ["tinyint", "smallint", "mediumint", "int", "bigint"]
+# Values of these types are written without quotes
+NUMERIC_FIELD_TYPES = {
+    FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL, FIELD_TYPE.TINY, FIELD_TYPE.SHORT,
+    FIELD_TYPE.LONG, FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE, FIELD_TYPE.LONGLONG,
+    FIELD_TYPE.INT24, FIELD_TYPE.YEAR,
+}
+# Session settings of chunk files. Values are read as text in UTC, so they
+# are loaded the same way.
+CHUNK_HEADER = (
+    "SET NAMES utf8mb4;\n"
+    "SET TIME_ZONE='+00:00';\n"
+    "SET FOREIGN_KEY_CHECKS=0;\n"
+    "SET UNIQUE_CHECKS=0;\n"
+    "SET SQL_MODE='NO_AUTO_VALUE_ON_ZERO';\n"
+)
+
+
+class Table:
+    def __init__(self, database, name, rows, columns, key=None):
+        self.database = database
+        self.name = name
+        self.rows = rows
+        self.columns = columns
+        # Single integer column of the primary key, or None
+        self.key = key
+
+
+class Chunk:
+    """Range of rows of a table. start and end are None for open ranges."""
+
+    def __init__(self, table, number, start=None, end=None):
+        self.table = table
+        self.number = number
+        self.start = start
+        self.end = end
+
+    @property
+    def name(self):
+        """Name of the chunk file without extension."""
+        return f"{quote_name(self.table.database)}.{quote_name(self.table.name)}.{self.number:05d}"
+
+    def get_query(self):
+        table = self.table
+        columns = ", ".join(quote_identifier(x) for x in table.columns)
+        query = f"SELECT {columns} FROM {quote_identifier(table.database)}.{quote_identifier(table.name)}"
+        conditions = []
+        if self.start is not None:
+            conditions.append(f"{quote_identifier(table.key)} >= {self.start}")
+        if self.end is not None:
+            conditions.append(f"{quote_identifier(table.key)} < {self.end}")
+        if conditions:
+            query += f" WHERE {' AND '.join(conditions)}"
+        return query
+
+
+class Snapshot:
+    """Connections to a MySQL/MariaDB server, that share one consistent
+    snapshot, like mydumper uses them. The server is only locked (FLUSH
+    TABLES WITH READ LOCK) while the transactions of all connections are
+    started. Tables of non-transactional engines (e.g. MyISAM) are not
+    consistent."""
+
+    def __init__(self, connect, jobs):
+        """connect must return a new pymysql connection. One connection is
+        opened for each job."""
+        self._connections = queue.Queue()
+        self._all_connections = []
+        self.binlog_position = None
+
+        try:
+            lock_connection = self._open(connect)
+            lock_connection.query("FLUSH TABLES WITH READ LOCK")
+            self.binlog_position = self._get_binlog_position(lock_connection)
+            for _ in range(jobs):
+                connection = self._open(connect)
+                connection.query(
+                    "SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                connection.query("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                self._connections.put(connection)
+            lock_connection.query("UNLOCK TABLES")
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for connection in self._all_connections:
+            try:
+                connection.close()
+            except pymysql.Error:
+                # Connection was already lost
+                pass
+
+    def kill(self):
+        """Aborts running queries of all connections, e.g. when the backup is
+        cancelled. Can be called from any thread."""
+        for connection in self._all_connections:
+            _shutdown(connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrows a connection of the snapshot."""
+        connection = self._connections.get()
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+
+    def get_databases(self, ignored_databases):
+        with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT SCHEMA_NAME FROM information_schema.SCHEMATA ORDER BY SCHEMA_NAME")
+            return [x[0] for x in cursor.fetchall() if x[0] not in ignored_databases]
+
+    def get_tables(self, databases):
+        """Returns the tables of the given databases."""
+        if len(databases) == 0:
+            return []
+        placeholders = ", ".join(["%s"] * len(databases))
+
+        with self.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE, COLUMN_KEY, EXTRA"
+                " FROM information_schema.COLUMNS"
+                f" WHERE TABLE_SCHEMA IN ({placeholders})"
+                " ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION",
+                databases)
+            columns = {}
+            keys = {}
+            for database, table, column, data_type, column_key, extra in cursor.fetchall():
+                # Generated columns are calculated while loading
+                if "GENERATED" not in extra.upper():
+                    columns.setdefault((database, table), []).append(column)
+                if column_key == "PRI":
+                    keys.setdefault((database, table), []).append(
+                        (column, data_type.lower()))
+
+            cursor.execute(
+                "SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES"
+                f" WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA IN ({placeholders})"
+                " ORDER BY TABLE_SCHEMA, TABLE_NAME",
+                databases)
+            tables = []
+            for database, table, rows in cursor.fetchall():
+                key = keys.get((database, table), [])
+                tables.append(Table(
+                    database,
+                    table,
+                    int(rows or 0),
+                    columns.get((database, table), []),
+                    key[0][0] if len(key) == 1 and key[0][1] in KEY_TYPES else None,
+                ))
+            return tables
+
+    def get_chunks(self, table, chunk_rows):
+        """Splits a table into ranges of its key with about chunk_rows rows.
+        Tables without a suitable key are a single chunk."""
+        count = math.ceil(table.rows / chunk_rows) if chunk_rows > 0 else 1
+        if table.key is None or count <= 1:
+            return [Chunk(table, 1)]
+
+        with self.connection() as connection, connection.cursor() as cursor:
+            key = quote_identifier(table.key)
+            cursor.execute(
+                f"SELECT MIN({key}), MAX({key})"
+                f" FROM {quote_identifier(table.database)}.{quote_identifier(table.name)}")
+            minimum, maximum = cursor.fetchone()
+        if minimum is None:
+            return [Chunk(table, 1)]
+
+        minimum = int(minimum)
+        step = max(math.ceil((int(maximum) - minimum + 1) / count), 1)
+        chunks = []
+        for start in range(minimum, int(maximum) + 1, step):
+            chunks.append(Chunk(table, len(chunks) + 1, start, start + step))
+        # Open ranges at both ends
+        chunks[0].start = None
+        chunks[-1].end = None
+        return chunks
+
+    def _open(self, connect):
+        connection = connect()
+        self._all_connections.append(connection)
+        # Values are read as text (see CHUNK_HEADER). A slow consumer (e.g.
+        # rate limits) must not abort the transfer.
+        connection.query("SET SESSION TIME_ZONE='+00:00'")
+        connection.query("SET SESSION net_write_timeout=3600")
+        return connection
+
+    def _get_binlog_position(self, connection):
+        """Returns the binary log position of the snapshot, or None if binary
+        logging is disabled."""
+        # Renamed in MySQL 8.4, but still used by MariaDB
+        for query in ["SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"]:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(query)
+                    row = cursor.fetchone()
+            except (pymysql.err.ProgrammingError, pymysql.err.OperationalError):
+                # Unknown statement or missing REPLICATION CLIENT privilege
+                continue
+            if row is None:
+                return None
+            return {"file": row[0], "position": int(row[1])}
+        return None
+
+
+class ChunkProcess:
+    """Popen like wrapper, that writes the SQL of a chunk from a background
+    thread. This way, chunks run through a DumpPipeline with compression,
+    encryption, rate limits and checksums like the output of dump
+    commands. kill() aborts the query of the chunk without waiting, so it
+    can be tracked by a CancelScope."""
+
+    def __init__(self, snapshot, chunk):
+        self._snapshot = snapshot
+        self._chunk = chunk
+        self._lock = threading.Lock()
+        self._connection = None
+        self._killed = False
+        self._producer = ProducerThread(self._write)
+        self.stdout = self._producer.stdout
+        self.stderr = io.BytesIO()
+
+    def wait(self):
+        try:
+            self._producer.wait()
+        except pymysql.Error as e:
+            if self._killed:
+                return -9
+            raise PipelineError(
+                f"Error while dumping chunk {self._chunk.name}", 1, str(e)) from e
+        return -9 if self._killed else 0
+
+    def kill(self):
+        with self._lock:
+            self._killed = True
+            if self._connection is not None:
+                _shutdown(self._connection)
+
+    def _write(self, output):
+        with self._snapshot.connection() as connection:
+            with self._lock:
+                if self._killed:
+                    return
+                self._connection = connection
+            try:
+                write_chunk(connection, self._chunk, output)
+            except BaseException:
+                # The rest of the result would have to be read, before the
+                # connection can be used again. All chunks fail anyway.
+                _shutdown(connection)
+                raise
+            finally:
+                with self._lock:
+                    self._connection = None
+
+
+def connect(host, port, user, password):
+    """Opens a connection for a Snapshot. Values are not converted, so
+    that they are written as they were read."""
+    return pymysql.connect(
+        host=host,
+        port=port,
+        user=user,
+        password=password,
+        charset="utf8mb4",
+        # Only the encoders of query parameters
+        conv={k: v for k, v in pymysql.converters.conversions.items() if not isinstance(k, int)},
+    )
+
+
+def write_chunk(connection, chunk, output):
+    """Writes the rows of a chunk as INSERT statements to output."""
+    table = chunk.table
+    # Rows are streamed from the server instead of being buffered
+    cursor = connection.cursor(pymysql.cursors.SSCursor)
+    cursor.execute(chunk.get_query())
+    numeric = [x[1] in NUMERIC_FIELD_TYPES for x in cursor.description]
+    output.write(
+        f"{CHUNK_HEADER}USE {quote_identifier(table.database)};\n".encode())
+    insert = (
+        f"INSERT INTO {quote_identifier(table.name)}"
+        f" ({', '.join(quote_identifier(x) for x in table.columns)}) VALUES\n"
+    )
+
+    values = []
+    size = 0
+    for row in cursor.fetchall_unbuffered():
+        value = "(" + ",".join(
+            _format_value(x, numeric[i]) for i, x in enumerate(row)) + ")"
+        values.append(value)
+        size += len(value)
+        if size >= INSERT_SIZE:
+            output.write(f"{insert}{','.join(values)};\n".encode())
+            values = []
+            size = 0
+    if values:
+        output.write(f"{insert}{','.join(values)};\n".encode())
+    cursor.close()
+
+
+def write_manifest(path, databases, tables, binlog_position=None):
+    """Writes the manifest of a chunked dump. databases maps each database
+    to the files of its schema and triggers, tables maps (database, table)
+    to the files of its chunks. The manifest lists the files in the order,
+    in which they are loaded."""
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "binlog_position": binlog_position,
+        "databases": [
+            {
+                "name": name,
+                "schema": schema_file,
+                "triggers": triggers_file,
+                "tables": [
+                    {"name": table, "chunks": chunk_files}
+                    for (database, table), chunk_files in tables.items()
+                    if database == name
+                ],
+            }
+            for name, (schema_file, triggers_file) in databases.items()
+        ],
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version: {manifest.get('version')}")
+    return manifest
+
+
+def quote_identifier(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def quote_name(name):
+    """Returns a name, that can be used in file names. Dots separate the
+    parts of file names, so they are also quoted."""
+    return urllib.parse.quote(name, safe="").replace(".", "%2E")
+
+
+def _shutdown(connection):
+    # Closing the socket would not interrupt a blocking read of another thread
+    sock = getattr(connection, "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _format_value(value, numeric):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bytes):
+        return f"X'{value.hex()}'"
+    if numeric:
+        return value
+    return f"'{pymysql.converters.escape_string(value)}'"
@@ -0,0 +1,62 @@
+from enum import Enum
+
+
+class CompressionAlgorithm(Enum):
+    gzip = 1
+    zstd = 2
+    lz4 = 3
+
+
+EXTENSIONS = {
+    CompressionAlgorithm.gzip: "gz",
+    CompressionAlgorithm.zstd: "zst",
+    CompressionAlgorithm.lz4: "lz4",
+}
+
+LEVELS = {
+    CompressionAlgorithm.gzip: (1, 9),
+    CompressionAlgorithm.zstd: (1, 19),
+    CompressionAlgorithm.lz4: (1, 12),
+}
+
+
+def clamp_level(algorithm, level):
+    min_level, max_level = LEVELS[algorithm]
+    return min(max(level, min_level), max_level)
+
+
+def get_extension(algorithm):
+    return EXTENSIONS[algorithm]
+
+
+def get_compress_command(algorithm, level, threads=0):
+    """Returns a shell command, that compresses stdin to stdout."""
+    level = clamp_level(algorithm, level)
+
+    if algorithm == CompressionAlgorithm.gzip:
+        return f"gzip -{level} -c"
+    elif algorithm == CompressionAlgorithm.zstd:
+        # zstd uses all available cores for -T0
+        return f"zstd -{level} -T{threads} -q -c"
+    elif algorithm == CompressionAlgorithm.lz4:
+        return f"lz4 -{level} -q -c"
+
+
+def get_decompress_command(algorithm):
+    """Returns a shell command, that decompresses stdin to stdout."""
+    if algorithm == CompressionAlgorithm.gzip:
+        return "gzip -d -c"
+    elif algorithm == CompressionAlgorithm.zstd:
+        return "zstd -d -q -c"
+    elif algorithm == CompressionAlgorithm.lz4:
+        return "lz4 -d -q -c"
+
+
+def detect_algorithm(filename):
+    """Returns the compression algorithm of a dump file by its extension, or
+    None if the file is not compressed."""
+    name = filename[:-len(".aes")] if filename.endswith(".aes") else filename
+    for algorithm, extension in EXTENSIONS.items():
+        if name.endswith(f".{extension}"):
+            return algorithm
+    return None
@@ -0,0 +1,284 @@
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+import docker
+
+from src.database import DatabaseType, DumpLayout, DumpMode
+from src.pipeline import ChildProcess, StderrCollector, run_command
+
+WAL_DIR_SUFFIX = ".wal"
+BINLOG_DIR_SUFFIX = ".binlog"
+# Delay before a terminated streaming command is restarted. It is doubled
+# after each failure, until the command runs longer than the maximum delay.
+MIN_RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+# Files of pg_receivewal, that are not pruned
+HISTORY_SUFFIX = ".history"
+PARTIAL_SUFFIX = ".partial"
+WAL_SEGMENT_REGEX = re.compile(r"^[0-9A-F]{24}$")
+# First WAL segment of a base backup, from its backup_label
+BACKUP_LABEL_REGEX = re.compile(
+    rb"^START WAL LOCATION: .+ \(file (?P<segment>[0-9A-F]{24})\)$", re.MULTILINE)
+# Binary log position in the head of dumps of mysqldump --master-data=2
+BINLOG_POSITION_REGEX = re.compile(
+    rb"^-- CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='(?P<file>[^']+)',"
+    rb" (?:MASTER|SOURCE)_LOG_POS=(?P<position>\d+)")
+
+
+class LogStreamer:
+    """Runs the command, that streams the log of a target into its log
+    directory, in a background thread. The command is restarted with
+    backoff, whenever it terminates. get_command is called before each
+    start and returns the command and the environment to run it with."""
+
+    def __init__(self, name, key, get_command, metrics):
+        self.name = name
+        self.key = key
+        self._get_command = get_command
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._process = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            name=f"stream_{name}", target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            if self._process is not None:
+                self._process.kill()
+        self._thread.join()
+
+    def _run(self):
+        delay = MIN_RESTART_DELAY
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            try:
+                command, env = self._get_command()
+                with self._lock:
+                    if self._stopped.is_set():
+                        break
+                    self._process = ChildProcess(
+                        command,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE,
+                        env=env,
+                    )
+                stderr = StderrCollector(self._process.stderr)
+                returncode = self._process.wait()
+                stderr.join()
+                error = f"Return Code: {returncode}; Error Output: {stderr.text}"
+            except Exception as e:
+                error = str(e)
+            finally:
+                with self._lock:
+                    self._process = None
+
+            if self._stopped.is_set():
+                break
+            if time.monotonic() - start > MAX_RESTART_DELAY:
+                delay = MIN_RESTART_DELAY
+            logging.error(
+                f"Continuous backup: Log streaming of {self.name} stopped. {error}. Restarting in {delay}s..")
+            self._metrics.increment(
+                'continuous_restarts_total', {"name": self.name})
+            self._stopped.wait(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+
+class LogArchiver:
+    """Streams the write-ahead log (Postgres) or the binary log
+    (MySQL/MariaDB) of targets with the `continuous` label into the dump
+    directory. The streaming commands run permanently and are attached to
+    the targets through the persistent backup network. update() is called
+    regularly with the current targets to start and stop them."""
+
+    def __init__(self, config, docker, metrics, dump_dir, get_client_command):
+        self._config = config
+        self._docker = docker
+        self._metrics = metrics
+        self._dump_dir = dump_dir
+        self._get_client_command = get_client_command
+        self._streamers = {}
+        # Invalid configurations are only reported once
+        self._rejected = set()
+
+    def update(self, targets):
+        """Starts the streaming of new continuous targets and stops it for
+        removed or changed ones. targets is a list of (container, Database,
+        dump name)."""
+        wanted = {
+            container.id: (container, database, name)
+            for container, database, name in targets if database.continuous
+        }
+        if len(wanted) > 0 and not self._config.docker_network_keep_targets:
+            if None not in self._rejected:
+                logging.error(
+                    "Continuous backup requires DOCKER_NETWORK_PERSISTENT and DOCKER_NETWORK_KEEP_TARGETS")
+                self._rejected.add(None)
+            wanted = {}
+
+        for container_id, streamer in list(self._streamers.items()):
+            target = wanted.get(container_id)
+            if target is None or streamer.key != self._get_key(*target):
+                logging.info(
+                    f"Continuous backup: Stopping log streaming of {streamer.name}")
+                streamer.stop()
+                del self._streamers[container_id]
+
+        for container_id, (container, database, name) in wanted.items():
+            if container_id in self._streamers:
+                continue
+            key = self._get_key(container, database, name)
+            if key in self._rejected:
+                continue
+            try:
+                validate(database)
+            except ValueError as e:
+                logging.error(
+                    f"Continuous backup of {container.name} not possible: {e}")
+                self._rejected.add(key)
+                continue
+
+            try:
+                self._docker.create_backup_network()
+                self._docker.connect_target(container)
+            except docker.errors.DockerException as e:
+                logging.error(
+                    f"Continuous backup: Cannot connect {container.name}: {e}")
+                continue
+
+            log_dir = get_log_dir(self._dump_dir, name, database.type)
+            os.makedirs(log_dir, exist_ok=True)
+            target_host = self._docker.get_target_name(container)
+            logging.info(
+                f"Continuous backup: Starting log streaming of {name} into {log_dir}")
+            self._streamers[container_id] = LogStreamer(
+                name, key, lambda database=database, target_host=target_host, log_dir=log_dir:
+                self._get_stream_command(database, target_host, log_dir),
+                self._metrics)
+
+    def close(self):
+        for streamer in self._streamers.values():
+            streamer.stop()
+        self._streamers = {}
+
+    def _get_key(self, container, database, name):
+        # Changes of these settings restart the streaming
+        return (
+            container.id,
+            name,
+            database.type,
+            database.username,
+            database.password,
+            database.skip_ssl,
+            database.dump_mode,
+            database.dump_layout,
+            database.continuous_slot,
+        )
+
+    def _get_stream_command(self, database, target_host, log_dir):
+        env = os.environ.copy()
+
+        if database.type == DatabaseType.postgres:
+            env["PGPASSWORD"] = database.password
+            receive = (
+                f"pg_receivewal"
+                f' --host="{target_host}"'
+                f' --username="{database.username}"'
+                f" --no-password"
+            )
+            command = f'{receive} --directory="{log_dir}" --no-loop'
+            if database.continuous_slot:
+                # The slot keeps the server from removing WAL, that was not
+                # streamed yet
+                slot = f'--slot="{database.continuous_slot}"'
+                command = f"{receive} {slot} --create-slot --if-not-exists && {command} {slot}"
+        else:
+            # Resume with the last (possibly incomplete) file
+            files = list_log_files(log_dir)
+            start_file = files[-1] if len(files) > 0 else self._get_current_binlog(
+                database, target_host)
+            command = (
+                f"mysqlbinlog"
+                f' --host="{target_host}"'
+                f' --user="{database.username}"'
+                f' --password="{database.password}"'
+                f" --read-from-remote-server --raw --stop-never"
+                f' --result-file="{log_dir}/"'
+                f' {"--skip-ssl" if database.skip_ssl else ""}'
+                f' "{start_file}"'
+            )
+
+        return command, env
+
+    def _get_current_binlog(self, database, target_host):
+        client, env = self._get_client_command(database, target_host)
+        result = run_command(f'{client} --execute="SHOW BINARY LOGS"', env)
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"Cannot list binary logs: {result.stderr.strip()}")
+        lines = [x for x in result.stdout.splitlines() if len(x) > 0]
+        if len(lines) == 0:
+            raise RuntimeError("Binary log is disabled")
+        return lines[-1].split("\t")[0]
+
+
+def validate(database):
+    """Raises ValueError, if the continuous backup of the database is not
+    supported."""
+    if database.dump_mode != DumpMode.network:
+        raise ValueError(
+            "Continuous backups are only supported in the network dump mode")
+    if database.type == DatabaseType.postgres:
+        if database.dump_layout != DumpLayout.single:
+            raise ValueError(
+                "Continuous backups of Postgres require the single dump layout")
+    elif database.type in (DatabaseType.mysql, DatabaseType.mariadb):
+        if database.dump_layout == DumpLayout.per_database:
+            raise ValueError(
+                "Continuous backups of MySQL/MariaDB require the single or chunked dump layout")
+    else:
+        raise ValueError(
+            f"Continuous backups are not supported for {database.type.name}")
+
+
+def get_log_dir(dump_dir, name, type):
+    suffix = WAL_DIR_SUFFIX if type == DatabaseType.postgres else BINLOG_DIR_SUFFIX
+    return f"{dump_dir}/{name}{suffix}"
+
+
+def list_log_files(log_dir):
+    """Returns the names of the log files in the directory. Log files are
+    named in the order they were written."""
+    return sorted(
+        x.name for x in os.scandir(log_dir)
+        if x.is_file() and not x.name.startswith(".")
+    )
+
+
+def prune_logs(log_dir, before):
+    """Deletes the log files, that are not needed to replay the log from the
+    time before (datetime) on. The newest file, that was completed before
+    this time, may contain the start position and is kept, as well as the
+    file, that is currently written. Returns the names of the deleted
+    files."""
+    files = [
+        x for x in list_log_files(log_dir)
+        if not x.endswith((HISTORY_SUFFIX, PARTIAL_SUFFIX))
+    ][:-1]
+    expired = [
+        x for x in files
+        if os.path.getmtime(os.path.join(log_dir, x)) < before.timestamp()
+    ]
+
+    deleted = []
+    for name in expired[:-1]:
+        os.remove(os.path.join(log_dir, name))
+        deleted.append(name)
+    return deleted
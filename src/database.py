@@ -4,6 +4,7 @@ import distutils.util
 import tempora
 
 from . import settings
+from .compression import CompressionAlgorithm, clamp_level
 
 
 class DatabaseType(Enum):
@@ -14,6 +15,30 @@ class DatabaseType(Enum):
     postgres = 3
 
 
+class DumpLayout(Enum):
+    single = 1
+    per_database = 2
+    chunked = 3
+
+
+class DumpMode(Enum):
+    network = 1
+    exec = 2
+
+
+class OverlapPolicy(Enum):
+    skip = 1
+    queue = 2
+    coalesce = 3
+
+
+class IoniceClass(Enum):
+    none = 0
+    realtime = 1
+    best_effort = 2
+    idle = 3
+
+
 KNOWN_IMAGES = {
     # MySQL
     "mysql": "mysql",
@@ -44,6 +69,18 @@ TYPE_DEFAULTS = {
     }
 }
 
+COMPRESSION_DEFAULTS = {
+    "gzip": {
+        "compression_level": "6",
+    },
+    "zstd": {
+        "compression_level": "3",
+    },
+    "lz4": {
+        "compression_level": "1",
+    },
+}
+
 RETENTION_DEFAULTS = {
     "none": {
         "dump_timestamp": "false",
@@ -106,6 +143,8 @@ class Database:
 
         # Resolve default values based on other attributes
         self._load_labels(TYPE_DEFAULTS.get(self.type, {}), True)
+        self._load_labels(COMPRESSION_DEFAULTS.get(
+            self.compression_algorithm, {}), True)
         self._load_labels(RETENTION_DEFAULTS.get(
             self.retention_policy, {}), True)
 
@@ -114,8 +153,31 @@ class Database:
         self.port = int(self.port)
         self.skip_ssl = distutils.util.strtobool(self.skip_ssl)
         self.compress = distutils.util.strtobool(self.compress)
-        self.compression_level = int(self.compression_level)
+        # Adaptive levels start at the default level of the algorithm
+        self.compression_adaptive = self.compression_level == "adaptive"
+        if self.compression_adaptive:
+            self.compression_level = COMPRESSION_DEFAULTS[self.compression_algorithm]["compression_level"]
+        self.compression_algorithm = CompressionAlgorithm[self.compression_algorithm]
+        self.compression_level = clamp_level(
+            self.compression_algorithm, int(self.compression_level))
+        self.compression_threads = max(int(self.compression_threads), 0)
         self.encrypt = distutils.util.strtobool(self.encrypt)
+        self.stream = distutils.util.strtobool(self.stream)
+        self.dedup = distutils.util.strtobool(self.dedup)
+        self.skip_unchanged = distutils.util.strtobool(self.skip_unchanged)
+        self.dump_layout = DumpLayout[self.dump_layout]
+        self.dump_mode = DumpMode[self.dump_mode]
+        self.nice = min(max(int(self.nice), -20), 19)
+        self.ionice_class = IoniceClass[self.ionice_class]
+        self.ionice_level = min(max(int(self.ionice_level), 0), 7)
+        self.read_rate_limit = settings.parse_size(self.read_rate_limit)
+        self.write_rate_limit = settings.parse_size(self.write_rate_limit)
+        self.schedule = self.schedule.strip()
+        self.schedule_overlap = OverlapPolicy[self.schedule_overlap]
+        self.schedule_jitter = tempora.parse_timedelta(self.schedule_jitter)
+        self.timeout = tempora.parse_timedelta(self.timeout)
+        self.dump_jobs = max(int(self.dump_jobs), 1)
+        self.dump_chunk_rows = max(int(self.dump_chunk_rows), 1)
         self.dump_timestamp = distutils.util.strtobool(self.dump_timestamp)
         self.retention_min_count = max(int(self.retention_min_count), 1)
         self.retention_min_age = tempora.parse_timedelta(
@@ -124,3 +186,5 @@ class Database:
         self.retention_max_age = tempora.parse_timedelta(
             self.retention_max_age)
         self.grace_time = tempora.parse_timedelta(self.grace_time)
+        self.continuous = distutils.util.strtobool(self.continuous)
+        self.continuous_slot = self.continuous_slot.strip()
@@ -0,0 +1,260 @@
+import functools
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import pyAesCrypt
+
+from src.pipeline import BUFFER_SIZE
+
+MANIFEST_EXTENSION = "manifest"
+MANIFEST_VERSION = 1
+
+# Chunk boundaries are placed with a rolling hash (buzhash) over the last
+# _HASH_WINDOW bytes, so an edit only affects the chunks around it, even
+# within long lines (e.g. extended inserts). After MIN_CHUNK_SIZE, each byte
+# ends a chunk with a probability of 1 / 2**20, which results in an average
+# chunk size of about MIN_CHUNK_SIZE + 1 MiB. Chunks are cut at
+# MAX_CHUNK_SIZE at the latest.
+MIN_CHUNK_SIZE = 512 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Three independent 8 bit hashes, of which 20 bits in total are tested. The
+# window is no multiple of 16 bytes, so that runs of a repeated byte do not
+# hash to zero.
+_HASH_WINDOW = 40
+_HASH_MASKS = (0xFF, 0xFF, 0x0F)
+# Random value of each byte for each hash. Derived from a hash, so that chunk
+# boundaries never change between releases.
+_HASH_TABLES = [
+    bytes(hashlib.sha256(bytes([i, x])).digest()[0] for x in range(256))
+    for i in range(len(_HASH_MASKS))
+]
+
+
+def iter_chunks(stream):
+    """Splits a stream into content-defined chunks."""
+    chunk = bytearray()
+    # End of the previous data, that is part of the next hash windows
+    context = b""
+
+    while True:
+        data = stream.read(BUFFER_SIZE)
+        if not data:
+            break
+
+        buffer = context + data
+        position = len(context)
+        while position < len(buffer):
+            end = min(len(buffer), position + MAX_CHUNK_SIZE - len(chunk))
+            # Bytes before the minimum size are not hashed
+            start = min(end, position + max(0, MIN_CHUNK_SIZE - 1 - len(chunk)))
+            boundary = _find_boundary(buffer, start, end)
+            cut = end if boundary is None else boundary
+            chunk += buffer[position:cut]
+            position = cut
+
+            if boundary is not None or len(chunk) >= MAX_CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk = bytearray()
+
+        context = buffer[-(_HASH_WINDOW - 1):]
+
+    if chunk:
+        yield bytes(chunk)
+
+
+def _find_boundary(buffer, start, end):
+    """Returns the position after the first byte of buffer[start:end], that
+    ends a chunk, or None. The hashes of all positions are computed at once:
+    Each byte is an 8 bit lane of an integer, and the hash values of the
+    window are combined by shifting, rotating and XORing whole integers."""
+    if start >= end:
+        return None
+    first = max(0, start - _HASH_WINDOW + 1)
+    window = buffer[first:end]
+    size = len(window) + _HASH_WINDOW
+
+    boundaries = 0
+    for table, mask in zip(_HASH_TABLES, _HASH_MASKS):
+        # Hashes of the last 1, 2, 4, ... bytes at each position
+        hash1 = int.from_bytes(window.translate(table), "little")
+        hash2 = hash1 ^ _rotate_lanes(hash1 << 8, 1, size)
+        hash4 = hash2 ^ _rotate_lanes(hash2 << 16, 2, size)
+        hash8 = hash4 ^ _rotate_lanes(hash4 << 32, 4, size)
+        # A rotation by 8 bits leaves a lane unchanged
+        hash16 = hash8 ^ (hash8 << 64)
+        hash32 = hash16 ^ (hash16 << 128)
+        hash40 = hash32 ^ (hash8 << 256)
+        boundaries |= hash40 & _repeat_lane(mask, size)
+
+    # Positions, at which all tested bits are zero, end a chunk
+    position = boundaries.to_bytes(size, "little").find(
+        0, start - first, end - first)
+    return None if position < 0 else first + position + 1
+
+
+def _rotate_lanes(value, bits, size):
+    """Rotates each 8 bit lane of value left by bits."""
+    return (
+        ((value << bits) & _repeat_lane((0xFF << bits) & 0xFF, size))
+        | ((value >> (8 - bits)) & _repeat_lane(0xFF >> (8 - bits), size))
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _repeat_lane(lane, size):
+    return int.from_bytes(bytes([lane]) * size, "little")
+
+
+class DedupRepository:
+    """Stores dumps as content-defined chunks, which are addressed by their
+    hash and shared between all dumps. Each dump is represented by a small
+    manifest, that lists its chunks."""
+
+    def __init__(self, path):
+        self._path = path
+        self._chunk_dir = os.path.join(path, ".chunks")
+
+    def store(self, stream, compression_level=None, encryption_key=None, write_limiter=None):
+        """Reads a dump from stream and stores its chunks. Chunks are
+        compressed with zlib, if a compression level is given. Writing of new
+        chunks is throttled by an optional RateLimiter. Returns the manifest
+        of the dump and a dict with statistics."""
+        extension = ""
+        if compression_level is not None:
+            extension += ".zz"
+        if encryption_key:
+            extension += ".aes"
+
+        # With encryption, the chunk id must not reveal the content
+        id_key = str.encode(encryption_key) if encryption_key else b""
+
+        chunks = []
+        stats = {
+            "chunks": 0,
+            "new_chunks": 0,
+            "stored_size": 0,
+            "written_size": 0,
+        }
+
+        for data in iter_chunks(stream):
+            chunk_id = hmac.new(id_key, data, hashlib.sha256).hexdigest()
+            chunk_file = self.get_chunk_file(chunk_id, extension)
+
+            if os.path.exists(chunk_file):
+                # Refresh mtime, so that a concurrent garbage collection
+                # does not remove a chunk that is about to be referenced
+                os.utime(chunk_file)
+                size = os.path.getsize(chunk_file)
+            else:
+                size = self._write_chunk(
+                    chunk_file, data, compression_level, encryption_key, write_limiter)
+                stats["new_chunks"] += 1
+                stats["written_size"] += size
+
+            chunks.append([chunk_id, len(data)])
+            stats["chunks"] += 1
+            stats["stored_size"] += size
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "extension": extension,
+            "chunks": chunks,
+        }
+
+        return manifest, stats
+
+    def write_manifest(self, manifest_file, manifest):
+        part_file = f"{manifest_file}.part"
+        with open(part_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(part_file, manifest_file)
+
+    def restore(self, manifest_file, output, encryption_key=None):
+        """Writes the dump described by a manifest to the output stream."""
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        extension = manifest["extension"]
+        for chunk_id, size in manifest["chunks"]:
+            with open(self.get_chunk_file(chunk_id, extension), "rb") as f:
+                data = f.read()
+
+            if extension.endswith(".aes"):
+                if not encryption_key:
+                    raise ValueError("Dump is encrypted, but no key given")
+                decrypted = io.BytesIO()
+                pyAesCrypt.decryptStream(
+                    io.BytesIO(data), decrypted, encryption_key, BUFFER_SIZE)
+                data = decrypted.getvalue()
+            if extension.startswith(".zz"):
+                data = zlib.decompress(data)
+
+            if len(data) != size:
+                raise ValueError(f"Chunk {chunk_id} is corrupted")
+            output.write(data)
+
+    def collect_garbage(self, min_age=0):
+        """Removes all chunks, that are not referenced by any manifest.
+        Chunks modified within the last min_age seconds are kept. Returns the
+        count and size of the removed chunks."""
+        referenced = set()
+        for entry in os.scandir(self._path):
+            if entry.is_file() and entry.name.endswith(f".{MANIFEST_EXTENSION}"):
+                try:
+                    with open(entry.path) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError) as e:
+                    # Without knowing all references, nothing can be removed
+                    logging.error(
+                        f"Skip garbage collection, cannot read manifest {entry.path}: {e}")
+                    return 0, 0
+                for chunk_id, _ in manifest["chunks"]:
+                    referenced.add(f"{chunk_id}{manifest['extension']}")
+
+        removed_count = 0
+        removed_size = 0
+        if not os.path.isdir(self._chunk_dir):
+            return removed_count, removed_size
+
+        threshold = time.time() - min_age
+        for prefix in os.scandir(self._chunk_dir):
+            for entry in os.scandir(prefix.path):
+                if entry.name in referenced:
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime > threshold:
+                    continue
+                os.remove(entry.path)
+                removed_count += 1
+                removed_size += stat.st_size
+
+        return removed_count, removed_size
+
+    def get_chunk_file(self, chunk_id, extension):
+        return os.path.join(self._chunk_dir, chunk_id[:2], f"{chunk_id}{extension}")
+
+    def _write_chunk(self, chunk_file, data, compression_level, encryption_key, write_limiter=None):
+        if compression_level is not None:
+            data = zlib.compress(data, compression_level)
+        if encryption_key:
+            encrypted = io.BytesIO()
+            pyAesCrypt.encryptStream(
+                io.BytesIO(data), encrypted, encryption_key, BUFFER_SIZE)
+            data = encrypted.getvalue()
+
+        if write_limiter is not None:
+            write_limiter.consume(len(data))
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+        part_file = f"{chunk_file}.{os.getpid()}-{threading.get_ident()}.part"
+        with open(part_file, "wb") as f:
+            f.write(data)
+        os.replace(part_file, chunk_file)
+
+        return len(data)
@@ -2,7 +2,15 @@ import logging
 import os
 import docker
 import base64
+import requests
+import signal
+import socket
+import threading
+import time
+import uuid
+from docker.utils.socket import demux_adaptor, frames_iter
 from src import settings
+from src.registry import TargetRegistry
 
 
 class Docker:
@@ -10,6 +18,9 @@ class Docker:
 
     def __init__(self, config):
         self._config = config
+        self._network = None
+        self._network_lock = threading.Lock()
+        self._attached_targets = set()
 
         if not os.path.exists(self._DOCKER_SOCK):
             raise RuntimeError(
@@ -47,6 +58,9 @@ class Docker:
             filters={"status": "running", "label": label}
         )
 
+    def watch_targets(self, label, global_labels):
+        return TargetRegistry(self._client, label, global_labels)
+
     def get_network_name(self):
         encoded_instance_id = base64.b64encode(
             str.encode(self._config.instance_id)).decode("utf-8", "ignore")
@@ -73,24 +87,275 @@ class Docker:
             logging.debug("No old networks to clean up")
 
     def create_backup_network(self):
+        if self._network is not None:
+            # Reuse the persistent network of the previous cycle
+            try:
+                self._network.reload()
+                return
+            except docker.errors.NotFound:
+                logging.warning(
+                    "Persistent backup network was removed. Creating a new one..")
+                self._network = None
+                self._attached_targets = set()
+
         network_name = self.get_network_name()
 
         self._network = self._client.networks.create(network_name)
         self._network.connect(self._own_container.id)
 
     def remove_backup_network(self):
+        if self._config.docker_network_persistent:
+            return
+
         if self._network is not None:
             self._network.disconnect(self._own_container.id)
             self._network.remove()
             self._network = None
 
-    def get_target_name(self):
-        return f"{self._config.docker_target_name}_{self._config.instance_id}"
+    def reconcile_targets(self, containers):
+        """Disconnects kept targets from the backup network, which are no
+        longer backed up."""
+        target_ids = {x.id for x in containers}
+
+        with self._network_lock:
+            for container_id in list(self._attached_targets - target_ids):
+                try:
+                    self._network.disconnect(container_id, force=True)
+                except docker.errors.NotFound:
+                    # Container was removed in the meantime
+                    pass
+                self._attached_targets.discard(container_id)
+
+    def get_target_name(self, container):
+        # Each target gets its own alias, so that multiple targets can be
+        # attached to the backup network at the same time
+        return f"{self._config.docker_target_name}_{self._config.instance_id}_{container.short_id}"
 
     def connect_target(self, container):
-        target_name = self.get_target_name()
+        target_name = self.get_target_name(container)
 
-        self._network.connect(container, aliases=[target_name])
+        with self._network_lock:
+            if container.id in self._attached_targets:
+                return
+            self._network.connect(container, aliases=[target_name])
+            if self._config.docker_network_keep_targets:
+                self._attached_targets.add(container.id)
 
     def disconnect_target(self, container):
-        self._network.disconnect(container)
+        if self._config.docker_network_keep_targets:
+            return
+
+        with self._network_lock:
+            self._network.disconnect(container)
+
+    def exec_process(self, container, command, environment):
+        """Starts a shell command inside of the container. Returns a Popen like
+        object, that streams the output of the command."""
+        return ExecProcess(self._client, container, command, environment)
+
+
+class ExecProcess:
+    """Command running inside of a container through the docker exec api. The
+    output is forwarded from the docker socket into pipes, so that it can be
+    consumed like the output of a local child process. With stdin, the input
+    of the command can be written to `stdin`."""
+
+    EXIT_CODE_TIMEOUT = 10
+    # Marks the processes of the command (including the ones started by the
+    # shell), so that they can be found inside of the container
+    MARKER_VARIABLE = "DATABASE_BACKUP_EXEC"
+    # Terminates the processes with the marker ($1) in their environment
+    TERMINATE_SCRIPT = (
+        'for dir in /proc/[0-9]*; do'
+        ' if tr "\\0" "\\n" 2>/dev/null < "$dir/environ" | grep -qxF "$1"; then'
+        ' kill -TERM "${dir#/proc/}" 2>/dev/null;'
+        ' fi;'
+        ' done'
+    )
+
+    def __init__(self, client, container, command, environment, stdin=False):
+        self._client = client
+        self._container_id = container.id
+        self._killed = False
+        token = uuid.uuid4().hex
+        self._marker = f"{self.MARKER_VARIABLE}={token}"
+        self.returncode = None
+        self.stdin = None
+
+        self._exec_id = client.api.exec_create(
+            container.id,
+            ["sh", "-c", command],
+            stdin=stdin,
+            stdout=True,
+            stderr=True,
+            environment={**(environment or {}), self.MARKER_VARIABLE: token},
+        )["Id"]
+        if stdin:
+            # Input can only be sent over the raw connection
+            self._output = ExecSocket(
+                client.api.exec_start(self._exec_id, socket=True))
+            self.stdin = self._output.input
+        else:
+            self._output = client.api.exec_start(
+                self._exec_id, stream=True, demux=True)
+
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        self.stdout = open(stdout_read, "rb")
+        self.stderr = open(stderr_read, "rb")
+        self._forwarder = threading.Thread(
+            target=self._forward,
+            args=(open(stdout_write, "wb"), open(stderr_write, "wb")),
+            daemon=True,
+        )
+        self._forwarder.start()
+
+    def _forward(self, stdout, stderr):
+        try:
+            for stdout_data, stderr_data in self._output:
+                if stdout_data:
+                    stdout.write(stdout_data)
+                if stderr_data:
+                    stderr.write(stderr_data)
+                    stderr.flush()
+        except Exception as e:
+            if not self._killed:
+                stderr.write(str.encode(f"Lost connection to docker: {e}"))
+        finally:
+            self._output.close()
+            for pipe in [stdout, stderr]:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+
+    def wait(self):
+        if self.returncode is not None:
+            return self.returncode
+
+        if self._killed:
+            # Nobody reads the output anymore, which would block forwarding
+            while self._forwarder.is_alive() and self.stdout.read(65536):
+                pass
+            self._forwarder.join()
+            self.returncode = -9
+            return self.returncode
+
+        self._forwarder.join()
+        deadline = time.monotonic() + self.EXIT_CODE_TIMEOUT
+        while True:
+            state = self._client.api.exec_inspect(self._exec_id)
+            if not state["Running"] or time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+
+        if state["Running"] or state["ExitCode"] is None:
+            # Command did not terminate in time
+            self.returncode = -1
+        else:
+            self.returncode = state["ExitCode"]
+        return self.returncode
+
+    def kill(self):
+        """Terminates the command and closes the connection to it. If the
+        command cannot be signaled, it is terminated by the broken pipe, once
+        it writes further output."""
+        self._killed = True
+        try:
+            self._terminate()
+        except (docker.errors.DockerException, requests.RequestException, OSError) as e:
+            logging.debug(f"Cannot terminate command in container: {e}")
+        self._output.close()
+
+    def _terminate(self):
+        state = self._client.api.exec_inspect(self._exec_id)
+        if not state["Running"]:
+            return
+
+        # The PID of the command is only visible, if the service shares the
+        # PID namespace of the host
+        pids = self._get_host_pids(state["Pid"])
+        if len(pids) > 0:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            return
+
+        kill_id = self._client.api.exec_create(
+            self._container_id,
+            ["sh", "-c", self.TERMINATE_SCRIPT, "sh", self._marker],
+        )["Id"]
+        self._client.api.exec_start(kill_id)
+
+    def _get_host_pids(self, pid):
+        """Returns the PID of the command and of the processes started by it,
+        or an empty list, if the PID belongs to another process in this
+        namespace."""
+        try:
+            with open(f"/proc/{pid}/environ", "rb") as f:
+                if str.encode(self._marker) not in f.read().split(b"\0"):
+                    return []
+        except OSError:
+            return []
+
+        pids = []
+        remaining = [pid]
+        while len(remaining) > 0:
+            current = remaining.pop()
+            pids.append(current)
+            try:
+                with open(f"/proc/{current}/task/{current}/children") as f:
+                    remaining += [int(x) for x in f.read().split()]
+            except (OSError, ValueError):
+                # Process has terminated in the meantime
+                pass
+        return pids
+
+
+class ExecSocket:
+    """Raw connection to a command started through the docker exec api with
+    stdin. Iterating yields the output like the demuxed stream of
+    exec_start. The input of the command is available through `input`."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        # Unix sockets are wrapped into a SocketIO
+        self._raw = getattr(sock, "_sock", sock)
+        self.input = ExecInput(self._raw)
+
+    def __iter__(self):
+        for stream, data in frames_iter(self._sock, tty=False):
+            yield demux_adaptor(stream, data)
+
+    def close(self):
+        try:
+            # Also wakes up a thread, that waits for output
+            self._raw.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Connection was already closed
+            pass
+        self._sock.close()
+
+
+class ExecInput:
+    """Writable input of a command. Closing it only closes the sending side
+    of the connection, so the command gets EOF and its output can still be
+    read."""
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def write(self, data):
+        self._raw.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            self._raw.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
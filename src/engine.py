@@ -0,0 +1,135 @@
+import asyncio
+import concurrent.futures
+import logging
+
+from src.pipeline import CancelScope
+
+
+class BackupEngine:
+    """Drives the backups of a cycle on an asyncio event loop. The blocking
+    work of each target runs in a worker thread, while the event loop limits
+    the parallelism and enforces the deadlines of the targets and of the
+    whole cycle. When a deadline has passed, the child processes of the
+    target are killed through its CancelScope. The worker then cleans up its
+    partial files and reports the failure.
+
+    In pipelined mode (post_workers > 0), the work after the dump runs in a
+    separate pool, so the next target is dumped while the previous dumps are
+    still compressed and encrypted."""
+
+    def __init__(self, max_workers, cycle_timeout=None, post_workers=0):
+        self._max_workers = max_workers
+        self._cycle_timeout = cycle_timeout
+        self._post_workers = post_workers
+
+    def run(self, jobs):
+        """Runs the jobs and returns their results in the same order, once
+        all work has finished. Each job is a tuple of a function, which is
+        called with a CancelScope, and its timeout (timedelta, 0 for none).
+        The function returns a generator, which yields once the target is no
+        longer needed (e.g. after the dump). Its return value is the result
+        of the job. Jobs, that raise an exception, are logged and have the
+        result None, so that they do not abort the other jobs."""
+        return asyncio.run(self._run(jobs))
+
+    async def _run(self, jobs):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self._max_workers)
+        post_semaphore = asyncio.Semaphore(
+            self._post_workers) if self._post_workers > 0 else None
+        cycle_deadline = None
+        if self._cycle_timeout is not None and self._cycle_timeout.total_seconds() > 0:
+            cycle_deadline = loop.time() + self._cycle_timeout.total_seconds()
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_workers,
+            thread_name_prefix="backup",
+        ) as executor, concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(self._post_workers, 1),
+            thread_name_prefix="postprocess",
+        ) as post_executor:
+            return await asyncio.gather(*[
+                self._run_job(executor, semaphore, post_executor, post_semaphore,
+                              function, timeout, cycle_deadline)
+                for function, timeout in jobs
+            ])
+
+    async def _run_job(self, executor, semaphore, post_executor, post_semaphore,
+                       function, timeout, cycle_deadline):
+        scope = CancelScope()
+        try:
+            return await self._run_stages(executor, semaphore, post_executor, post_semaphore,
+                                          function, timeout, cycle_deadline, scope)
+        except Exception:
+            logging.exception("Unexpected error while running backup job")
+            # Child processes of the job must not outlive it
+            scope.cancel("Job failed")
+            return None
+
+    async def _run_stages(self, executor, semaphore, post_executor, post_semaphore,
+                          function, timeout, cycle_deadline, scope):
+        loop = asyncio.get_running_loop()
+
+        async with semaphore:
+            deadline = cycle_deadline
+            reason = "Cycle deadline exceeded"
+            if timeout.total_seconds() > 0:
+                target_deadline = loop.time() + timeout.total_seconds()
+                if deadline is None or target_deadline < deadline:
+                    deadline = target_deadline
+                    reason = f"Deadline exceeded ({timeout})"
+
+            if deadline is not None and deadline <= loop.time():
+                # Targets, that were waiting for a worker, are not started
+                scope.cancel(reason)
+
+            stages = function(scope)
+            if post_semaphore is None:
+                return await self._wait(
+                    loop.run_in_executor(executor, _finish, stages), scope, deadline, reason)
+
+            finished, result = await self._wait(
+                loop.run_in_executor(executor, _step, stages), scope, deadline, reason)
+            if finished:
+                return result
+            # The worker is only released, once the post-processing can
+            # start. This bounds the count of dumps waiting for it.
+            await post_semaphore.acquire()
+
+        try:
+            _, result = await self._wait(
+                loop.run_in_executor(post_executor, _step, stages), scope, deadline, reason)
+            return result
+        finally:
+            post_semaphore.release()
+
+    async def _wait(self, future, scope, deadline, reason):
+        loop = asyncio.get_running_loop()
+        if deadline is None or scope.cancelled:
+            return await future
+
+        try:
+            # The worker thread itself cannot be interrupted
+            return await asyncio.wait_for(
+                asyncio.shield(future), deadline - loop.time())
+        except asyncio.TimeoutError:
+            scope.cancel(reason)
+            return await future
+
+
+def _step(generator):
+    """Runs the generator until its next yield. Returns, if it has finished,
+    and its return value."""
+    try:
+        next(generator)
+    except StopIteration as e:
+        return True, e.value
+    return False, None
+
+
+def _finish(generator):
+    """Runs the generator to its end and returns its return value."""
+    while True:
+        finished, result = _step(generator)
+        if finished:
+            return result
@@ -1,30 +1,117 @@
 import logging
+import queue
+import threading
+import time
+
 import requests
 
+# Seconds to wait for a response of Healthchecks.io
+TIMEOUT = 5
+# Failed pings are retried after 1, 2, 4, ... seconds
+RETRIES = 3
+RETRY_DELAY = 1
+# Count of pings waiting for delivery. While the endpoint is unreachable,
+# the oldest pings are dropped.
+QUEUE_SIZE = 100
+
 
 class Healthcheck:
+    """Sends pings to Healthchecks.io. Pings are delivered in order by a
+    background thread with a persistent session, so a slow or unreachable
+    endpoint never delays the backups."""
+
     def __init__(self, config):
         self.healthchecks_io_url = config.healthchecks_io_url
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._session = requests.Session()
 
-    def start(self, text):
+    def start(self, text, url=None):
+        """Pings the start of a backup. If url is given, it is used instead of
+        the global url (e.g. for a single target)."""
         logging.debug("Healthcheck: Start")
-        self._healthchecks_io_request('/start', text)
+        self._healthchecks_io_request('/start', text, url)
 
-    def success(self, text):
+    def success(self, text, url=None):
         logging.debug("Healthcheck: Success")
-        self._healthchecks_io_request('', text)
+        self._healthchecks_io_request('', text, url)
 
-    def fail(self, text):
+    def fail(self, text, url=None):
         logging.debug("Healthcheck: Fail")
-        self._healthchecks_io_request('/fail', text)
+        self._healthchecks_io_request('/fail', text, url)
+
+    def close(self, timeout=TIMEOUT):
+        """Waits up to timeout seconds for the delivery of pending pings."""
+        with self._lock:
+            worker = self._worker
+        if worker is None:
+            return
+
+        deadline = time.monotonic() + timeout
+        try:
+            # No pending ping is dropped for the end marker
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logging.warning(
+                f"Healthcheck queue is still full. {self._queue.qsize()} ping(s) were not delivered")
+            return
+        worker.join(max(0, deadline - time.monotonic()))
+
+    def _healthchecks_io_request(self, path, text=None, url=None):
+        base_url = url or self.healthchecks_io_url
+        if base_url is not None:
+            self._put((f"{base_url}{path}", text))
 
-    def _healthchecks_io_request(self, path, text=None):
-        if self.healthchecks_io_url is not None:
-            url = f"{self.healthchecks_io_url}{path}"
-            logging.debug(f"Ping Healtchecks.io (URL: {url}")
+    def _put(self, item):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    name="healthcheck", target=self._run, daemon=True)
+                self._worker.start()
 
             try:
-                requests.post(url, data=text, timeout=5)
+                self._queue.put_nowait(item)
+            except queue.Full:
+                try:
+                    dropped = self._queue.get_nowait()
+                except queue.Empty:
+                    # Emptied by the worker in the meantime
+                    self._queue.put_nowait(item)
+                    return
+                if dropped is None:
+                    # The end marker of close() is kept, the new ping is
+                    # dropped instead
+                    dropped, item = item, dropped
+                logging.warning(
+                    f"Healthcheck queue is full. Dropped ping to {dropped[0]}")
+                self._queue.put_nowait(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._send(*item)
+
+    def _send(self, url, text):
+        logging.debug(f"Ping Healtchecks.io (URL: {url}")
+
+        for attempt in range(RETRIES + 1):
+            if attempt > 0:
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                response = self._session.post(url, data=text, timeout=TIMEOUT)
             except requests.RequestException as e:
-                logging.error(
-                    f"Failed to ping Healthchecks.io. Error Output: {e}")
+                error = e
+                continue
+            # Only errors of the server can be resolved by retrying
+            if response.status_code < 500:
+                if not response.ok:
+                    logging.error(
+                        f"Failed to ping Healthchecks.io. Status: {response.status_code} {response.text.strip()}")
+                return
+            error = f"Status: {response.status_code}"
+
+        logging.error(
+            f"Failed to ping Healthchecks.io. Error Output: {error}")
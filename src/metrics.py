@@ -1,97 +1,308 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import threading
 import logging
-import copy
+import gzip
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
 
 class Metrics:
     def __init__(self, config):
-        self._live_metrics = {}
+        self._payload = (b"", gzip.compress(b""))
         self._metrics = {}
+        self._verify_metrics = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+        # Counters are accumulated over all backup cycles
+        self._init_counter_metric(
+            'cycles_total', 'Count of finished backup cycles')
+        self._init_counter_metric(
+            'backups_total', 'Count of backups')
+        self._init_counter_metric(
+            'backup_failures_total', 'Count of failed backups')
+        self._init_counter_metric(
+            'backup_timeouts_total', 'Count of backups cancelled, because their deadline has passed')
+        self._init_counter_metric(
+            'backup_skipped_total', 'Count of backups skipped, because the database has not changed')
+        self._init_counter_metric(
+            'backup_raw_bytes_total', 'Size of all dumps before compression/encryption')
+        self._init_counter_metric(
+            'backup_bytes_total', 'Size of all dumps after compression/encryption')
+        self._init_counter_metric(
+            'backup_cpu_seconds_total', 'CPU time of the child processes of backups in seconds')
+        self._init_counter_metric(
+            'scheduler_idle_seconds_total', 'Time the scheduler waited between backup cycles in seconds')
+        self._init_counter_metric(
+            'scheduler_busy_seconds_total', 'Time spent in backup cycles in seconds')
+        self._init_counter_metric(
+            'scheduler_skipped_runs_total', 'Count of scheduled runs, that were skipped because of an overlap')
+        self._init_counter_metric(
+            'scheduler_coalesced_runs_total', 'Count of scheduled runs, that were merged into one run because of an overlap')
+        self._init_counter_metric(
+            'scheduler_failed_runs_total', 'Count of backup cycles or verifications, that failed with an unexpected error')
+        self._init_counter_metric(
+            'verify_runs_total', 'Count of finished verifications')
+        self._init_counter_metric(
+            'verify_bytes_total', 'Size of all files read by verifications')
+        self._init_counter_metric(
+            'verify_failures_total', 'Count of damaged files found by verifications')
+        self._init_counter_metric(
+            'continuous_restarts_total', 'Count of restarts of the log streaming of continuous backups')
+
+        # Histograms are accumulated over all backup cycles
+        self._init_histogram_metric(
+            'backup_duration_seconds', 'Distribution of the time needed for backups in seconds',
+            [1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200, 14400])
+        self._init_histogram_metric(
+            'backup_dump_size_bytes', 'Distribution of the dump size after compression/encryption in bytes',
+            [10**6, 10**7, 10**8, 10**9, 10**10, 10**11, 10**12])
 
         if config.openmetrics_enable:
             logging.info(
                 f"Starting openmetrics endpoint at port {config.openmetrics_port}")
             daemon = threading.Thread(name='daemon_server',
                                       target=self._start_http_server,
-                                      args=(config.openmetrics_port,))
+                                      args=(config.openmetrics_port, config.openmetrics_gzip))
 
             # Set as a daemon so it will be killed once the main thread is dead.
-            daemon.setDaemon(True)
+            daemon.daemon = True
             daemon.start()
 
-    def init_metrics(self):
+    def init_metrics(self, partial=False):
+        """Resets the metrics of the last cycle. The endpoint keeps serving
+        them until the next flush. On partial cycles, which only back up some
+        targets, the values of the other targets are kept."""
+        previous = self._metrics
+        self._metrics = {}
         # General metrics
         self._init_single_metric(
             'targets', 'gauge', 'Count of configured/detected databases')
         self._init_single_metric(
             'successful_targets', 'gauge', 'Count of successfully backuped databases')
+        self._init_single_metric(
+            'skipped_targets', 'gauge', 'Count of databases skipped, because they have not changed')
         self._init_single_metric(
             'cycle_duration', 'gauge', 'Duration of whole backup cycle in milliseconds')
+        self._init_single_metric(
+            'service_max_rss', 'gauge', 'Peak resident memory of the backup service process in bytes')
 
         # Database specific
         self._init_multi_metric('backup_status', 'gauge',
                                 'Status of latest backup')
+        self._init_multi_metric('backup_skipped', 'gauge',
+                                'Latest backup was skipped, because the database has not changed')
         self._init_multi_metric('backup_duration', 'gauge',
                                 'Time needed for backup in milliseconds')
         self._init_multi_metric(
             'backup_dump_raw_size', 'gauge', 'Size of dump before compression/encryption')
         self._init_multi_metric('backup_dump_size', 'gauge',
                                 'Size of dump after compression/encryption')
+        self._init_multi_metric('backup_database_dump_raw_size', 'gauge',
+                                'Size of the dump of a single database before compression/encryption (per_database layout)')
+        self._init_multi_metric('backup_database_dump_size', 'gauge',
+                                'Size of the dump of a single database after compression/encryption (per_database layout)')
+        self._init_multi_metric('backup_compression_level', 'gauge',
+                                'Compression level of the latest dump')
+        self._init_multi_metric('backup_dedup_written_size', 'gauge',
+                                'Size of new chunks written to the deduplication repository')
+        self._init_multi_metric('backup_phase_duration', 'gauge',
+                                'Time needed for each phase of the backup in milliseconds')
+        self._init_multi_metric('backup_phase_throughput', 'gauge',
+                                'Processed bytes per second in each phase of the backup')
+        self._init_multi_metric('backup_read_rate', 'gauge',
+                                'Bytes per second read from the database while dumping')
+        self._init_multi_metric('backup_write_rate', 'gauge',
+                                'Bytes per second written to the dump directory while dumping, compressing and encrypting')
+        self._init_multi_metric('backup_cpu_user_time', 'gauge',
+                                'User CPU time of the child processes (dump, compression, ...) of the latest backup in milliseconds')
+        self._init_multi_metric('backup_cpu_system_time', 'gauge',
+                                'System CPU time of the child processes of the latest backup in milliseconds')
+        self._init_multi_metric('backup_max_rss', 'gauge',
+                                'Peak resident memory of the largest child process of the latest backup in bytes')
+        self._init_multi_metric('backup_io_read_bytes', 'gauge',
+                                'Bytes read by the child processes of the latest backup (including pipes and sockets)')
+        self._init_multi_metric('backup_io_write_bytes', 'gauge',
+                                'Bytes written by the child processes of the latest backup (including pipes and sockets)')
         self._init_multi_metric('backup_retention_checked_files', 'gauge',
                                 'Count of dumps check when applying retention policy')
         self._init_multi_metric('backup_retention_kept_files', 'gauge',
                                 'Count of dumps kept after retention policy is applied')
 
-    def _init_single_metric(self, name, type, help):
-        self._metrics[name] = {
+        if partial:
+            for name, metric in self._metrics.items():
+                if 'values' in metric and name in previous:
+                    metric['values'] = previous[name]['values']
+
+    def init_verify_metrics(self):
+        """Resets the metrics of the last verification. They are kept apart
+        from the metrics of backup cycles, which are reset in every cycle."""
+        metrics = {}
+        self._init_single_metric(
+            'verify_checked_files', 'gauge', 'Count of files checked by the latest verification', metrics)
+        self._init_single_metric(
+            'verify_failed_files', 'gauge', 'Count of damaged files found by the latest verification', metrics)
+        self._init_single_metric(
+            'verify_unverified_files', 'gauge', 'Count of dumps without checksum', metrics)
+        self._init_single_metric(
+            'verify_duration', 'gauge', 'Duration of the latest verification in milliseconds', metrics)
+        self._init_single_metric(
+            'verify_last_run', 'gauge', 'Unix timestamp of the latest verification', metrics)
+        self._init_multi_metric(
+            'verify_status', 'gauge', 'All files of the dump were intact in the latest verification', metrics)
+        self._verify_metrics = metrics
+
+    def _init_single_metric(self, name, type, help, metrics=None):
+        (metrics if metrics is not None else self._metrics)[name] = {
             'type': type,
             'help': help,
             'value': None
         }
 
-    def _init_multi_metric(self, name, type, help):
-        self._metrics[name] = {
+    def _init_multi_metric(self, name, type, help, metrics=None):
+        (metrics if metrics is not None else self._metrics)[name] = {
             'type': type,
             'help': help,
-            'values': []
+            'values': {}
+        }
+
+    def _init_counter_metric(self, name, help):
+        self._counters[name] = {
+            'type': 'counter',
+            'help': help,
+            'series': {}
+        }
+
+    def _init_histogram_metric(self, name, help, buckets):
+        self._histograms[name] = {
+            'type': 'histogram',
+            'help': help,
+            'buckets': buckets,
+            'series': {}
         }
 
     def set_single_value(self, name, value):
-        self._metrics[name]['value'] = value
+        self._get_metric(name)['value'] = value
 
     def add_multi_value(self, name, labels, value):
         pair = {
             'labels': labels,
             'value': value
         }
-        self._metrics[name]['values'].append(pair)
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._get_metric(name)['values'][key] = pair
+
+    def _get_metric(self, name):
+        if name in self._verify_metrics:
+            return self._verify_metrics[name]
+        return self._metrics[name]
+
+    def increment(self, name, labels=None, value=1):
+        labels = labels or {}
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]['series'].setdefault(key, {
+                'labels': labels,
+                'value': 0
+            })
+            series['value'] += value
+
+    def observe(self, name, labels, value):
+        histogram = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = histogram['series'].setdefault(key, {
+                'labels': labels,
+                'buckets': [0] * len(histogram['buckets']),
+                'sum': 0,
+                'count': 0
+            })
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
 
     def flush_metrics(self):
-        self._live_metrics = copy.deepcopy(self._metrics)
+        """Renders the current metrics into the payload served by the http
+        endpoint. The payload is replaced as a whole, so that scrapes never
+        see a partially updated state."""
+        with self._lock:
+            lines = []
+            for name, metric in self._metrics.items():
+                lines += _render_metric(name, metric)
+            for name, metric in self._verify_metrics.items():
+                lines += _render_metric(name, metric)
+            for name, metric in self._counters.items():
+                lines += _render_metric(name, metric)
+            for name, metric in self._histograms.items():
+                lines += _render_metric(name, metric)
 
-    def _start_http_server(self, port):
+        payload = "".join(f"{line}\n" for line in lines).encode("utf-8")
+        self._payload = (payload, gzip.compress(payload))
+
+    def _start_http_server(self, port, gzip_enable):
         metrics = self
 
         class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
             def do_GET(self):
-                message = ""
-                for metric in metrics._live_metrics.items():
-                    message += f"# HELP {metric[0]} {metric[1]['help']}\n# TYPE {metric[0]} {metric[1]['type']}\n"
-                    if "value" in metric[1] and metric[1]['value'] is not None:
-                        message += f"{metric[0]} {metric[1]['value']}\n"
-                    elif "values" in metric[1]:
-                        for entry in metric[1]['values']:
-                            label_string = ','.join(
-                                map(lambda lbl: f'{lbl[0]}="{lbl[1]}"', entry['labels'].items()))
-                            message += f"{metric[0]}{{{label_string}}} {entry['value']}\n"
-
-                self.protocol_version = "HTTP/1.1"
+                payload, compressed_payload = metrics._payload
+                accept_encoding = self.headers.get("Accept-Encoding", "")
+
                 self.send_response(200)
-                self.send_header("Content-Length", len(message))
+                self.send_header("Content-Type", CONTENT_TYPE)
+                if gzip_enable and "gzip" in accept_encoding:
+                    payload = compressed_payload
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", len(payload))
                 self.end_headers()
-                self.wfile.write(bytes(message, "utf8"))
-                return
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Openmetrics: {format % args}")
 
-        with HTTPServer(('', port), RequestHandler) as httpd:
+        with ThreadingHTTPServer(('', port), RequestHandler) as httpd:
+            httpd.daemon_threads = True
             httpd.serve_forever()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, le=None):
+    pairs = [f'{key}="{_escape(value)}"' for key, value in labels.items()]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return f"{{{','.join(pairs)}}}" if pairs else ""
+
+
+def _render_metric(name, metric):
+    lines = [f"# HELP {name} {metric['help']}",
+             f"# TYPE {name} {metric['type']}"]
+    if "value" in metric and metric['value'] is not None:
+        lines.append(f"{name} {metric['value']}")
+    elif "values" in metric:
+        for entry in metric['values'].values():
+            lines.append(
+                f"{name}{_format_labels(entry['labels'])} {entry['value']}")
+    elif metric['type'] == 'histogram':
+        for entry in metric['series'].values():
+            for bound, count in zip(metric['buckets'], entry['buckets']):
+                lines.append(
+                    f"{name}_bucket{_format_labels(entry['labels'], bound)} {count}")
+            lines.append(
+                f"{name}_bucket{_format_labels(entry['labels'], '+Inf')} {entry['count']}")
+            lines.append(
+                f"{name}_sum{_format_labels(entry['labels'])} {entry['sum']}")
+            lines.append(
+                f"{name}_count{_format_labels(entry['labels'])} {entry['count']}")
+    elif "series" in metric:
+        for entry in metric['series'].values():
+            lines.append(
+                f"{name}{_format_labels(entry['labels'])} {entry['value']}")
+    return lines
@@ -0,0 +1,628 @@
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+import pyAesCrypt
+
+from src import checksum
+
+BUFFER_SIZE = 64 * 1024
+STDERR_LIMIT = 64 * 1024
+# Interval to sample the memory of running child processes
+SAMPLE_INTERVAL = 0.1
+
+
+class PipelineError(Exception):
+    def __init__(self, message, returncode=None, stderr=""):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class Cancelled(PipelineError):
+    """Raised, when the backup was cancelled through its CancelScope."""
+
+
+class ChildProcess(subprocess.Popen):
+    """Shell command running in its own process group. kill() terminates the
+    whole group, so that no process started by the shell keeps running (and
+    keeps the pipes open) after the command was killed. Once wait() has
+    returned, the resource usage of the command (including the processes
+    started by the shell) is available in `rusage`, its I/O counters in `io`
+    and its peak memory in `max_rss`. The same applies to poll(), once it
+    returned the exit code."""
+
+    def __init__(self, command, **kwargs):
+        self.rusage = None
+        self.io = None
+        self.max_rss = 0
+        self._reap_lock = threading.Lock()
+        super().__init__(command, shell=True, start_new_session=True, **kwargs)
+        # The maxrss of the rusage also includes the memory of the service,
+        # from which the process was forked
+        _memory_sampler.add(self)
+
+    def poll(self):
+        """Like Popen.poll(), but keeps the resource usage of the process."""
+        if self.returncode is None and self._reap_lock.acquire(False):
+            # Another thread is already waiting for the process otherwise
+            try:
+                self._reap(os.WNOHANG)
+            finally:
+                self._reap_lock.release()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Like Popen.wait(), but keeps the resource usage of the process."""
+        if timeout is None:
+            with self._reap_lock:
+                self._reap(0)
+            return self.returncode
+
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+        return self.returncode
+
+    def _reap(self, wait_flags):
+        # Popen reaps with waitpid(), which discards the resource usage
+        if self.returncode is not None or not self._await_exit(wait_flags):
+            return
+        try:
+            _, status, self.rusage = os.wait4(self.pid, 0)
+        except ChildProcessError:
+            # Reaped elsewhere (e.g. SIGCHLD ignored)
+            self.returncode = 0
+            return
+        self.returncode = os.waitstatus_to_exitcode(status)
+
+    def _await_exit(self, wait_flags):
+        """Waits for the process to terminate without reaping it, so that its
+        I/O counters can still be read. Returns, if it has terminated."""
+        try:
+            result = os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT | wait_flags)
+        except ChildProcessError:
+            _memory_sampler.discard(self)
+            return True
+        if result is None:
+            # Still running (WNOHANG)
+            return False
+        self.io = _read_io_counters(self.pid)
+        _memory_sampler.discard(self)
+        return True
+
+    def sample_memory(self):
+        self.max_rss = max(self.max_rss, _read_peak_memory(self.pid))
+
+    def kill(self):
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # All processes of the group have already terminated
+            pass
+
+
+class MemorySampler:
+    """Samples the peak memory of running child processes in a background
+    thread, which only runs while processes are tracked."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._thread = None
+
+    def add(self, process):
+        with self._lock:
+            self._processes.add(process)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    name="memory_sampler", target=self._run, daemon=True)
+                self._thread.start()
+
+    def discard(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._processes) == 0:
+                    self._thread = None
+                    return
+                processes = list(self._processes)
+            for process in processes:
+                process.sample_memory()
+            time.sleep(SAMPLE_INTERVAL)
+
+
+_memory_sampler = MemorySampler()
+
+
+class ResourceUsage:
+    """Sums up the resource usage of terminated child processes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.processes = 0
+        self.user_seconds = 0
+        self.system_seconds = 0
+        # Peak resident memory of the largest process in bytes
+        self.max_rss = 0
+        # Bytes passed to read/write calls, including pipes and sockets
+        self.read_bytes = 0
+        self.write_bytes = 0
+
+    def add(self, process):
+        """Adds the usage of a process, if it is available (e.g. not for
+        commands inside of the target container)."""
+        rusage = getattr(process, "rusage", None)
+        if rusage is None:
+            return
+        io = process.io or {}
+        with self._lock:
+            self.processes += 1
+            self.user_seconds += rusage.ru_utime
+            self.system_seconds += rusage.ru_stime
+            self.max_rss = max(self.max_rss, process.max_rss)
+            self.read_bytes += io.get("rchar", 0)
+            self.write_bytes += io.get("wchar", 0)
+
+
+class CancelScope:
+    """Tracks the child processes of a backup, so that all of them can be
+    killed at once, e.g. when its deadline has passed. Processes, that are
+    added after the cancellation, are killed immediately. The resource usage
+    of discarded processes is summed up in `usage`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.reason = None
+        self.usage = ResourceUsage()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def add(self, process):
+        with self._lock:
+            if self.reason is None:
+                self._processes.add(process)
+                return
+        process.kill()
+        raise Cancelled(self.reason)
+
+    def discard(self, process):
+        with self._lock:
+            self._processes.discard(process)
+        self.usage.add(process)
+
+    def check(self):
+        """Raises Cancelled, if the scope was cancelled."""
+        if self.reason is not None:
+            raise Cancelled(self.reason)
+
+    def cancel(self, reason):
+        """Kills all tracked processes. Does not wait for them, so that it can
+        be called from the event loop."""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            processes = list(self._processes)
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                # Process has already terminated
+                pass
+
+
+class RateLimiter:
+    """Limits the throughput of one or more streams to a number of bytes per
+    second. A rate of 0 means unlimited. Streams that are processed in
+    parallel share the limit. The total count of bytes is kept in `bytes`.
+    Transfers fail with Cancelled, once the optional CancelScope was
+    cancelled."""
+
+    def __init__(self, rate=0, scope=None):
+        self._rate = rate
+        self._scope = scope
+        self._lock = threading.Lock()
+        self._next_time = None
+        self.bytes = 0
+
+    def consume(self, size):
+        if self._scope is not None:
+            self._scope.check()
+        with self._lock:
+            self.bytes += size
+            if self._rate <= 0:
+                return
+            # Each transfer is scheduled after the previous one
+            now = time.monotonic()
+            start = max(now, self._next_time or now)
+            self._next_time = start + size / self._rate
+            delay = start - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CountingReader:
+    """Wraps a readable stream and counts the bytes read from it. Reads are
+    throttled by an optional RateLimiter."""
+
+    def __init__(self, stream, limiter=None):
+        self._stream = stream
+        self._limiter = limiter
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._count(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        self._count(data)
+        return data
+
+    def _count(self, data):
+        self.bytes += len(data)
+        if self._limiter is not None:
+            self._limiter.consume(len(data))
+
+
+class CountingWriter:
+    """Wraps a writable stream and counts the bytes written to it. Writes are
+    throttled by an optional RateLimiter. An optional hash object (see
+    checksum.new) is updated with the written data, and an optional mirror
+    stream (e.g. an upload) receives a copy of it."""
+
+    def __init__(self, stream, limiter=None, digest=None, mirror=None):
+        self._stream = stream
+        self._limiter = limiter
+        self._digest = digest
+        self._mirror = mirror
+        self.bytes = 0
+
+    def write(self, data):
+        if self._limiter is not None:
+            self._limiter.consume(len(data))
+        self._stream.write(data)
+        if self._digest is not None:
+            self._digest.update(data)
+        if self._mirror is not None:
+            self._mirror.write(data)
+        self.bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        self._stream.flush()
+
+
+class StderrCollector(threading.Thread):
+    """Drains the stderr pipe of a child process in the background. Only the
+    last STDERR_LIMIT bytes are kept."""
+
+    def __init__(self, stream):
+        super().__init__(daemon=True)
+        self._stream = stream
+        self._buffer = bytearray()
+        self.start()
+
+    def run(self):
+        for chunk in iter(lambda: self._stream.read(BUFFER_SIZE), b""):
+            self._buffer += chunk
+            if len(self._buffer) > STDERR_LIMIT:
+                del self._buffer[:-STDERR_LIMIT]
+
+    @property
+    def text(self):
+        return self._buffer.decode("utf-8", "replace").strip()
+
+
+class FilterProcess:
+    """Runs an external filter command (e.g. gzip), which is fed from a
+    source stream by a background thread. The filtered data is available
+    through `stdout`."""
+
+    def __init__(self, command, source):
+        self._error = None
+        self._process = ChildProcess(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._stderr = StderrCollector(self._process.stderr)
+        self._feeder = threading.Thread(
+            target=self._feed, args=(source,), daemon=True)
+        self._feeder.start()
+        self.stdout = self._process.stdout
+
+    @property
+    def process(self):
+        """Underlying child process, e.g. to add it to a CancelScope."""
+        return self._process
+
+    def _feed(self, source):
+        try:
+            shutil.copyfileobj(source, self._process.stdin, BUFFER_SIZE)
+        except OSError:
+            # Filter was terminated. Its return code tells what happened.
+            pass
+        except PipelineError as e:
+            # Reading the source failed, e.g. because it was cancelled
+            self._error = e
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+    def wait(self):
+        self._feeder.join()
+        returncode = self._process.wait()
+        self._stderr.join()
+        if self._error is not None:
+            raise self._error
+        if returncode != 0:
+            raise PipelineError(
+                "Error while filtering dump", returncode, self._stderr.text)
+
+    def kill(self):
+        self._process.kill()
+        self._process.wait()
+        self._feeder.join()
+
+
+class ProducerThread(threading.Thread):
+    """Runs a function, that writes to a stream (e.g. decryption), in a
+    background thread. The written data is available through `stdout`, like
+    the output of a child process."""
+
+    def __init__(self, function):
+        super().__init__(daemon=True)
+        self._function = function
+        self._error = None
+        stdout_read, stdout_write = os.pipe()
+        self.stdout = open(stdout_read, "rb")
+        self._output = open(stdout_write, "wb")
+        self.start()
+
+    def run(self):
+        try:
+            self._function(self._output)
+        except BrokenPipeError:
+            # Output is no longer read. The reader reports the error.
+            pass
+        except Exception as e:
+            self._error = e
+        finally:
+            try:
+                self._output.close()
+            except OSError:
+                pass
+
+    def wait(self):
+        """Waits for the function and raises its error. Data, that was not
+        read yet, is discarded."""
+        self.stdout.close()
+        self.join()
+        if self._error is not None:
+            raise self._error
+
+    def kill(self):
+        self.stdout.close()
+        self.join()
+
+
+class DumpPipeline:
+    """Streams the output of a dump command through optional compression and
+    encryption stages directly into the dump file. Data is only held in
+    bounded buffers and no intermediate files are written."""
+
+    def __init__(self, command, env, compress_command=None, encryption_key=None, launcher=None,
+                 read_limiter=None, write_limiter=None, scope=None):
+        self._command = command
+        self._env = env
+        self._compress_command = compress_command
+        self._encryption_key = encryption_key
+        # Starts the dump command. Must return a Popen like object.
+        self._launcher = launcher if launcher is not None else _launch_process
+        self._read_limiter = read_limiter
+        self._write_limiter = write_limiter
+        self._scope = scope
+
+        self.raw_size = 0
+        self.processed_size = 0
+        # Checksum of the written dump file
+        self.checksum = None
+
+    def run(self, output_file, mirror=None):
+        """Writes the processed dump to output_file. The optional mirror
+        stream receives a copy of it."""
+        part_file = f"{output_file}.part"
+        digest = checksum.new()
+
+        def write_file(stream):
+            with open(part_file, "wb") as f:
+                processed = CountingWriter(
+                    f, self._write_limiter, digest, mirror)
+                if self._encryption_key:
+                    pyAesCrypt.encryptStream(
+                        stream, processed, self._encryption_key, BUFFER_SIZE)
+                else:
+                    shutil.copyfileobj(stream, processed, BUFFER_SIZE)
+            return processed.bytes
+
+        try:
+            self.run_into(write_file)
+        except BaseException:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            raise
+
+        os.replace(part_file, output_file)
+        self.checksum = digest.hexdigest()
+
+    def run_into(self, consumer):
+        """Passes the (compressed) dump stream to consumer, which must read it
+        to the end and return the number of processed bytes."""
+        dump = self._launcher(self._command, self._env)
+        dump_stderr = StderrCollector(dump.stderr)
+        filter_process = None
+
+        try:
+            if self._scope is not None:
+                self._scope.add(dump)
+            raw = CountingReader(dump.stdout, self._read_limiter)
+            stream = raw
+            if self._compress_command is not None:
+                filter_process = FilterProcess(self._compress_command, raw)
+                stream = filter_process.stdout
+                if self._scope is not None:
+                    self._scope.add(filter_process.process)
+
+            processed_size = consumer(stream)
+
+            # A failed filter stops reading the dump, which would block the
+            # dump command forever
+            if filter_process is not None:
+                filter_process.wait()
+            returncode = dump.wait()
+            dump_stderr.join()
+            if returncode != 0:
+                raise PipelineError(
+                    "Error while creating dump", returncode, dump_stderr.text)
+        except BaseException as e:
+            dump.kill()
+            dump.wait()
+            if filter_process is not None:
+                filter_process.kill()
+            if self._scope is not None and self._scope.cancelled and not isinstance(e, Cancelled):
+                # Killed processes fail with misleading errors
+                raise Cancelled(self._scope.reason) from e
+            raise
+        finally:
+            if self._scope is not None:
+                self._scope.discard(dump)
+                if filter_process is not None:
+                    self._scope.discard(filter_process.process)
+
+        self.raw_size = raw.bytes
+        self.processed_size = processed_size
+
+
+def filter_file(command, input_file, output_file, write_limiter=None, scope=None, digest=None,
+                mirror=None):
+    """Runs the content of input_file through a filter command (e.g. gzip) and
+    writes the result to output_file. Returns the size of the output. The
+    optional hash object is updated with the output and the optional mirror
+    stream receives a copy of it. A partially written output_file is removed
+    on errors."""
+    try:
+        with open(input_file, "rb") as source, open(output_file, "wb") as f:
+            filter_process = FilterProcess(command, source)
+            output = CountingWriter(f, write_limiter, digest, mirror)
+            try:
+                if scope is not None:
+                    scope.add(filter_process.process)
+                shutil.copyfileobj(filter_process.stdout, output, BUFFER_SIZE)
+                filter_process.wait()
+            except BaseException:
+                filter_process.kill()
+                if scope is not None:
+                    scope.check()
+                raise
+            finally:
+                if scope is not None:
+                    scope.discard(filter_process.process)
+    except BaseException:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+
+    return output.bytes
+
+
+def run_command(command, env, launcher=None, scope=None):
+    """Runs a short command (e.g. a database query) and returns its result like
+    subprocess.run(capture_output=True, text=True). Only the last
+    STDERR_LIMIT bytes of stderr are kept."""
+    process = (launcher or _launch_process)(command, env)
+    stderr = StderrCollector(process.stderr)
+
+    try:
+        if scope is not None:
+            scope.add(process)
+        stdout = process.stdout.read()
+        returncode = process.wait()
+        stderr.join()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        if scope is not None:
+            scope.discard(process)
+
+    if scope is not None:
+        scope.check()
+    return subprocess.CompletedProcess(
+        command, returncode, stdout.decode("utf-8", "replace"), stderr.text)
+
+
+def _read_io_counters(pid):
+    """Returns the I/O counters of a process, or None if they are not
+    available."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            return {
+                key: int(value)
+                for key, _, value in (line.partition(":") for line in f)
+            }
+    except (OSError, ValueError):
+        return None
+
+
+def _read_peak_memory(pid):
+    """Returns the peak resident memory of the largest process of a running
+    command in bytes, or 0 if it is not available. The processes started by
+    the shell are included."""
+    peak = 0
+    pids = [pid]
+    while len(pids) > 0:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        # Kilobytes
+                        peak = max(peak, int(line.split()[1]) * 1024)
+                        break
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids += [int(x) for x in f.read().split()]
+        except (OSError, ValueError, IndexError):
+            # Process has terminated in the meantime
+            pass
+    return peak
+
+
+def _launch_process(command, env):
+    return ChildProcess(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
@@ -0,0 +1,122 @@
+import datetime
+import logging
+import threading
+import time
+
+import docker
+
+from src.database import Database
+
+
+class TargetRegistry:
+    """Keeps the list of target containers up to date by listening to the
+    docker events stream, instead of listing all containers every cycle.
+    Resolved database configurations are cached per container."""
+
+    ADD_ACTIONS = ["start", "unpause", "rename", "update"]
+    REMOVE_ACTIONS = ["die", "stop", "pause", "destroy"]
+    RECONNECT_DELAY = 5
+
+    def __init__(self, client, label, global_labels):
+        self._client = client
+        self._label = label
+        self._global_labels = global_labels
+        self._containers = {}
+        self._databases = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # Incremented on every change of the targets
+        self._version = 0
+
+        daemon = threading.Thread(name='target_registry', target=self._watch)
+        # Set as a daemon so it will be killed once the main thread is dead.
+        daemon.daemon = True
+        daemon.start()
+
+    def get_targets(self):
+        self._ready.wait()
+        with self._lock:
+            return list(self._containers.values())
+
+    def get_version(self):
+        """Returns a number, that changes whenever targets are added, changed
+        or removed."""
+        with self._lock:
+            return self._version
+
+    def get_database(self, container):
+        with self._lock:
+            database = self._databases.get(container.id)
+        if database is None:
+            database = Database(container, self._global_labels)
+            with self._lock:
+                # Only cache, if container was not removed in the meantime
+                if container.id in self._containers:
+                    self._databases[container.id] = database
+        return database
+
+    def _watch(self):
+        while True:
+            try:
+                since = datetime.datetime.now(datetime.timezone.utc)
+                self._sync()
+                self._ready.set()
+
+                events = self._client.events(
+                    since=since,
+                    filters={"type": "container", "label": self._label},
+                    decode=True,
+                )
+                for event in events:
+                    self._handle_event(event)
+            except docker.errors.DockerException as e:
+                logging.error(
+                    f"Target registry: Lost connection to docker events. Error: {e}")
+            except Exception as e:
+                logging.error(f"Target registry: Unexpected error: {e}")
+
+            time.sleep(self.RECONNECT_DELAY)
+
+    def _sync(self):
+        containers = self._client.containers.list(
+            filters={"status": "running", "label": self._label}
+        )
+        with self._lock:
+            self._containers = {x.id: x for x in containers}
+            self._databases = {
+                id: database for id, database in self._databases.items()
+                if id in self._containers
+            }
+            self._version += 1
+        logging.debug(
+            f"Target registry: Synchronized {len(containers)} target(s)")
+
+    def _handle_event(self, event):
+        action = event.get("Action", event.get("status", ""))
+        container_id = event.get("id", event.get("Actor", {}).get("ID"))
+        if container_id is None:
+            return
+
+        if action in self.ADD_ACTIONS:
+            try:
+                container = self._client.containers.get(container_id)
+            except docker.errors.NotFound:
+                return
+            with self._lock:
+                if container.status == "running":
+                    self._containers[container_id] = container
+                else:
+                    self._containers.pop(container_id, None)
+                self._databases.pop(container_id, None)
+                self._version += 1
+            logging.debug(
+                f"Target registry: Updated target {container.name} ({action})")
+        elif action in self.REMOVE_ACTIONS:
+            with self._lock:
+                container = self._containers.pop(container_id, None)
+                self._databases.pop(container_id, None)
+                if container is not None:
+                    self._version += 1
+            if container is not None:
+                logging.debug(
+                    f"Target registry: Removed target {container.name} ({action})")
@@ -0,0 +1,258 @@
+import concurrent.futures
+import datetime
+import os
+import threading
+
+import boto3
+import botocore.config
+import botocore.exceptions
+
+from src import checksum
+from src.catalog import TIMESTAMP_FORMAT, TIMESTAMPED_NAME_REGEX
+
+# Limits of S3 multipart uploads. Only the last part may be smaller.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# The part size is doubled after this many parts, so that dumps of unknown
+# size never exceed MAX_PARTS
+PART_SIZE_STEP = 1000
+DELETE_BATCH_SIZE = 1000
+
+_CLIENT_ERRORS = (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+
+
+class RemoteError(Exception):
+    pass
+
+
+class RemoteStorage:
+    """Copies dumps to an S3 compatible object storage (AWS S3, MinIO, ...).
+    Objects are named after the path of the dump inside of the dump
+    directory, so the bucket mirrors its layout."""
+
+    def __init__(self, config, dump_dir):
+        self._dump_dir = dump_dir
+        self._bucket = config.s3_bucket
+        self._prefix = config.s3_prefix
+        self._part_size = max(config.s3_part_size, MIN_PART_SIZE)
+        self._jobs = config.s3_upload_jobs
+        path_style = config.s3_path_style
+        if path_style is None:
+            # Custom endpoints (e.g. MinIO) usually have no wildcard dns
+            path_style = config.s3_endpoint_url is not None
+
+        self._client = boto3.client(
+            "s3",
+            endpoint_url=config.s3_endpoint_url,
+            region_name=config.s3_region,
+            aws_access_key_id=config.s3_access_key_id,
+            aws_secret_access_key=config.s3_secret_access_key,
+            config=botocore.config.Config(
+                s3={"addressing_style": "path" if path_style else "auto"},
+                retries={"max_attempts": 5, "mode": "standard"},
+                max_pool_connections=max(
+                    self._jobs * config.max_parallel_backups, 10),
+            ),
+        )
+
+    def get_key(self, path):
+        """Returns the object key of a file inside of the dump directory."""
+        return self._prefix + os.path.relpath(path, self._dump_dir).replace(os.sep, "/")
+
+    def open_upload(self, path, scope=None):
+        """Returns a writable stream, that uploads the written data as the
+        object of path."""
+        return MultipartUpload(
+            self._client, self._bucket, self.get_key(path), self._part_size, self._jobs, scope)
+
+    def upload_file(self, path):
+        """Uploads a small file (e.g. checksums) in a single request."""
+        try:
+            with open(path, "rb") as f:
+                self._client.put_object(
+                    Bucket=self._bucket, Key=self.get_key(path), Body=f)
+        except _CLIENT_ERRORS as e:
+            raise RemoteError(f"Upload of {os.path.basename(path)} failed: {e}") from e
+
+    def get_dumps(self, name):
+        """Returns the timestamped dumps of a dump name in the object storage
+        as (path, timestamp), newest first. Paths are relative to the dump
+        directory, like the local copies."""
+        dumps = {}
+        for key in self._list_keys(f"{self._prefix}{name}_"):
+            # Files of dump directories belong to the directory
+            dump_name = key[len(self._prefix):].partition("/")[0]
+            if checksum.is_sidecar(dump_name):
+                continue
+            match = TIMESTAMPED_NAME_REGEX.match(dump_name)
+            if match is None or match.group(1) != name:
+                continue
+            timestamp = datetime.datetime.strptime(
+                match.group(2), TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc)
+            dumps[os.path.join(self._dump_dir, dump_name)] = timestamp
+
+        return sorted(dumps.items(), reverse=True)
+
+    def remove_dump(self, path, keep=()):
+        """Removes the object of a dump together with its checksum, or all
+        objects of a dump directory except the given keys."""
+        key = self.get_key(path)
+        keys = [
+            x for x in self._list_keys(key)
+            if x in (key, checksum.get_sidecar_file(key)) or x.startswith(f"{key}/")
+        ]
+        keys = [x for x in keys if x not in keep]
+
+        try:
+            for i in range(0, len(keys), DELETE_BATCH_SIZE):
+                response = self._client.delete_objects(
+                    Bucket=self._bucket,
+                    Delete={
+                        "Objects": [{"Key": x} for x in keys[i:i + DELETE_BATCH_SIZE]],
+                        "Quiet": True,
+                    },
+                )
+                if response.get("Errors"):
+                    error = response["Errors"][0]
+                    raise RemoteError(
+                        f"Cannot delete {error['Key']}: {error['Message']}")
+        except _CLIENT_ERRORS as e:
+            raise RemoteError(f"Cannot delete {key}: {e}") from e
+
+    def _list_keys(self, prefix):
+        try:
+            paginator = self._client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+                for item in page.get("Contents", []):
+                    yield item["Key"]
+        except _CLIENT_ERRORS as e:
+            raise RemoteError(f"Cannot list objects: {e}") from e
+
+
+class MultipartUpload:
+    """Writable stream, that uploads the written data in parts while it is
+    written. Up to `jobs` parts are uploaded at the same time. Writes block
+    while all of them are in flight, so memory is bounded by about
+    (jobs + 1) * part_size.
+
+    Errors of the upload do not interrupt the writer, as the local dump is
+    still valid. The upload stops and complete() raises the error."""
+
+    def __init__(self, client, bucket, key, part_size, jobs, scope=None):
+        self._client = client
+        self._bucket = bucket
+        self.key = key
+        self._part_size = part_size
+        self._scope = scope
+        self._slots = threading.Semaphore(jobs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs,
+            thread_name_prefix=f"{threading.current_thread().name}_upload",
+        )
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._futures = []
+        self._error = None
+        self._closed = False
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        if self._error is None:
+            self._buffer += data
+            while len(self._buffer) >= self._get_part_size() and self._error is None:
+                part_size = self._get_part_size()
+                self._submit(bytes(self._buffer[:part_size]))
+                del self._buffer[:part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def complete(self):
+        """Uploads the remaining data and completes the upload. Raises
+        RemoteError, if the upload failed."""
+        try:
+            if self._error is None and self._upload_id is None:
+                # Small dumps are uploaded in a single request
+                self._client.put_object(
+                    Bucket=self._bucket, Key=self.key, Body=bytes(self._buffer))
+            elif self._error is None:
+                if len(self._buffer) > 0:
+                    self._submit(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                if self._error is None:
+                    self._client.complete_multipart_upload(
+                        Bucket=self._bucket,
+                        Key=self.key,
+                        UploadId=self._upload_id,
+                        MultipartUpload={"Parts": parts},
+                    )
+        except _CLIENT_ERRORS as e:
+            self._error = e
+        self._buffer = bytearray()
+
+        if self._error is not None:
+            self.abort()
+            raise RemoteError(f"Upload of {self.key} failed: {self._error}")
+        self._close()
+
+    def abort(self):
+        """Stops the upload and removes the uploaded parts."""
+        self._close()
+        if self._upload_id is not None:
+            try:
+                self._client.abort_multipart_upload(
+                    Bucket=self._bucket, Key=self.key, UploadId=self._upload_id)
+            except _CLIENT_ERRORS:
+                # Incomplete uploads can also be removed by a lifecycle rule
+                pass
+            self._upload_id = None
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._executor.shutdown(cancel_futures=True)
+
+    def _get_part_size(self):
+        return self._part_size * 2 ** (len(self._futures) // PART_SIZE_STEP)
+
+    def _submit(self, data):
+        # Wait for a free slot, but stop if the backup was cancelled
+        while not self._slots.acquire(timeout=1):
+            if self._scope is not None:
+                self._scope.check()
+
+        try:
+            if self._upload_id is None:
+                self._upload_id = self._client.create_multipart_upload(
+                    Bucket=self._bucket, Key=self.key)["UploadId"]
+        except _CLIENT_ERRORS as e:
+            self._error = e
+            self._slots.release()
+            return
+
+        part_number = len(self._futures) + 1
+        if part_number > MAX_PARTS:
+            self._error = RemoteError("Too many parts")
+            self._slots.release()
+            return
+        self._futures.append(self._executor.submit(
+            self._upload_part, part_number, data))
+
+    def _upload_part(self, part_number, data):
+        try:
+            response = self._client.upload_part(
+                Bucket=self._bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+            return {"ETag": response["ETag"], "PartNumber": part_number}
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            return None
+        finally:
+            self._slots.release()
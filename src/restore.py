@@ -0,0 +1,650 @@
+import concurrent.futures
+import datetime
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import time
+import urllib.parse
+
+import humanize
+import pyAesCrypt
+
+from src import checksum, chunked, compression, continuous, dedup
+from src.catalog import PLAIN_NAME_REGEX, TIMESTAMPED_NAME_REGEX
+from src.database import DatabaseType
+from src.docker import ExecProcess
+from src.pipeline import (BUFFER_SIZE, ChildProcess, CountingReader, FilterProcess, PipelineError, ProducerThread,
+                          StderrCollector)
+
+# Host of the database, as the client runs inside of the target container
+TARGET_HOST = "localhost"
+GLOBALS_NAME = "_globals"
+
+# Start of the statements of a database in dumps of all databases
+DATABASE_MARKERS = [
+    re.compile(rb"^-- Current Database: `(?P<name>.+)`$"),  # mysqldump
+    re.compile(rb'^-- Database "(?P<name>.+)" dump$'),  # pg_dumpall
+]
+# Start of the statements of a single object (table, view, ...)
+OBJECT_MARKERS = [
+    re.compile(
+        rb"^-- (?:Table structure|Dumping data) for table `(?P<name>.+)`$"),
+    re.compile(
+        rb"^-- (?:Temporary view structure|Final view structure) for view `(?P<name>.+)`$"),
+    re.compile(rb"^-- Dumping (?:events|routines) for database"),
+    re.compile(
+        rb"^-- (?:Data for )?Name: (?P<name>.+?); Type: (?P<type>.+?); Schema: (?P<schema>[^;]*)"),
+]
+# Postgres objects, that are always kept (e.g. to connect to the database)
+KEPT_TYPES = [b"DATABASE", b"DATABASE PROPERTIES"]
+# Lines in the head of a dump, that are searched for the binary log position
+HEADER_LINES = 100
+# Directory inside of a restored data directory, that holds the WAL for the
+# recovery
+WAL_ARCHIVE_DIR = "pg_wal_archive"
+
+
+class RestoreError(Exception):
+    pass
+
+
+class SqlFilter:
+    """Selects the statements of a single database and/or table from a plain
+    SQL dump, while it is streamed. Sections are detected by the comments,
+    that mysqldump and pg_dump write in front of each database and object.
+    Statements in front of the first section (e.g. settings) are kept, unless
+    header is False. The database GLOBALS_NAME selects only them."""
+
+    def __init__(self, stream, database=None, table=None, header=True):
+        self._stream = stream
+        self._database = database.encode() if database is not None else None
+        self._table = table.encode() if table is not None else None
+        self._header = header
+        self._lines = self._filter()
+        self._buffer = bytearray()
+        self.database_found = database == GLOBALS_NAME
+        self.table_found = False
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _filter(self):
+        database_selected = self._header
+        object_selected = True
+        line_start = True
+
+        for line in iter(lambda: self._stream.readline(BUFFER_SIZE), b""):
+            # Long lines (e.g. extended inserts) are read in parts
+            if line_start and line.startswith(b"-- "):
+                marker = line.rstrip(b"\r\n")
+                name = self._match(DATABASE_MARKERS, marker)
+                if name is not None and self._database is not None:
+                    database_selected = name.group("name") == self._database
+                    self.database_found |= database_selected
+                    object_selected = True
+                elif name is None and self._table is not None:
+                    match = self._match(OBJECT_MARKERS, marker)
+                    if match is not None:
+                        object_selected = self._is_selected(match)
+                        self.table_found |= object_selected and database_selected
+
+            line_start = line.endswith(b"\n")
+            if database_selected and object_selected:
+                yield line
+
+    def _match(self, markers, line):
+        for marker in markers:
+            match = marker.match(line)
+            if match is not None:
+                return match
+        return None
+
+    def _is_selected(self, match):
+        groups = match.groupdict()
+        if groups.get("name") is None:
+            return False
+        if groups.get("type") in KEPT_TYPES:
+            return True
+
+        schema, _, table = self._table.rpartition(b".")
+        if len(schema) > 0 and groups.get("schema") not in (None, schema):
+            return False
+        # Constraints, defaults and triggers are named after their table
+        name = groups["name"]
+        return name == table or name.startswith(table + b" ")
+
+
+class ArtifactReader:
+    """Streams the plain SQL of a dump file or deduplicated dump. Decryption
+    runs in a background thread and decompression in a child process, so no
+    plaintext is written to disk."""
+
+    def __init__(self, path, encryption_key=None):
+        self._file = None
+        self._producer = None
+        self._filter = None
+
+        if path.endswith(f".{dedup.MANIFEST_EXTENSION}"):
+            repository = dedup.DedupRepository(
+                os.path.dirname(os.path.abspath(path)))
+            self._producer = ProducerThread(
+                lambda output: repository.restore(path, output, encryption_key))
+            stream = self._producer.stdout
+        else:
+            self._file = open(path, "rb")
+            stream = self._file
+            if path.endswith(".aes"):
+                if not encryption_key:
+                    self._file.close()
+                    raise RestoreError("Dump is encrypted, but no key given")
+                source = stream
+                self._producer = ProducerThread(
+                    lambda output: pyAesCrypt.decryptStream(
+                        source, output, encryption_key, BUFFER_SIZE))
+                stream = self._producer.stdout
+
+            algorithm = compression.detect_algorithm(path)
+            if algorithm is not None:
+                self._filter = FilterProcess(
+                    compression.get_decompress_command(algorithm), stream)
+                stream = self._filter.stdout
+
+        self.stdout = stream
+
+    def wait(self):
+        """Waits for all stages. Errors of earlier stages are raised first, as
+        they cause the errors of later stages."""
+        filter_error = None
+        try:
+            if self._filter is not None:
+                try:
+                    self._filter.wait()
+                except PipelineError as e:
+                    filter_error = e
+            if self._producer is not None:
+                self._producer.wait()
+            if filter_error is not None:
+                raise filter_error
+        finally:
+            if self._file is not None:
+                self._file.close()
+
+    def kill(self):
+        if self._filter is not None:
+            self._filter.kill()
+        if self._producer is not None:
+            self._producer.kill()
+        if self._file is not None:
+            self._file.close()
+
+
+class LogReader:
+    """Streams the output of a local command, e.g. the SQL of binary logs,
+    that are decoded by mysqlbinlog."""
+
+    def __init__(self, command, env=None):
+        self._process = ChildProcess(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        self._stderr = StderrCollector(self._process.stderr)
+        self.stdout = self._process.stdout
+
+    def wait(self):
+        returncode = self._process.wait()
+        self._stderr.join()
+        if returncode != 0:
+            raise PipelineError(
+                "Error while reading the logs", returncode, self._stderr.text)
+
+    def kill(self):
+        self._process.kill()
+        self._process.wait()
+
+
+class Restore:
+    """Loads dumps into a database container. The SQL is streamed from the
+    dump through decryption and decompression directly into the database
+    client, which runs inside of the container through the docker exec api.
+    Databases of the per_database dump layout, chunks of the chunked dump
+    layout and the databases of single dump files are loaded in parallel. Dumps of continuous backups of MySQL and
+    MariaDB can be rolled forward to a point in time with the streamed
+    binary logs."""
+
+    def __init__(self, client, container, database, jobs=4, encryption_key=None):
+        self._client = client
+        self._container = container
+        self._database = database
+        self._jobs = max(jobs, 1)
+        self._encryption_key = encryption_key or database.encryption_key
+
+    def run(self, artifact, database_name=None, table=None, until=None, log_dir=None):
+        """Restores the given dump. If database_name is given, only this
+        database is restored. If table is also given, only this table of the
+        database is restored. If until (datetime) is given, the binary logs
+        in log_dir (default: the log directory next to the dump) are
+        replayed up to this time."""
+        if table is not None and database_name is None:
+            raise RestoreError("A table can only be restored together with its database")
+
+        position = None
+        if until is not None:
+            if self._database.type == DatabaseType.postgres:
+                raise RestoreError(
+                    "Base backups of Postgres are restored into a directory (--target-dir)")
+            if table is not None:
+                raise RestoreError(
+                    "A single table cannot be restored to a point in time")
+            # Fail before anything is loaded
+            position = self._get_binlog_position(artifact)
+            log_dir = log_dir or get_log_dir(artifact, self._database.type)
+            files = continuous.list_log_files(log_dir)
+            if position["file"] not in files:
+                raise RestoreError(
+                    f"Binary log {position['file']} of the dump not found in {log_dir}")
+
+        if os.path.isdir(artifact):
+            self._restore_directory(artifact, database_name, table)
+        elif database_name is None:
+            self._restore_file(artifact)
+        else:
+            self._load(artifact, database_name, table)
+
+        if position is not None:
+            self._replay_binlog(log_dir, files, position, until, database_name)
+
+    def _get_binlog_position(self, artifact):
+        """Returns the binary log position, at which the dump was taken."""
+        position = None
+        if os.path.isdir(artifact):
+            manifest_file = os.path.join(artifact, chunked.MANIFEST_FILE)
+            if os.path.exists(manifest_file):
+                position = chunked.read_manifest(manifest_file)["binlog_position"]
+        else:
+            reader = ArtifactReader(artifact, self._encryption_key)
+            try:
+                for _ in range(HEADER_LINES):
+                    match = continuous.BINLOG_POSITION_REGEX.match(
+                        reader.stdout.readline(BUFFER_SIZE))
+                    if match is not None:
+                        position = {
+                            "file": match.group("file").decode(),
+                            "position": int(match.group("position")),
+                        }
+                        break
+            finally:
+                reader.kill()
+
+        if position is None:
+            raise RestoreError(
+                "Dump contains no binary log position. Only dumps of continuous backups "
+                "can be restored to a point in time.")
+        return position
+
+    def _replay_binlog(self, log_dir, files, position, until, database_name=None):
+        """Loads the changes from the binary log position on, until the given
+        time. The logs are decoded by the local mysqlbinlog."""
+        files = files[files.index(position["file"]):]
+        logging.info(
+            f"Replaying {len(files)} binary logs from {position['file']}:{position['position']} "
+            f"until {until.isoformat()}")
+        # The start position applies to the first file
+        command = (
+            f"mysqlbinlog"
+            f" --start-position={position['position']}"
+            f' --stop-datetime="{until.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")}"'
+        )
+        if database_name is not None:
+            command += f" --database={shlex.quote(database_name)}"
+        command += "".join(
+            f" {shlex.quote(os.path.join(log_dir, x))}" for x in files)
+        env = os.environ.copy()
+        # Times of the command are local times
+        env["TZ"] = "UTC"
+        self._load(os.path.join(log_dir, files[0]),
+                   reader=LogReader(command, env))
+
+    def _restore_directory(self, artifact, database_name, table):
+        if os.path.exists(os.path.join(artifact, chunked.MANIFEST_FILE)):
+            self._restore_chunked(artifact, database_name, table)
+            return
+
+        files = {}
+        for entry in sorted(os.scandir(artifact), key=lambda x: x.name):
+            if entry.name == checksum.SUMS_FILE:
+                continue
+            name = urllib.parse.unquote(entry.name.partition(".sql")[0])
+            files[name] = entry.path
+
+        if database_name is not None:
+            if database_name not in files:
+                raise RestoreError(
+                    f"Database {database_name} not found in dump. Available: {', '.join(sorted(files))}")
+            # The file only contains the selected database
+            self._load(files[database_name], table=table)
+            return
+
+        # Roles must exist before the databases are restored
+        if GLOBALS_NAME in files:
+            self._load(files.pop(GLOBALS_NAME))
+
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs,
+            thread_name_prefix="restore",
+        ) as executor:
+            futures = {
+                name: executor.submit(self._load, path)
+                for name, path in files.items()
+            }
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Restore of {name} failed: {e}")
+                    failed.append(name)
+
+        if failed:
+            raise RestoreError(
+                f"{len(failed)}/{len(files)} databases failed: {', '.join(failed)}")
+
+    def _restore_file(self, artifact):
+        """Restores a single dump file. The databases of a dump of all
+        databases are loaded in parallel: Each worker streams the whole file
+        and selects its database, so no plaintext is buffered or written to
+        disk."""
+        names = self._list_databases(artifact) if self._jobs > 1 else []
+        if len(names) < 2:
+            self._load(artifact)
+            return
+
+        # Statements in front of the first database are loaded once (e.g. the
+        # roles of pg_dumpall). Those of mysqldump only hold session settings,
+        # which every connection needs.
+        header = self._database.type != DatabaseType.postgres
+        if not header:
+            self._load(artifact, GLOBALS_NAME)
+
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs,
+            thread_name_prefix="restore",
+        ) as executor:
+            futures = {
+                name: executor.submit(self._load, artifact, name, header=header)
+                for name in names
+            }
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Restore of {name} failed: {e}")
+                    failed.append(name)
+
+        if failed:
+            raise RestoreError(
+                f"{len(failed)}/{len(names)} databases failed: {', '.join(failed)}")
+
+    def _list_databases(self, artifact):
+        """Returns the names of the databases in a dump file in their
+        order."""
+        names = []
+        reader = ArtifactReader(artifact, self._encryption_key)
+        try:
+            line_start = True
+            for line in iter(lambda: reader.stdout.readline(BUFFER_SIZE), b""):
+                if line_start and line.startswith(b"-- "):
+                    for marker in DATABASE_MARKERS:
+                        match = marker.match(line.rstrip(b"\r\n"))
+                        if match is not None:
+                            names.append(match.group("name").decode())
+                            break
+                line_start = line.endswith(b"\n")
+            reader.wait()
+        except BaseException:
+            reader.kill()
+            raise
+        return names
+
+    def _restore_chunked(self, artifact, database_name, table):
+        """Restores a dump of the chunked layout. The schemas are created
+        first, then the chunks are loaded in parallel. Triggers are created
+        last, so that they do not fire for the loaded rows. They are not
+        restored together with a single table."""
+        manifest = chunked.read_manifest(
+            os.path.join(artifact, chunked.MANIFEST_FILE))
+        databases = manifest["databases"]
+        if database_name is not None:
+            databases = [x for x in databases if x["name"] == database_name]
+            if len(databases) == 0:
+                raise RestoreError(
+                    f"Database {database_name} not found in dump. Available: "
+                    f"{', '.join(x['name'] for x in manifest['databases'])}")
+
+        for item in databases:
+            self._load(os.path.join(artifact, item["schema"]),
+                       database_name, table)
+
+        chunks = [
+            chunk
+            for item in databases
+            for x in item["tables"] if table is None or x["name"] == table
+            for chunk in x["chunks"]
+        ]
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs,
+            thread_name_prefix="restore",
+        ) as executor:
+            futures = {
+                name: executor.submit(self._load, os.path.join(artifact, name))
+                for name in chunks
+            }
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Restore of {name} failed: {e}")
+                    failed.append(name)
+
+        if failed:
+            raise RestoreError(
+                f"{len(failed)}/{len(chunks)} chunks failed: {', '.join(failed)}")
+
+        if table is None:
+            for item in databases:
+                self._load(os.path.join(artifact, item["triggers"]))
+
+    def _load(self, path, database_name=None, table=None, reader=None, header=True):
+        """Streams a single dump file (or the output of the given reader)
+        into the database client. Only the given database and table are
+        loaded, if given. header tells, if the statements in front of the
+        first database are loaded with them."""
+        start = time.monotonic()
+        command, environment = self._get_load_command()
+        reader = reader or ArtifactReader(path, self._encryption_key)
+        try:
+            loader = ExecProcess(
+                self._client, self._container, command, environment, stdin=True)
+        except BaseException:
+            reader.kill()
+            raise
+        # The output of the client is not needed. Only its end is kept.
+        stdout = StderrCollector(loader.stdout)
+        stderr = StderrCollector(loader.stderr)
+
+        try:
+            source = CountingReader(reader.stdout)
+            stream = source
+            if database_name is not None or table is not None:
+                stream = SqlFilter(source, database_name, table, header)
+
+            try:
+                shutil.copyfileobj(stream, loader.stdin, BUFFER_SIZE)
+                loader.stdin.close()
+                reader.wait()
+            except ConnectionError:
+                # Client terminated early. Its return code tells why.
+                reader.kill()
+            returncode = loader.wait()
+            stdout.join()
+            stderr.join()
+            if returncode != 0:
+                raise PipelineError(
+                    "Error while loading dump", returncode, stderr.text)
+        except BaseException:
+            loader.kill()
+            loader.wait()
+            reader.kill()
+            raise
+
+        if stream is not source and database_name is not None and not stream.database_found:
+            raise RestoreError(f"Database {database_name} not found in dump")
+        if stream is not source and table is not None and not stream.table_found:
+            raise RestoreError(f"Table {table} not found in dump")
+        name = os.path.basename(path)
+        if database_name is not None:
+            name += f" ({database_name})"
+        if len(stderr.text) > 0:
+            logging.warning(
+                f"Output of the database client for {name}:\n{stderr.text}")
+
+        logging.info(
+            f"Restored {name} ({humanize.naturalsize(source.bytes)} "
+            f"in {time.monotonic() - start:.1f}s)")
+
+    def _get_load_command(self):
+        """Returns the shell command of the database client, that executes
+        the statements from stdin, and the environment to run it with."""
+        database = self._database
+        environment = {}
+
+        if (
+            database.type == DatabaseType.mysql
+            or database.type == DatabaseType.mariadb
+        ):
+            command = (
+                f"mysql"
+                f' --host="{TARGET_HOST}"'
+                f' --user="{database.username}"'
+                f' --password="{database.password}"'
+                f' {"--skip-ssl" if database.skip_ssl else ""}'
+            )
+        elif database.type == DatabaseType.postgres:
+            environment["PGPASSWORD"] = database.password
+            command = (
+                f"psql"
+                f' --host="{TARGET_HOST}"'
+                f' --username="{database.username}"'
+                f" --dbname=postgres --quiet --no-psqlrc"
+            )
+        else:
+            raise RestoreError(
+                "Cannot resolve database type. Please specify via label.")
+
+        return command, environment
+
+
+class BaseBackupRestore:
+    """Extracts a base backup of a continuous Postgres backup into a data
+    directory and prepares its recovery. The streamed WAL is copied next to
+    it, so that Postgres replays it up to the given time, once it is started
+    on the directory."""
+
+    def __init__(self, encryption_key=None):
+        self._encryption_key = encryption_key
+
+    def run(self, artifact, target_dir, until=None, wal_dir=None):
+        wal_dir = wal_dir or get_log_dir(artifact, DatabaseType.postgres)
+        if not os.path.isdir(wal_dir):
+            raise RestoreError(f"WAL directory {wal_dir} not found")
+        os.makedirs(target_dir, exist_ok=True)
+        if len(os.listdir(target_dir)) > 0:
+            raise RestoreError(f"Target directory {target_dir} is not empty")
+        # Postgres refuses data directories, that others can access
+        os.chmod(target_dir, 0o700)
+
+        start = time.monotonic()
+        reader = ArtifactReader(artifact, self._encryption_key)
+        extract = FilterProcess(f"tar -x -C {shlex.quote(target_dir)}", reader.stdout)
+        try:
+            extract.stdout.read()
+            extract.wait()
+            reader.wait()
+        except BaseException:
+            extract.kill()
+            reader.kill()
+            raise
+        logging.info(
+            f"Extracted {os.path.basename(artifact)} ({time.monotonic() - start:.1f}s)")
+
+        label_file = os.path.join(target_dir, "backup_label")
+        if not os.path.exists(label_file):
+            raise RestoreError("Dump is not a base backup (backup_label is missing)")
+        with open(label_file, "rb") as f:
+            match = continuous.BACKUP_LABEL_REGEX.search(f.read())
+        if match is None:
+            raise RestoreError("Cannot read the start of the base backup from backup_label")
+        start_segment = match.group("segment").decode()
+
+        copied = self._copy_wal(wal_dir, os.path.join(target_dir, WAL_ARCHIVE_DIR), start_segment)
+        logging.info(f"Copied {copied} WAL files from {start_segment} on")
+
+        with open(os.path.join(target_dir, "postgresql.auto.conf"), "a") as f:
+            f.write("\n# Point-in-time recovery from the streamed WAL\n")
+            f.write(f"restore_command = 'cp {WAL_ARCHIVE_DIR}/%f \"%p\"'\n")
+            if until is not None:
+                f.write(f"recovery_target_time = '{until.isoformat(sep=' ')}'\n")
+            f.write("recovery_target_action = 'promote'\n")
+        open(os.path.join(target_dir, "recovery.signal"), "w").close()
+
+    def _copy_wal(self, wal_dir, archive_dir, start_segment):
+        """Copies the timeline history and the segments from start_segment
+        on (of any timeline). The segment, that was streamed last, is
+        incomplete and copied without its suffix."""
+        os.makedirs(archive_dir)
+        copied = 0
+        for name in continuous.list_log_files(wal_dir):
+            target_name = name.removesuffix(continuous.PARTIAL_SUFFIX)
+            if not target_name.endswith(continuous.HISTORY_SUFFIX) and not (
+                    continuous.WAL_SEGMENT_REGEX.match(target_name) and target_name[8:] >= start_segment[8:]):
+                continue
+            target_file = os.path.join(archive_dir, target_name)
+            # Complete segments are sorted in front of the incomplete one
+            if os.path.exists(target_file):
+                continue
+            shutil.copyfile(os.path.join(wal_dir, name), target_file)
+            copied += 1
+        return copied
+
+
+def is_base_backup(artifact):
+    """Returns, if the dump is a base backup of a continuous Postgres
+    backup."""
+    return "tar" in os.path.basename(artifact).split(".")[1:]
+
+
+def get_log_dir(artifact, type):
+    """Returns the log directory of a continuous backup, which is stored
+    next to its dumps."""
+    file_name = os.path.basename(os.path.normpath(artifact))
+    match = TIMESTAMPED_NAME_REGEX.match(file_name) or PLAIN_NAME_REGEX.match(file_name)
+    if match is None:
+        raise RestoreError(f"Cannot derive the name of the backup from {file_name}")
+    return continuous.get_log_dir(
+        os.path.dirname(os.path.abspath(artifact)), match.group(1), type)
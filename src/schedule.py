@@ -12,23 +12,23 @@ class ScheduleMode(Enum):
 
 
 class Schedule:
-    def __init__(self, config):
+    def __init__(self, schedule, run_at_startup=None, schedule_hash_id=None):
         self._startup_run_done = False
 
-        if config.schedule is None:
+        if schedule is None:
             self.mode = ScheduleMode.once
             self.run_at_startup = True
         else:
             try:
-                self.interval = int(config.schedule)
+                self.interval = int(schedule)
                 self.cron = None
                 self.mode = ScheduleMode.interval
-                self.run_at_startup = config.run_at_startup if config.run_at_startup is not None else True
+                self.run_at_startup = run_at_startup if run_at_startup is not None else True
             except ValueError:
                 self.interval = None
-                self.cron = config.schedule
+                self.cron = schedule
                 self.mode = ScheduleMode.cron
-                self.run_at_startup = config.run_at_startup if config.run_at_startup is not None else False
+                self.run_at_startup = run_at_startup if run_at_startup is not None else False
 
         if self.mode == ScheduleMode.interval:
             if self.interval <= 0:
@@ -36,24 +36,29 @@ class Schedule:
 
         if self.mode == ScheduleMode.cron:
             self.schedule_hash_id = str.encode(
-                config.schedule_hash_id if config.schedule_hash_id is not None else socket.getfqdn())
+                schedule_hash_id if schedule_hash_id is not None else socket.getfqdn())
 
             if not croniter.is_valid(self.cron, hash_id=self.schedule_hash_id):
                 raise ValueError("Invalid cron expression!")
 
-    def get_next(self):
+    def get_next(self, after=None):
+        """Returns the time of the next run after the given time (default:
+        now), or None if there is none."""
         now = datetime.datetime.now()
 
         if self.run_at_startup and not self._startup_run_done:
             self._startup_run_done = True
             return now
 
+        if after is None:
+            after = now
+
         if self.mode == ScheduleMode.once:
             return None
         elif self.mode == ScheduleMode.interval:
-            return now + datetime.timedelta(seconds=self.interval)
+            return after + datetime.timedelta(seconds=self.interval)
         elif self.mode == ScheduleMode.cron:
-            cron = croniter(self.cron, now, hash_id=self.schedule_hash_id)
+            cron = croniter(self.cron, after, hash_id=self.schedule_hash_id)
             return cron.get_next(datetime.datetime)
 
     def get_humanized_schedule(self):
@@ -0,0 +1,291 @@
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import socket
+import time
+
+import docker
+import requests
+import tempora
+
+from src.database import OverlapPolicy
+from src.schedule import Schedule
+
+
+class Job:
+    """Scheduled backup of one target, or of all targets without an own
+    schedule (global job)."""
+
+    def __init__(self, name, schedule, overlap, jitter, expression=None):
+        self.name = name
+        self.schedule = schedule
+        self.overlap = overlap
+        self.jitter = jitter
+        self.expression = expression
+        self.container = None
+        # Planned time of the next run (without jitter)
+        self.planned = None
+        # Sequence number of the valid queue entry
+        self.sequence = None
+
+
+class Scheduler:
+    """Runs backups according to the global schedule and the schedules of
+    single targets (`schedule` label). The next runs of all jobs are kept in a
+    priority queue. Jobs that are due at the same time are backed up in one
+    cycle. Cycles do not overlap, so runs that become due during a cycle are
+    handled by the overlap policy of their job. The optional verification
+    of the dump directory runs after the backups, that are due at the same
+    time."""
+
+    GLOBAL_JOB = "_global"
+    VERIFY_JOB = "_verify"
+    # Interval to check for changed targets (docker events) while waiting.
+    # Without docker events, the targets are only listed before due runs.
+    REFRESH_INTERVAL = 60
+    MAX_QUEUED_RUNS = 10
+
+    def __init__(self, config, global_labels, backup, metrics, verifier=None):
+        self._config = config
+        self._backup = backup
+        self._metrics = metrics
+        self._verifier = verifier
+        self._queue = []
+        self._sequence = itertools.count()
+        self._global_targets = []
+        # Version of the targets, that the jobs were created from
+        self._targets_version = None
+        self._last_run_end = None
+        self._idle_since = time.monotonic()
+
+        self._global_schedule = Schedule(
+            config.schedule, config.run_at_startup, config.schedule_hash_id)
+        self._jobs = {
+            self.GLOBAL_JOB: Job(
+                "global",
+                self._global_schedule,
+                OverlapPolicy[global_labels["schedule_overlap"]],
+                tempora.parse_timedelta(global_labels["schedule_jitter"]),
+            )
+        }
+        self._plan(self._jobs[self.GLOBAL_JOB],
+                   self._global_schedule.get_next())
+
+        if verifier is not None:
+            schedule = Schedule(config.verify_schedule, False,
+                                config.schedule_hash_id)
+            self._jobs[self.VERIFY_JOB] = Job(
+                "verify", schedule, OverlapPolicy.coalesce, datetime.timedelta(), config.verify_schedule)
+            logging.info(
+                f"Verification schedule: {schedule.get_humanized_schedule()}")
+            self._plan(self._jobs[self.VERIFY_JOB], schedule.get_next())
+
+    def get_humanized_schedule(self):
+        return self._global_schedule.get_humanized_schedule()
+
+    def run(self):
+        """Runs the scheduled backups. Returns, once no further runs are
+        planned."""
+        self._refresh_jobs()
+        refreshed = True
+        while True:
+            # Drop entries of removed or rescheduled jobs
+            while len(self._queue) > 0 and not self._is_valid(self._queue[0]):
+                heapq.heappop(self._queue)
+            if len(self._queue) == 0:
+                return
+
+            diff = (self._queue[0][0] - datetime.datetime.now()).total_seconds()
+            if diff > 0:
+                time.sleep(min(diff, self.REFRESH_INTERVAL))
+                if self._backup.get_targets_version() != self._targets_version:
+                    self._refresh_jobs()
+                continue
+
+            if not refreshed:
+                # Pick up changed targets before the due runs
+                self._refresh_jobs()
+                refreshed = True
+                continue
+
+            self._run_due_jobs()
+            refreshed = False
+
+    def _refresh_jobs(self):
+        """Creates, updates and removes the jobs of targets with an own
+        schedule. The log streaming of continuous targets is updated
+        alongside. If the targets cannot be listed, the current jobs are
+        kept."""
+        global_targets = []
+        target_ids = set()
+
+        version = self._backup.get_targets_version()
+        try:
+            containers = self._backup.get_targets()
+            self._backup.update_streams(containers)
+        except (docker.errors.DockerException, requests.RequestException) as e:
+            logging.error(
+                f"Cannot refresh the targets, keeping the current schedules. Error: {e}")
+            return
+        self._targets_version = version
+        for container in containers:
+            database = self._backup.get_database(container)
+            if len(database.schedule) == 0:
+                global_targets.append(container)
+                continue
+
+            job = self._jobs.get(container.id)
+            if job is None or (job.expression, job.overlap, job.jitter) != (
+                    database.schedule, database.schedule_overlap, database.schedule_jitter):
+                try:
+                    # Spread hashed cron expressions between targets
+                    schedule = Schedule(
+                        database.schedule,
+                        schedule_hash_id=f"{self._config.schedule_hash_id or socket.getfqdn()}/{container.name}",
+                    )
+                except ValueError as e:
+                    logging.error(
+                        f"Invalid schedule of container {container.name}: {e}")
+                    continue
+                job = Job(
+                    container.name,
+                    schedule,
+                    database.schedule_overlap,
+                    database.schedule_jitter,
+                    database.schedule,
+                )
+                self._jobs[container.id] = job
+                logging.info(
+                    f"Schedule of {job.name}: {schedule.get_humanized_schedule()}")
+                self._plan(job, schedule.get_next())
+
+            job.container = container
+            target_ids.add(container.id)
+
+        for key in list(self._jobs.keys()):
+            if key not in (self.GLOBAL_JOB, self.VERIFY_JOB) and key not in target_ids:
+                logging.info(
+                    f"Removed schedule of {self._jobs[key].name}")
+                del self._jobs[key]
+
+        self._global_targets = global_targets
+
+    def _run_due_jobs(self):
+        now = datetime.datetime.now()
+
+        due_jobs = []
+        while len(self._queue) > 0 and self._queue[0][0] <= now:
+            entry = heapq.heappop(self._queue)
+            if self._is_valid(entry):
+                due_jobs.append((entry[0], entry[2]))
+
+        run_jobs = []
+        for run_time, job in due_jobs:
+            # Run became due, while the previous cycle was running
+            overlapped = self._last_run_end is not None and run_time < self._last_run_end
+
+            if job.overlap == OverlapPolicy.queue:
+                # Every missed run is done, one after another
+                next_run = job.schedule.get_next(job.planned)
+                missed = self._get_missed_runs(job, next_run, now)
+                if len(missed) > self.MAX_QUEUED_RUNS:
+                    next_run = missed[-self.MAX_QUEUED_RUNS]
+                self._plan(job, next_run)
+                run_jobs.append(job)
+                continue
+
+            missed = self._get_missed_runs(job, job.planned, now)
+            self._plan(job, self._get_next_after(job, now))
+
+            if overlapped and job.overlap == OverlapPolicy.skip:
+                logging.info(
+                    f"Skipped run of {job.name}, because it overlapped with the previous backup cycle")
+                self._metrics.increment(
+                    'scheduler_skipped_runs_total', {"job": job.name})
+                continue
+            if len(missed) > 1:
+                logging.info(
+                    f"Coalesced {len(missed)} runs of {job.name} into one")
+                self._metrics.increment(
+                    'scheduler_coalesced_runs_total', {"job": job.name}, len(missed) - 1)
+            run_jobs.append(job)
+
+        if len(run_jobs) == 0:
+            self._metrics.flush_metrics()
+            return
+
+        idle_seconds = time.monotonic() - self._idle_since
+        logging.debug(f"Scheduler was idle for {idle_seconds:.1f} seconds")
+        self._metrics.increment('scheduler_idle_seconds_total', value=idle_seconds)
+        start = time.monotonic()
+
+        verify_job = self._jobs.get(self.VERIFY_JOB)
+        backup_jobs = [x for x in run_jobs if x is not verify_job]
+        if len(backup_jobs) > 0:
+            try:
+                if all(key in (self.GLOBAL_JOB, self.VERIFY_JOB) for key in self._jobs):
+                    # No target has its own schedule
+                    self._backup.run()
+                else:
+                    containers = [
+                        x.container for x in backup_jobs if x.container is not None]
+                    if self._jobs[self.GLOBAL_JOB] in backup_jobs:
+                        containers = self._global_targets + containers
+                    self._backup.run(containers)
+            except Exception:
+                # The next runs are planned already, so the schedules continue
+                logging.exception("Backup cycle failed with an unexpected error")
+                self._metrics.increment(
+                    'scheduler_failed_runs_total', {"job": "backup"})
+
+        if verify_job is not None and verify_job in run_jobs:
+            try:
+                self._verifier.run()
+            except Exception:
+                logging.exception("Verification failed with an unexpected error")
+                self._metrics.increment(
+                    'scheduler_failed_runs_total', {"job": verify_job.name})
+
+        self._last_run_end = datetime.datetime.now()
+        self._idle_since = time.monotonic()
+        self._metrics.increment(
+            'scheduler_busy_seconds_total', value=self._idle_since - start)
+
+    def _plan(self, job, next_run):
+        job.planned = next_run
+        job.sequence = next(self._sequence)
+        if next_run is None:
+            return
+
+        run_time = next_run + datetime.timedelta(
+            seconds=random.uniform(0, job.jitter.total_seconds()))
+        heapq.heappush(self._queue, (run_time, job.sequence, job))
+        if job.expression is None:
+            logging.info(
+                f"Scheduled next run at {run_time.strftime('%Y-%m-%d %H:%M:%S')}..")
+        else:
+            logging.info(
+                f"Scheduled next run of {job.name} at {run_time.strftime('%Y-%m-%d %H:%M:%S')}..")
+
+    def _is_valid(self, entry):
+        job = entry[2]
+        return job.sequence == entry[1] and any(x is job for x in self._jobs.values())
+
+    def _get_missed_runs(self, job, planned, now):
+        """Returns the planned runs of a job until now, starting at
+        planned."""
+        missed = []
+        while planned is not None and planned <= now:
+            missed.append(planned)
+            planned = job.schedule.get_next(planned)
+        return missed
+
+    def _get_next_after(self, job, now):
+        """Returns the next planned run of a job after now, so that runs stay
+        aligned to the schedule (e.g. intervals do not drift)."""
+        next_run = job.planned
+        while next_run is not None and next_run <= now:
+            next_run = job.schedule.get_next(next_run)
+        return next_run
@@ -1,9 +1,15 @@
 import logging
 import os
+import re
 import distutils.util
 
+import tempora
+
 LABEL_PREFIX = "jan-di.database-backup."
 
+SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
 CONFIG_DEFAULTS = {
     "schedule": None,
     "schedule_hash_id": None,
@@ -17,8 +23,28 @@ CONFIG_DEFAULTS = {
     "healthchecks_io_url": None,
     "openmetrics_enable": "false",
     "openmetrics_port": "9639",
+    "openmetrics_gzip": "true",
     "whitelist": None,
     "blacklist": None,
+    "max_parallel_backups": "1",
+    "cycle_timeout": None,
+    "cycle_time_budget": None,  # via cycle_timeout
+    "postprocess_jobs": "0",  # 0: no pipelining
+    "catalog_enable": "false",
+    "verify_schedule": None,
+    "verify_jobs": "0",  # 0: count of cpus
+    "s3_bucket": None,
+    "s3_prefix": "",
+    "s3_endpoint_url": None,
+    "s3_region": None,
+    "s3_access_key_id": None,
+    "s3_secret_access_key": None,
+    "s3_path_style": None,  # via s3_endpoint_url
+    "s3_part_size": "16M",
+    "s3_upload_jobs": "4",
+    "docker_events_enable": "false",
+    "docker_network_persistent": "false",
+    "docker_network_keep_targets": "false",
 }
 
 LABEL_DEFAULTS = {
@@ -29,9 +55,14 @@ LABEL_DEFAULTS = {
     "port": "auto",  # via type
     "skip_ssl": "true",
     "compress": "false",
-    "compression_level": "6",
+    "compression_algorithm": "gzip",
+    "compression_level": "auto",  # via compression_algorithm
+    "compression_threads": "0",
     "encrypt": "false",
     "encryption_key": "",
+    "stream": "false",
+    "dedup": "false",
+    "skip_unchanged": "false",
     "retention_policy": "none",
     "retention_min_count": "auto",  # via retention_policy
     "retention_min_age": "auto",  # via retention_policy
@@ -39,7 +70,23 @@ LABEL_DEFAULTS = {
     "retention_max_age": "auto",  # via retention_policy
     "dump_name": "",
     "dump_timestamp": "auto",  # via retention_policy
+    "dump_layout": "single",
+    "dump_jobs": "4",
+    "dump_chunk_rows": "1000000",
+    "dump_mode": "network",
+    "nice": "0",
+    "ionice_class": "none",
+    "ionice_level": "4",
+    "read_rate_limit": "0",
+    "write_rate_limit": "0",
+    "schedule": "",  # empty: global schedule
+    "schedule_overlap": "coalesce",
+    "schedule_jitter": "0s",
+    "timeout": "0s",  # 0s: no deadline
     "grace_time": "10s",
+    "healthchecks_io_url": "",  # empty: no pings for the target
+    "continuous": "false",
+    "continuous_slot": "",  # empty: no replication slot
 }
 
 
@@ -57,6 +104,13 @@ class Config:
 
         self.docker_network_name = values["docker_network_name"]
         self.docker_target_name = values["docker_target_name"]
+        self.docker_events_enable = _convert_bool(
+            values["docker_events_enable"])
+        self.docker_network_persistent = _convert_bool(
+            values["docker_network_persistent"])
+        # Attached targets would prevent the network from being removed
+        self.docker_network_keep_targets = self.docker_network_persistent and _convert_bool(
+            values["docker_network_keep_targets"])
 
         self.instance_id = values["instance_id"]
 
@@ -64,10 +118,34 @@ class Config:
 
         self.openmetrics_enable = _convert_bool(values["openmetrics_enable"])
         self.openmetrics_port = int(values["openmetrics_port"])
+        self.openmetrics_gzip = _convert_bool(values["openmetrics_gzip"])
 
         self.whitelist = values["whitelist"]
         self.blacklist = values["blacklist"]
 
+        self.max_parallel_backups = max(int(values["max_parallel_backups"]), 1)
+        self.cycle_timeout = tempora.parse_timedelta(
+            values["cycle_timeout"]) if values["cycle_timeout"] else None
+        # Target duration of a cycle for adaptive compression levels
+        self.cycle_time_budget = tempora.parse_timedelta(
+            values["cycle_time_budget"]) if values["cycle_time_budget"] else self.cycle_timeout
+        self.postprocess_jobs = max(int(values["postprocess_jobs"]), 0)
+
+        self.catalog_enable = _convert_bool(values["catalog_enable"])
+
+        self.verify_schedule = values["verify_schedule"]
+        self.verify_jobs = max(int(values["verify_jobs"]), 0)
+
+        self.s3_bucket = values["s3_bucket"]
+        self.s3_prefix = values["s3_prefix"]
+        self.s3_endpoint_url = values["s3_endpoint_url"]
+        self.s3_region = values["s3_region"]
+        self.s3_access_key_id = values["s3_access_key_id"]
+        self.s3_secret_access_key = values["s3_secret_access_key"]
+        self.s3_path_style = _convert_bool(values["s3_path_style"], True)
+        self.s3_part_size = parse_size(values["s3_part_size"])
+        self.s3_upload_jobs = max(int(values["s3_upload_jobs"]), 1)
+
 
 def read():
     config_values = {}
@@ -84,6 +162,14 @@ def read():
     return Config(config_values), label_values
 
 
+def parse_size(value):
+    """Converts a size like 512K, 10M or 1G into bytes."""
+    matches = SIZE_REGEX.match(value)
+    if matches is None:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(matches.group(1)) * SIZE_UNITS[matches.group(2).lower()])
+
+
 def _create_env_name(name, prefix=""):
     if len(prefix) > 0:
         prefix = prefix + "."
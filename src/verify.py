@@ -0,0 +1,173 @@
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import zlib
+
+from src import checksum, dedup
+from src.catalog import PLAIN_NAME_REGEX, TIMESTAMPED_NAME_REGEX
+
+
+class Check:
+    """Single file, that is verified. `expected` is the stored checksum, or
+    the chunk id for chunks of the deduplication repository."""
+
+    def __init__(self, name, path, expected, chunk=False):
+        self.name = name
+        self.path = path
+        self.expected = expected
+        self.chunk = chunk
+
+
+class Verifier:
+    """Verifies the checksums of all dumps in the dump directory, to detect
+    damaged files (e.g. bit rot of the storage) without decrypting or
+    restoring them. Files are hashed in parallel by threads, as hashlib
+    releases the GIL while hashing."""
+
+    def __init__(self, dump_dir, metrics=None, jobs=0):
+        self._dump_dir = dump_dir
+        self._metrics = metrics
+        self._jobs = jobs if jobs > 0 else os.cpu_count() or 1
+
+    def run(self):
+        """Verifies all dumps. Returns the count of checked, failed and
+        unverified (without checksum) files."""
+        start = time.monotonic()
+        logging.info(f"Starting verification of {self._dump_dir}..")
+
+        checks, unverified = self._collect_checks()
+        failed_names = set()
+        failed = 0
+        checked_bytes = 0
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs,
+            thread_name_prefix="verify",
+        ) as executor:
+            results = executor.map(self._verify, checks)
+            for check, (error, size) in zip(checks, results):
+                checked_bytes += size
+                if error is not None:
+                    logging.error(f"Verification of {check.path} failed: {error}")
+                    failed_names.add(check.name)
+                    failed += 1
+
+        for path in unverified:
+            logging.debug(f"{path} has no checksum")
+
+        duration = time.monotonic() - start
+        message = f"Finished verification. {len(checks) - failed}/{len(checks)} files intact"
+        if unverified:
+            message += f", {len(unverified)} without checksum"
+        message += f" ({duration:.1f}s)"
+        if failed:
+            logging.error(message)
+        else:
+            logging.info(message)
+
+        if self._metrics is not None:
+            self._set_metrics(checks, failed_names, failed, len(unverified), checked_bytes, duration)
+
+        return len(checks), failed, len(unverified)
+
+    def _collect_checks(self):
+        """Returns the files to check and the dumps without checksum."""
+        checks = []
+        unverified = []
+        chunks = {}
+
+        for entry in sorted(os.scandir(self._dump_dir), key=lambda x: x.name):
+            if entry.name.startswith(".") or entry.name.endswith(".part") or checksum.is_sidecar(entry.name):
+                continue
+            name = self._get_dump_name(entry.name)
+            if name is None:
+                continue
+
+            if entry.is_dir():
+                sums = checksum.read_sums(entry.path)
+                if sums is None:
+                    unverified.append(entry.path)
+                    continue
+                for file_name, expected in sums.items():
+                    checks.append(
+                        Check(name, os.path.join(entry.path, file_name), expected))
+                continue
+
+            expected = checksum.read_sidecar(entry.path)
+            if expected is None:
+                unverified.append(entry.path)
+            else:
+                checks.append(Check(name, entry.path, expected))
+
+            if entry.name.endswith(f".{dedup.MANIFEST_EXTENSION}"):
+                try:
+                    with open(entry.path) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    # Reported by the check of the manifest itself
+                    continue
+                repository = dedup.DedupRepository(self._dump_dir)
+                for chunk_id, _ in manifest["chunks"]:
+                    # Chunks shared between dumps are only checked once
+                    chunk_file = repository.get_chunk_file(
+                        chunk_id, manifest["extension"])
+                    chunks.setdefault(chunk_file, Check(name, chunk_file, chunk_id, True))
+
+        return checks + list(chunks.values()), unverified
+
+    def _get_dump_name(self, file_name):
+        match = TIMESTAMPED_NAME_REGEX.match(file_name) or PLAIN_NAME_REGEX.match(file_name)
+        return match.group(1) if match is not None else None
+
+    def _verify(self, check):
+        """Returns the error of a check (None if the file is intact) and the
+        count of read bytes."""
+        try:
+            if check.chunk:
+                return self._verify_chunk(check)
+            actual = checksum.hash_file(check.path)
+            size = os.path.getsize(check.path)
+        except OSError as e:
+            return str(e), 0
+
+        if actual != check.expected:
+            return "Checksum mismatch", size
+        return None, size
+
+    def _verify_chunk(self, check):
+        """Chunks are addressed by the hash of their content. Encrypted
+        chunks can only be checked for existence, as their hash depends on
+        the encryption key."""
+        with open(check.path, "rb") as f:
+            data = f.read()
+        if check.path.endswith(".aes"):
+            return None, len(data)
+
+        size = len(data)
+        if check.path.endswith(".zz"):
+            try:
+                data = zlib.decompress(data)
+            except zlib.error as e:
+                return f"Cannot decompress chunk: {e}", size
+        if hmac.new(b"", data, hashlib.sha256).hexdigest() != check.expected:
+            return "Checksum mismatch", size
+        return None, size
+
+    def _set_metrics(self, checks, failed_names, failed, unverified, checked_bytes, duration):
+        self._metrics.init_verify_metrics()
+        self._metrics.set_single_value('verify_checked_files', len(checks))
+        self._metrics.set_single_value('verify_failed_files', failed)
+        self._metrics.set_single_value('verify_unverified_files', unverified)
+        self._metrics.set_single_value('verify_duration', round(duration * 1000))
+        self._metrics.set_single_value('verify_last_run', round(time.time()))
+        for name in sorted({x.name for x in checks}):
+            self._metrics.add_multi_value(
+                'verify_status', {"name": name}, int(name not in failed_names))
+        self._metrics.increment('verify_runs_total')
+        self._metrics.increment('verify_bytes_total', value=checked_bytes)
+        self._metrics.increment('verify_failures_total', value=failed)
+        self._metrics.flush_metrics()
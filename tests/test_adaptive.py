@@ -0,0 +1,83 @@
+import datetime
+import os
+import tempfile
+import types
+import unittest
+
+from src.adaptive import EWMA_WEIGHT, MAX_CORRECTION, CompressionPlanner
+from src.compression import CompressionAlgorithm
+
+ZSTD = CompressionAlgorithm.zstd
+RAW_SIZE = 10**9
+
+
+def create_database(level=3):
+    return types.SimpleNamespace(
+        compress=True, compression_adaptive=True, compression_level=level, compression_algorithm=ZSTD)
+
+
+class CompressionPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.history_file = os.path.join(directory.name, "history.json")
+        self.planner = CompressionPlanner(self.history_file)
+        # Level 3 compresses in 10s. Levels 2 and 4 are estimated with
+        # 17.5s and 23.3s per backup.
+        self.planner.record("a", ZSTD, 3, RAW_SIZE, RAW_SIZE * 0.3, 20, 10)
+        self.planner.record("b", ZSTD, 3, RAW_SIZE, RAW_SIZE * 0.9, 20, 10)
+
+    def plan(self, budget_seconds, names=("a",)):
+        budget = None if budget_seconds is None else datetime.timedelta(seconds=budget_seconds)
+        return self.planner.plan([(x, create_database()) for x in names], budget, 1)
+
+    def test_without_history(self):
+        levels = self.planner.plan([("new", create_database(5))], datetime.timedelta(seconds=60), 1)
+
+        self.assertEqual(levels, {"new": 5})
+
+    def test_without_budget(self):
+        self.assertEqual(self.plan(None), {"a": 3})
+
+    def test_budget(self):
+        # Moves at most one level beyond the measured ones
+        self.assertEqual(self.plan(3600), {"a": 4})
+        self.assertEqual(self.plan(25), {"a": 3})
+        # Too small budgets fall back to the fastest level
+        self.assertEqual(self.plan(1), {"a": 2})
+
+    def test_most_saved_bytes_first(self):
+        # Capacity for a single raise of one level
+        levels = self.plan(42, ("a", "b"))
+
+        self.assertEqual(levels, {"a": 2, "b": 3})
+
+    def test_correction(self):
+        self.plan(3600)
+        estimate = self.planner._estimate
+
+        self.planner.record_cycle(estimate * 10)
+
+        # Limited to MAX_CORRECTION and averaged
+        self.assertAlmostEqual(self.planner._history["correction"], 1 + EWMA_WEIGHT * (MAX_CORRECTION - 1))
+        self.assertIsNone(self.planner._estimate)
+
+    def test_save(self):
+        self.planner.save()
+
+        self.assertEqual(CompressionPlanner(self.history_file)._history, self.planner._history)
+        self.assertFalse(os.path.exists(f"{self.history_file}.part"))
+
+    def test_damaged_history(self):
+        with open(self.history_file, "w") as f:
+            f.write("{")
+
+        with self.assertLogs(level="WARNING"):
+            planner = CompressionPlanner(self.history_file)
+
+        self.assertEqual(planner._history, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+
+from src import checksum
+from src.verify import Verifier
+
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dump_dir = directory.name
+
+    def test_sidecar(self):
+        path = os.path.join(self.dump_dir, "db_2024-06-01_12-00-00.sql")
+        digest = write_file(path, b"CREATE TABLE t (id int);\n")
+
+        checksum.write_sidecar(path, digest)
+
+        self.assertEqual(checksum.read_sidecar(path), digest)
+        self.assertEqual(checksum.hash_file(path), digest)
+        self.assertTrue(checksum.is_sidecar(checksum.get_sidecar_file(path)))
+        self.assertFalse(os.path.exists(checksum.get_sidecar_file(path) + ".part"))
+        # Compatible with sha256sum
+        result = subprocess.run(
+            ["sha256sum", "-c", checksum.get_sidecar_file(path)], cwd=self.dump_dir, capture_output=True)
+        self.assertEqual(result.returncode, 0)
+
+    def test_missing_sidecar(self):
+        path = os.path.join(self.dump_dir, "db.sql")
+        write_file(path, b"")
+
+        self.assertIsNone(checksum.read_sidecar(path))
+        self.assertIsNone(checksum.read_sums(self.dump_dir))
+
+    def test_sums(self):
+        directory = os.path.join(self.dump_dir, "db.d")
+        os.mkdir(directory)
+        checksums = {
+            "shop.sql": write_file(os.path.join(directory, "shop.sql"), b"shop"),
+            "app.sql": write_file(os.path.join(directory, "app.sql"), b"app"),
+        }
+
+        directory_checksum = checksum.write_sums(directory, checksums)
+
+        self.assertEqual(checksum.read_sums(directory), checksums)
+        self.assertEqual(directory_checksum, checksum.hash_file(os.path.join(directory, checksum.SUMS_FILE)))
+        with open(os.path.join(directory, checksum.SUMS_FILE)) as f:
+            # Sorted by name
+            self.assertEqual(f.readline(), f"{checksums['app.sql']}  app.sql\n")
+
+    def test_verifier(self):
+        intact = os.path.join(self.dump_dir, "a.sql")
+        checksum.write_sidecar(intact, write_file(intact, b"intact"))
+        damaged = os.path.join(self.dump_dir, "b.sql")
+        checksum.write_sidecar(damaged, write_file(damaged, b"damaged"))
+        write_file(damaged, b"bit rot")
+        write_file(os.path.join(self.dump_dir, "c.sql"), b"no checksum")
+        write_file(os.path.join(self.dump_dir, "d.sql.part"), b"partial")
+        directory = os.path.join(self.dump_dir, "e.d")
+        os.mkdir(directory)
+        checksum.write_sums(directory, {"app.sql": write_file(os.path.join(directory, "app.sql"), b"app")})
+
+        with self.assertLogs(level="ERROR"):
+            checked, failed, unverified = Verifier(self.dump_dir, jobs=2).run()
+
+        self.assertEqual((checked, failed, unverified), (3, 1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import hashlib
+import io
+import random
+import unittest
+
+from src import dedup
+
+
+def get_chunk_hashes(data):
+    return [hashlib.sha256(x).hexdigest() for x in dedup.iter_chunks(io.BytesIO(data))]
+
+
+class IterChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        # Extended insert of about 24 MiB in a single line
+        rng = random.Random(0)
+        rows = (
+            f"({i},'{rng.getrandbits(64):x}','name {rng.randint(0, 10**6)}',{rng.random():.6f})"
+            for i in range(500000)
+        )
+        self.dump = f"INSERT INTO `t` VALUES {','.join(rows)};\n".encode()
+
+    def test_sizes(self):
+        chunks = list(dedup.iter_chunks(io.BytesIO(self.dump)))
+
+        self.assertEqual(b"".join(chunks), self.dump)
+        self.assertGreater(len(chunks), 4)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), dedup.MIN_CHUNK_SIZE)
+            self.assertLessEqual(len(chunk), dedup.MAX_CHUNK_SIZE)
+
+    def test_max_size(self):
+        # Runs of this byte contain no boundary
+        data = b"x" * (3 * dedup.MAX_CHUNK_SIZE - 1)
+        chunks = list(dedup.iter_chunks(io.BytesIO(data)))
+
+        self.assertEqual([len(x) for x in chunks], [
+            dedup.MAX_CHUNK_SIZE, dedup.MAX_CHUNK_SIZE, dedup.MAX_CHUNK_SIZE - 1])
+
+    def test_edit_in_long_line(self):
+        # Change one value in the middle of the line, which shifts the rest
+        position = self.dump.index(b"),(", len(self.dump) // 2)
+        edited = self.dump[:position] + b",'changed'" + self.dump[position:]
+
+        original = get_chunk_hashes(self.dump)
+        changed = get_chunk_hashes(edited)
+
+        # Only the chunk with the edit differs
+        self.assertEqual(len(set(changed) - set(original)), 1)
+        self.assertEqual(len(set(original) - set(changed)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import datetime
+import threading
+import time
+import unittest
+
+from src.engine import BackupEngine
+from src.pipeline import ChildProcess
+
+NO_TIMEOUT = datetime.timedelta()
+
+
+def job(result, error=None):
+    def run(scope):
+        if error is not None:
+            raise error
+        yield
+        return result
+    return run
+
+
+def sleeping_job(started):
+    def run(scope):
+        # Targets, that are cancelled before the start, do not dump
+        started.append(not scope.cancelled)
+        if not scope.cancelled:
+            process = ChildProcess("sleep 10")
+            scope.add(process)
+            process.wait()
+            scope.discard(process)
+        yield
+        return scope.reason
+    return run
+
+
+class BackupEngineTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+        engine = BackupEngine(2)
+
+        results = engine.run([(job(x), NO_TIMEOUT) for x in range(5)])
+
+        self.assertEqual(results, list(range(5)))
+
+    def test_failed_job_does_not_abort_others(self):
+        for post_workers in (0, 1):
+            engine = BackupEngine(2, post_workers=post_workers)
+
+            with self.assertLogs(level="ERROR"):
+                results = engine.run([
+                    (job(1), NO_TIMEOUT),
+                    (job(2, IsADirectoryError("bench0.sql.part")), NO_TIMEOUT),
+                    (job(3), NO_TIMEOUT),
+                ])
+
+            self.assertEqual(results, [1, None, 3])
+
+    def test_target_deadline(self):
+        engine = BackupEngine(2)
+        started = []
+        start = time.monotonic()
+
+        results = engine.run([
+            (sleeping_job(started), datetime.timedelta(seconds=0.2)),
+            (job(2), NO_TIMEOUT),
+        ])
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(results, ["Deadline exceeded (0:00:00.200000)", 2])
+
+    def test_cycle_deadline(self):
+        engine = BackupEngine(1, datetime.timedelta(seconds=0.2))
+        started = []
+        start = time.monotonic()
+
+        results = engine.run([
+            (sleeping_job(started), datetime.timedelta(seconds=5)),
+            (sleeping_job(started), NO_TIMEOUT),
+        ])
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(results, ["Cycle deadline exceeded"] * 2)
+        # The second target was waiting for the worker
+        self.assertEqual(started, [True, False])
+
+    def test_post_processing_overlaps_next_dump(self):
+        engine = BackupEngine(1, post_workers=1)
+        dumped = threading.Event()
+
+        def first(scope):
+            yield
+            # Post-processing of the first target waits for the dump of the
+            # second one, which needs the only dump worker
+            return dumped.wait(5)
+
+        def second(scope):
+            dumped.set()
+            yield
+            return True
+
+        results = engine.run([(first, NO_TIMEOUT), (second, NO_TIMEOUT)])
+
+        self.assertEqual(results, [True, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from src import healthcheck
+from src.healthcheck import Healthcheck
+
+
+class FakeSession:
+    def __init__(self):
+        self.urls = []
+        self.released = threading.Event()
+        self.released.set()
+
+    def post(self, url, data=None, timeout=None):
+        self.released.wait()
+        self.urls.append(url)
+        return types.SimpleNamespace(status_code=200, ok=True)
+
+
+def create_healthcheck():
+    check = Healthcheck(types.SimpleNamespace(healthchecks_io_url="http://hc"))
+    check._session = FakeSession()
+    return check
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("Condition not reached")
+
+
+class HealthcheckTest(unittest.TestCase):
+
+    def test_pings_in_order(self):
+        check = create_healthcheck()
+
+        check.start("Start")
+        check.success("Done", "http://target")
+        check.fail("Failed")
+        check.close()
+
+        self.assertEqual(check._session.urls, ["http://hc/start", "http://target", "http://hc/fail"])
+
+    def test_without_url(self):
+        check = Healthcheck(types.SimpleNamespace(healthchecks_io_url=None))
+
+        check.start("Start")
+        check.close()
+
+        self.assertIsNone(check._worker)
+
+    @mock.patch.object(healthcheck, "QUEUE_SIZE", 2)
+    def test_full_queue_keeps_end_marker(self):
+        check = create_healthcheck()
+        session = check._session
+        session.released.clear()
+        # Blocks the worker
+        check._put(("1", None))
+        wait_for(lambda: check._queue.qsize() == 0)
+        check._put(("2", None))
+        closing = threading.Thread(target=check.close)
+        closing.start()
+        wait_for(lambda: check._queue.qsize() == 2)
+
+        with self.assertLogs(level="WARNING"):
+            # Drops the oldest ping
+            check._put(("3", None))
+            # Drops the new ping instead of the end marker
+            check._put(("4", None))
+        session.released.set()
+        closing.join(5)
+
+        self.assertFalse(closing.is_alive())
+        self.assertFalse(check._worker.is_alive())
+        self.assertEqual(session.urls, ["1", "3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import subprocess
+import time
+import unittest
+
+from src.pipeline import ChildProcess
+
+# Uses some CPU time in the shell
+COMMAND = "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done; exit 3"
+
+
+class ChildProcessTest(unittest.TestCase):
+
+    def test_rusage_after_wait(self):
+        process = ChildProcess(COMMAND)
+
+        self.assertEqual(process.wait(), 3)
+        self.assertIsNotNone(process.rusage)
+        self.assertGreater(process.rusage.ru_utime + process.rusage.ru_stime, 0)
+
+    def test_rusage_after_poll(self):
+        process = ChildProcess(COMMAND)
+
+        while process.poll() is None:
+            self.assertIsNone(process.rusage)
+            time.sleep(0.01)
+
+        self.assertEqual(process.returncode, 3)
+        self.assertIsNotNone(process.rusage)
+        self.assertGreater(process.rusage.ru_utime + process.rusage.ru_stime, 0)
+        # Already reaped
+        self.assertEqual(process.wait(), 3)
+
+    def test_wait_timeout(self):
+        process = ChildProcess("sleep 10")
+
+        with self.assertRaises(subprocess.TimeoutExpired):
+            process.wait(0.05)
+        process.kill()
+
+        self.assertEqual(process.wait(1), -9)
+        self.assertIsNotNone(process.rusage)
+
+
+if __name__ == "__main__":
+    unittest.main()
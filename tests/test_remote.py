@@ -0,0 +1,154 @@
+import threading
+import types
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+from src import remote
+from src.remote import MultipartUpload, RemoteError, RemoteStorage
+
+DUMP_DIR = "/dump"
+
+
+class FakeClient:
+    def __init__(self, keys=(), fail_part=None):
+        self.keys = list(keys)
+        self.fail_part = fail_part
+        self.objects = {}
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.deleted = []
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url="http://s3")
+        with self._lock:
+            self.parts[PartNumber] = Body
+        return {"ETag": f"etag{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload["Parts"]
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def delete_objects(self, Bucket, Delete):
+        self.deleted += [x["Key"] for x in Delete["Objects"]]
+        return {}
+
+    def get_paginator(self, name):
+        keys = self.keys
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                return [{"Contents": [{"Key": x} for x in keys if x.startswith(Prefix)]}]
+        return Paginator()
+
+
+def create_storage(client):
+    config = types.SimpleNamespace(
+        s3_bucket="bucket", s3_prefix="backups/", s3_part_size=0, s3_upload_jobs=2, s3_path_style=None,
+        s3_endpoint_url=None, s3_region=None, s3_access_key_id=None, s3_secret_access_key=None,
+        max_parallel_backups=1)
+    with mock.patch("boto3.client", return_value=client):
+        return RemoteStorage(config, DUMP_DIR)
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def test_small_upload(self):
+        client = FakeClient()
+        upload = MultipartUpload(client, "bucket", "db.sql", remote.MIN_PART_SIZE, 2)
+
+        upload.write(b"dump")
+        upload.complete()
+
+        self.assertEqual(client.objects, {"db.sql": b"dump"})
+        self.assertIsNone(client.completed)
+
+    def test_parts(self):
+        client = FakeClient()
+        upload = MultipartUpload(client, "bucket", "db.sql", 4, 2)
+
+        for data in (b"abc", b"defghij", b"klmnopq"):
+            upload.write(data)
+        upload.complete()
+
+        self.assertEqual(upload.bytes, 17)
+        self.assertEqual(client.completed, [{"ETag": f"etag{x}", "PartNumber": x} for x in range(1, 6)])
+        self.assertEqual(b"".join(client.parts[x] for x in range(1, 6)), b"abcdefghijklmnopq")
+
+    @mock.patch.object(remote, "PART_SIZE_STEP", 2)
+    def test_growing_part_size(self):
+        client = FakeClient()
+        upload = MultipartUpload(client, "bucket", "db.sql", 1, 1)
+
+        upload.write(b"x" * 10)
+        upload.complete()
+
+        # Doubled after every 2 parts
+        self.assertEqual([len(client.parts[x]) for x in sorted(client.parts)], [1, 1, 2, 2, 4])
+
+    def test_failed_part(self):
+        client = FakeClient(fail_part=2)
+        upload = MultipartUpload(client, "bucket", "db.sql", 4, 2)
+
+        upload.write(b"x" * 16)
+        with self.assertRaises(RemoteError):
+            upload.complete()
+
+        self.assertTrue(client.aborted)
+        self.assertIsNone(client.completed)
+
+
+class RemoteStorageTest(unittest.TestCase):
+
+    def test_get_dumps(self):
+        client = FakeClient([
+            "backups/db_2024-06-01_12-00-00.sql.gz",
+            "backups/db_2024-06-01_12-00-00.sql.gz.sha256",
+            "backups/db_2024-06-02_12-00-00.d/app.sql",
+            "backups/db_2024-06-02_12-00-00.d/SHA256SUMS",
+            "backups/db_other_2024-06-03_12-00-00.sql",
+            "backups/db.sql",
+        ])
+        storage = create_storage(client)
+
+        dumps = storage.get_dumps("db")
+
+        self.assertEqual([(path, timestamp.day) for path, timestamp in dumps], [
+            (f"{DUMP_DIR}/db_2024-06-02_12-00-00.d", 2),
+            (f"{DUMP_DIR}/db_2024-06-01_12-00-00.sql.gz", 1),
+        ])
+
+    def test_remove_dump(self):
+        client = FakeClient([
+            "backups/db_2024-06-01_12-00-00.sql",
+            "backups/db_2024-06-01_12-00-00.sql.sha256",
+            "backups/db_2024-06-01_12-00-00.sql.gz",
+            "backups/db_2024-06-02_12-00-00.d/app.sql",
+            "backups/db_2024-06-02_12-00-00.d/SHA256SUMS",
+        ])
+        storage = create_storage(client)
+
+        storage.remove_dump(f"{DUMP_DIR}/db_2024-06-01_12-00-00.sql")
+        storage.remove_dump(f"{DUMP_DIR}/db_2024-06-02_12-00-00.d", keep=["backups/db_2024-06-02_12-00-00.d/SHA256SUMS"])
+
+        self.assertEqual(client.deleted, [
+            "backups/db_2024-06-01_12-00-00.sql",
+            "backups/db_2024-06-01_12-00-00.sql.sha256",
+            "backups/db_2024-06-02_12-00-00.d/app.sql",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
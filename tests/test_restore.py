@@ -0,0 +1,72 @@
+import io
+import os
+import tempfile
+import types
+import unittest
+
+from src.database import DatabaseType
+from src.restore import GLOBALS_NAME, Restore, SqlFilter
+
+PG_DUMPALL = b"""SET default_transaction_read_only = off;
+CREATE ROLE app;
+--
+-- Database "app" dump
+--
+CREATE DATABASE app;
+\\connect app
+CREATE TABLE public.users (id int);
+--
+-- Database "shop" dump
+--
+CREATE DATABASE shop;
+\\connect shop
+CREATE TABLE public.orders (id int);
+"""
+
+
+def read_filtered(database=None, table=None, header=True):
+    stream = SqlFilter(io.BytesIO(PG_DUMPALL), database, table, header)
+    return stream.read(), stream
+
+
+class SqlFilterTest(unittest.TestCase):
+
+    def test_database_with_header(self):
+        data, stream = read_filtered("shop")
+
+        self.assertTrue(stream.database_found)
+        self.assertIn(b"CREATE ROLE app;", data)
+        self.assertIn(b"CREATE TABLE public.orders", data)
+        self.assertNotIn(b"CREATE TABLE public.users", data)
+
+    def test_database_without_header(self):
+        data, _ = read_filtered("app", header=False)
+
+        self.assertNotIn(b"CREATE ROLE app;", data)
+        self.assertIn(b"CREATE TABLE public.users", data)
+        self.assertNotIn(b"CREATE TABLE public.orders", data)
+
+    def test_globals(self):
+        data, stream = read_filtered(GLOBALS_NAME)
+
+        self.assertTrue(stream.database_found)
+        self.assertTrue(data.startswith(b"SET default_transaction_read_only"))
+        self.assertNotIn(b"CREATE DATABASE", data)
+
+
+class ListDatabasesTest(unittest.TestCase):
+
+    def test_list_databases(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "all.sql")
+            with open(path, "wb") as f:
+                f.write(PG_DUMPALL)
+            database = types.SimpleNamespace(type=DatabaseType.postgres, encryption_key="")
+
+            names = Restore(None, None, database)._list_databases(path)
+
+        self.assertEqual(names, ["app", "shop"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import datetime
+import logging
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from src import settings
+from src.backup import Backup
+from src.database import DatabaseType
+
+START = datetime.datetime(2024, 6, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def create_database(max_count=2, max_age=datetime.timedelta()):
+    return types.SimpleNamespace(
+        type=DatabaseType.mysql, continuous=False, dump_timestamp=True, retention_policy="simple",
+        retention_min_count=1, retention_min_age=datetime.timedelta(),
+        retention_max_count=max_count, retention_max_age=max_age)
+
+
+def get_dump_name(days_ago, extension="sql"):
+    timestamp = START - datetime.timedelta(days=days_ago)
+    return f"db_{timestamp.strftime('%Y-%m-%d_%H-%M-%S')}.{extension}"
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dump_dir = directory.name
+        patcher = mock.patch.object(Backup, "DUMP_DIR", self.dump_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log = logging.getLogger("test")
+
+    def create_backup(self, catalog_enable=False):
+        with mock.patch.dict(os.environ, {"CATALOG_ENABLE": str(catalog_enable).lower()}):
+            config, global_labels = settings.read()
+        return Backup(config, global_labels, None, None, None)
+
+    def create_file(self, name, mtime=None):
+        path = f"{self.dump_dir}/{name}"
+        with open(path, "w") as f:
+            f.write("dump")
+        if mtime is not None:
+            os.utime(path, (mtime.timestamp(), mtime.timestamp()))
+        return path
+
+    def test_select_expired(self):
+        backup = self.create_backup()
+        files = [(get_dump_name(x), START - datetime.timedelta(days=x)) for x in range(5)]
+
+        kept, deleted = backup._select_expired(
+            create_database(max_count=0, max_age=datetime.timedelta(days=2)), files, START, self.log)
+
+        self.assertEqual(kept, 3)
+        self.assertEqual(deleted, [x[0] for x in files[3:]])
+
+    def test_catalog_retention(self):
+        for days_ago in range(4):
+            self.create_file(get_dump_name(days_ago))
+        self.create_file("db.sql")
+        backup = self.create_backup(catalog_enable=True)
+
+        kept, checked = backup._apply_retention(create_database(), "db", START, self.log)
+
+        # Dumps without timestamp are not part of the retention
+        self.assertEqual((kept, checked), (2, 4))
+        self.assertEqual(sorted(os.listdir(self.dump_dir)), sorted(
+            [".catalog.sqlite", "db.sql", get_dump_name(0), get_dump_name(1)]))
+        self.assertEqual([x.path for x in backup._catalog.get_artifacts("db")], [
+            f"{self.dump_dir}/{get_dump_name(0)}", f"{self.dump_dir}/{get_dump_name(1)}",
+            f"{self.dump_dir}/db.sql"])
+
+    def test_partial_dumps(self):
+        for days_ago in range(3):
+            self.create_file(get_dump_name(days_ago))
+        stale_file = self.create_file(get_dump_name(3, "sql.part"), START - datetime.timedelta(days=3))
+        stale_dir = f"{self.dump_dir}/{get_dump_name(4, 'd.part')}"
+        os.mkdir(stale_dir)
+        os.utime(stale_dir, (START.timestamp() - 60, START.timestamp() - 60))
+        # Written by the current run
+        current_file = self.create_file(get_dump_name(0, "sql.gz.part"), START)
+        # Belongs to another target
+        other_file = self.create_file("db_other.sql.part", START - datetime.timedelta(days=3))
+        backup = self.create_backup()
+
+        kept, checked = backup._apply_retention(create_database(max_count=3), "db", START, self.log)
+
+        self.assertEqual((kept, checked), (3, 3))
+        self.assertFalse(os.path.exists(stale_file))
+        self.assertFalse(os.path.exists(stale_dir))
+        self.assertTrue(os.path.exists(current_file))
+        self.assertTrue(os.path.exists(other_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
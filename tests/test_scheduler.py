@@ -0,0 +1,144 @@
+import datetime
+import types
+import unittest
+
+from src.database import OverlapPolicy
+from src.scheduler import Scheduler
+
+
+class FakeBackup:
+    def __init__(self, containers=(), schedules=None, error=None):
+        self.containers = list(containers)
+        self.schedules = schedules or {}
+        self.error = error
+        self.runs = []
+
+    def get_targets(self):
+        return self.containers
+
+    def get_targets_version(self):
+        return None
+
+    def update_streams(self, containers):
+        pass
+
+    def get_database(self, container):
+        schedule, overlap = self.schedules.get(container.id, ("", OverlapPolicy.coalesce))
+        return types.SimpleNamespace(
+            schedule=schedule, schedule_overlap=overlap, schedule_jitter=datetime.timedelta())
+
+    def run(self, containers=None):
+        self.runs.append(None if containers is None else [x.name for x in containers])
+        if self.error is not None:
+            raise self.error
+
+
+class FakeMetrics:
+    def __init__(self):
+        self.counters = {}
+
+    def increment(self, name, labels=None, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush_metrics(self):
+        pass
+
+
+def create_scheduler(backup, schedule="60", overlap="coalesce", jitter="0s"):
+    config = types.SimpleNamespace(schedule=schedule, run_at_startup=False, schedule_hash_id="test")
+    metrics = FakeMetrics()
+    scheduler = Scheduler(
+        config, {"schedule_overlap": overlap, "schedule_jitter": jitter}, backup, metrics)
+    return scheduler, metrics
+
+
+def plan_in_past(scheduler, seconds, key=Scheduler.GLOBAL_JOB):
+    job = scheduler._jobs[key]
+    scheduler._plan(job, datetime.datetime.now() - datetime.timedelta(seconds=seconds))
+    return job
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_failed_cycle_does_not_stop_scheduler(self):
+        backup = FakeBackup(error=RuntimeError("Docker API error"))
+        config = types.SimpleNamespace(schedule=None, run_at_startup=None, schedule_hash_id="test")
+        metrics = FakeMetrics()
+        scheduler = Scheduler(
+            config, {"schedule_overlap": "coalesce", "schedule_jitter": "0s"}, backup, metrics)
+
+        with self.assertLogs(level="ERROR"):
+            scheduler.run()
+
+        self.assertEqual(backup.runs, [None])
+        self.assertEqual(metrics.counters["scheduler_failed_runs_total"], 1)
+
+    def test_coalesce_missed_runs(self):
+        backup = FakeBackup()
+        scheduler, metrics = create_scheduler(backup)
+        job = plan_in_past(scheduler, 179)
+
+        scheduler._run_due_jobs()
+
+        self.assertEqual(backup.runs, [None])
+        self.assertEqual(metrics.counters["scheduler_coalesced_runs_total"], 2)
+        # Next run stays aligned to the schedule
+        self.assertGreater(job.planned, datetime.datetime.now())
+        self.assertLessEqual(job.planned, datetime.datetime.now() + datetime.timedelta(seconds=1))
+
+    def test_skip_overlapping_run(self):
+        backup = FakeBackup()
+        scheduler, metrics = create_scheduler(backup, overlap="skip")
+        plan_in_past(scheduler, 30)
+        scheduler._last_run_end = datetime.datetime.now()
+
+        scheduler._run_due_jobs()
+
+        self.assertEqual(backup.runs, [])
+        self.assertEqual(metrics.counters["scheduler_skipped_runs_total"], 1)
+
+    def test_queue_missed_runs(self):
+        backup = FakeBackup()
+        scheduler, _ = create_scheduler(backup, overlap="queue")
+        job = plan_in_past(scheduler, 60 * 20 - 1)
+
+        scheduler._run_due_jobs()
+
+        # Only the last missed runs are kept
+        self.assertEqual(backup.runs, [None])
+        missed = scheduler._get_missed_runs(job, job.planned, datetime.datetime.now())
+        self.assertEqual(len(missed), Scheduler.MAX_QUEUED_RUNS)
+
+    def test_jitter(self):
+        scheduler, _ = create_scheduler(FakeBackup(), jitter="10s")
+        job = scheduler._jobs[Scheduler.GLOBAL_JOB]
+
+        for _ in range(20):
+            scheduler._plan(job, job.planned)
+            run_time = [x[0] for x in scheduler._queue if x[1] == job.sequence][0]
+            self.assertGreaterEqual(run_time, job.planned)
+            self.assertLessEqual(run_time, job.planned + datetime.timedelta(seconds=10))
+
+    def test_target_schedules(self):
+        containers = [types.SimpleNamespace(id="a", name="a"), types.SimpleNamespace(id="b", name="b")]
+        backup = FakeBackup(containers, {"b": ("3600", OverlapPolicy.skip)})
+        scheduler, _ = create_scheduler(backup)
+
+        scheduler._refresh_jobs()
+
+        self.assertIn("b", scheduler._jobs)
+        self.assertEqual(scheduler._global_targets, [containers[0]])
+
+        # Targets with an own schedule run alone
+        plan_in_past(scheduler, 1, "b")
+        scheduler._run_due_jobs()
+        self.assertEqual(backup.runs, [["b"]])
+
+        # Removed targets lose their job
+        backup.containers = containers[:1]
+        scheduler._refresh_jobs()
+        self.assertNotIn("b", scheduler._jobs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import argparse
+import logging
+import sys
+
+from src.backup import Backup
+from src.verify import Verifier
+
+
+def verify(dump_dir, jobs=0):
+    try:
+        checked, failed, unverified = Verifier(dump_dir, jobs=jobs).run()
+        if failed:
+            print(f"Verification failed: {failed}/{checked} file(s) damaged")
+            return False
+        print(f"Verification successful: {checked} file(s) intact, {unverified} dump(s) without checksum")
+        return True
+    except Exception as e:
+        print(f"Verification failed: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verifies the checksums of all dumps in the dump directory.")
+    parser.add_argument(
+        "dump_dir", nargs="?", default=Backup.DUMP_DIR, help=f"Default: {Backup.DUMP_DIR}")
+    parser.add_argument(
+        "--jobs", type=int, default=0, help="Files checked in parallel. Default: count of cpus")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    sys.exit(0 if verify(args.dump_dir, args.jobs) else 1)